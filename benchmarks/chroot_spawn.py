@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Measure per-run latency of the 'chroot' backend with a large parent heap.
+
+The cost of forking grows with the size of the calling process. The backend
+forks only once per run, but that fork still copies the page tables of the
+parent, so the latency still depends on the size of the heap. This allocates
+(and touches) each of the given amounts of memory in turn, and runs a trivial
+command in the sandbox many times with each, so the difference between them
+shows how much the heap still costs.
+
+This must be run as 'root', because the 'chroot' backend needs to be.
+
+'''
+
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sandboxlib
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--heap-size', type=int, nargs='+', default=[64, 2048], metavar='MB',
+        help="sizes of the parent process heap to compare (default: 64 "
+             "2048)")
+    parser.add_argument(
+        '--runs', type=int, default=50,
+        help="number of sandbox runs to time (default: 50)")
+    parser.add_argument(
+        '--command', type=str, default='true',
+        help="command to run in the sandbox (default: true)")
+    return parser.parse_args()
+
+
+def allocate_heap(size_mb):
+    # Writing to every page makes sure the memory is really resident.
+    heap = bytearray(size_mb * 1024 * 1024)
+    for i in range(0, len(heap), 4096):
+        heap[i] = 1
+    return heap
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def time_runs(command, runs):
+    timings = []
+    for i in range(runs):
+        start = sandboxlib.utils.monotonic()
+        exit, out, err = sandboxlib.chroot.run_sandbox(
+            [command], filesystem_root='/')
+        timings.append(sandboxlib.utils.monotonic() - start)
+        assert exit == 0, err
+    return timings
+
+
+def main():
+    args = parse_args()
+
+    medians = []
+    for heap_size in args.heap_size:
+        heap = allocate_heap(heap_size)
+        timings = time_runs(args.command, args.runs)
+        del heap
+
+        medians.append(percentile(timings, 0.5))
+        print("heap: %i MB, runs: %i" % (heap_size, args.runs))
+        print("  median: %.2f ms, p90: %.2f ms, min: %.2f ms" % (
+            medians[-1] * 1000, percentile(timings, 0.9) * 1000,
+            min(timings) * 1000))
+
+    if len(medians) > 1:
+        print("median latency at %i MB is %.2fx that at %i MB" % (
+            args.heap_size[-1], medians[-1] / medians[0], args.heap_size[0]))
+
+
+if __name__ == '__main__':
+    main()
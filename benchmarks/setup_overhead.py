@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Measure the overhead of setting up sandboxes, for each backend.
+
+Each benchmark runs one of the static C programs from tests/programs.py in a
+small sandbox, varying one aspect of the sandbox configuration:
+
+  - extra_mounts: the number of tmpfs mounts in 'extra_mounts'
+  - writable_paths: the number of files in 'filesystem_root', with all of it
+        writable or only one directory writable
+  - output: the number of bytes the command writes to a captured stdout
+  - concurrency: the number of sandboxes run at once with run_sandbox_async()
+
+'Cold' runs clear the caches that sandboxlib keeps between runs first, and
+'warm' runs don't. The results are printed, and can be written to a JSON file
+with --output. A results file from an earlier run can be given with
+--baseline, in which case any benchmark whose median warm time has grown by
+more than --threshold is reported, and the exit code is 1.
+
+Backends that can't be used on the current machine are skipped.
+
+'''
+
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+import sandboxlib
+import programs
+
+
+BACKENDS = ['chroot', 'linux_namespaces', 'linux_user_chroot']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--backend', action='append', choices=BACKENDS,
+        help="backend to benchmark (default: all that are available)")
+    parser.add_argument(
+        '--benchmark', action='append',
+        choices=['extra_mounts', 'writable_paths', 'output', 'concurrency'],
+        help="benchmark to run (default: all)")
+    parser.add_argument(
+        '--runs', type=int, default=20,
+        help="number of timed runs of each configuration (default: 20)")
+    parser.add_argument(
+        '--quick', action='store_true',
+        help="skip the largest configurations")
+    parser.add_argument(
+        '--output', type=str, metavar='FILE',
+        help="write the results to FILE as JSON")
+    parser.add_argument(
+        '--baseline', type=str, metavar='FILE',
+        help="compare the results with those in FILE")
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help="fraction by which a median time may grow before it counts as a "
+             "regression (default: 0.25)")
+    return parser.parse_args()
+
+
+def available_backends(names):
+    result = []
+    for name in names:
+        if name == 'chroot' and os.getuid() != 0:
+            skip_reason = 'needs root'
+        elif name == 'linux_namespaces' and \
+                not sandboxlib.linux_namespaces.namespaces_available():
+            skip_reason = 'unable to create user namespaces'
+        elif name == 'linux_user_chroot' and not linux_user_chroot_found():
+            skip_reason = "'linux-user-chroot' not found"
+        else:
+            result.append(getattr(sandboxlib, name))
+            continue
+        print("Skipping %s backend: %s" % (name, skip_reason))
+    return result
+
+
+def linux_user_chroot_found():
+    try:
+        sandboxlib.linux_user_chroot.linux_user_chroot_program()
+        return True
+    except sandboxlib.ProgramNotFound:
+        return False
+
+
+def supports_writable_paths(executor):
+    return 'any' in executor.CAPABILITIES['filesystem_writable_paths']
+
+
+def build_programs(path):
+    for name, source in [
+            ('test-file-or-directory-exists',
+             programs.FILE_OR_DIRECTORY_EXISTS_TEST_PROGRAM),
+            ('test-write-output', programs.WRITE_OUTPUT_TEST_PROGRAM)]:
+        programs.build_c_program(source, os.path.join(path, name))
+
+
+def make_sandbox(path, program_dir, n_files=0):
+    '''Create a sandbox containing the test programs and 'n_files' files.'''
+    os.makedirs(os.path.join(path, 'bin'))
+    for name in os.listdir(program_dir):
+        shutil.copy2(os.path.join(program_dir, name),
+                     os.path.join(path, 'bin', name))
+
+    files_per_dir = 100
+    for i in range(n_files):
+        dir_path = os.path.join(path, 'data', str(i // files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, str(i)), 'w'):
+            pass
+    return path
+
+
+def clear_caches():
+    sandboxlib.linux_user_chroot.readonly_paths_cache.invalidate()
+
+
+def summarise(timings):
+    timings = sorted(timings)
+
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+    return {
+        'median': percentile(0.5),
+        'p90': percentile(0.9),
+        'min': timings[0],
+    }
+
+
+def time_runs(run, runs):
+    '''Time 'runs' cold calls and 'runs' warm calls of the function 'run'.
+
+    The function should return a SandboxResult, or a list of them. The median
+    time spent in each phase of the warm runs is also returned.
+
+    '''
+    cold = []
+    for i in range(runs):
+        clear_caches()
+        start = sandboxlib.utils.monotonic()
+        run()
+        cold.append(sandboxlib.utils.monotonic() - start)
+
+    run()
+
+    warm = []
+    phases = {}
+    for i in range(runs):
+        start = sandboxlib.utils.monotonic()
+        results = run()
+        warm.append(sandboxlib.utils.monotonic() - start)
+
+        if not isinstance(results, list):
+            results = [results]
+        for result in results:
+            for phase, seconds in result.timings.items():
+                phases.setdefault(phase, []).append(seconds)
+
+    return {
+        'cold': summarise(cold),
+        'warm': summarise(warm),
+        'phases': dict(
+            (phase, summarise(seconds)['median'])
+            for phase, seconds in phases.items()),
+    }
+
+
+def check_result(result):
+    exit, out, err = result
+    if exit != 0:
+        raise RuntimeError("Command failed with exit code %i: %s" % (
+            exit, err.decode('utf-8', 'replace') if err else ''))
+    return result
+
+
+def benchmark_extra_mounts(executor, workdir, program_dir, args):
+    sandbox = make_sandbox(os.path.join(workdir, 'sandbox'), program_dir)
+    for n_mounts in [0, 1, 10] if args.quick else [0, 1, 10, 50]:
+        extra_mounts = [
+            (None, '/mnt/%i' % i, 'tmpfs', None) for i in range(n_mounts)]
+
+        def run():
+            return check_result(executor.run_sandbox(
+                ['test-file-or-directory-exists', '/'],
+                filesystem_root=sandbox, extra_mounts=extra_mounts))
+
+        yield {'extra_mounts': n_mounts}, run
+
+
+def benchmark_writable_paths(executor, workdir, program_dir, args):
+    sizes = [0, 1000, 10000] if args.quick else [0, 1000, 10000, 100000]
+    for n_files in sizes:
+        sandbox = make_sandbox(
+            os.path.join(workdir, 'sandbox-%i' % n_files), program_dir,
+            n_files=n_files)
+
+        writable_paths_options = ['all']
+        if supports_writable_paths(executor):
+            writable_paths_options.append(['/data/0'])
+
+        for writable_paths in writable_paths_options:
+            def run():
+                return check_result(executor.run_sandbox(
+                    ['test-file-or-directory-exists', '/'],
+                    filesystem_root=sandbox,
+                    filesystem_writable_paths=writable_paths))
+
+            yield {
+                'files': n_files,
+                'writable_paths': writable_paths,
+            }, run
+
+
+def benchmark_output(executor, workdir, program_dir, args):
+    sandbox = make_sandbox(os.path.join(workdir, 'sandbox'), program_dir)
+    sizes = [0, 1 << 20, 16 << 20] if args.quick else \
+        [0, 1 << 20, 16 << 20, 256 << 20]
+    for n_bytes in sizes:
+        for mode in ['capture', 'tail']:
+            def run():
+                if mode == 'capture':
+                    stdout = sandboxlib.CAPTURE
+                else:
+                    stdout = sandboxlib.output.TailBuffer()
+                return check_result(executor.run_sandbox(
+                    ['test-write-output', str(n_bytes)],
+                    filesystem_root=sandbox, stdout=stdout))
+
+            yield {'bytes': n_bytes, 'stdout': mode}, run
+
+
+def benchmark_concurrency(executor, workdir, program_dir, args):
+    sandbox = make_sandbox(os.path.join(workdir, 'sandbox'), program_dir)
+    for n_sandboxes in [1, 4, 16] if args.quick else [1, 4, 16, 64]:
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                results = loop.run_until_complete(asyncio.gather(*[
+                    executor.run_sandbox_async(
+                        ['test-file-or-directory-exists', '/'],
+                        filesystem_root=sandbox)
+                    for i in range(n_sandboxes)]))
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+            return [check_result(result) for result in results]
+
+        yield {'sandboxes': n_sandboxes}, run
+
+
+BENCHMARKS = [
+    ('extra_mounts', benchmark_extra_mounts),
+    ('writable_paths', benchmark_writable_paths),
+    ('output', benchmark_output),
+    ('concurrency', benchmark_concurrency),
+]
+
+
+def result_key(result):
+    return json.dumps(
+        [result['benchmark'], result['backend'], result['params']],
+        sort_keys=True)
+
+
+def format_params(params):
+    return ' '.join('%s=%s' % (key, params[key]) for key in sorted(params))
+
+
+def compare_with_baseline(results, baseline, threshold):
+    '''Print a comparison with 'baseline', and return the regressions.'''
+    baseline_results = dict(
+        (result_key(result), result) for result in baseline['results'])
+
+    regressions = []
+    for result in results:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            continue
+        old_median = old['warm']['median']
+        new_median = result['warm']['median']
+        change = (new_median - old_median) / old_median if old_median else 0
+        marker = ''
+        if change > threshold:
+            regressions.append(result)
+            marker = '  REGRESSION'
+        print("%-15s %-18s %-35s %8.2f ms -> %8.2f ms (%+.0f%%)%s" % (
+            result['benchmark'], result['backend'],
+            format_params(result['params']), old_median * 1000,
+            new_median * 1000, change * 100, marker))
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    executors = available_backends(args.backend or BACKENDS)
+    benchmarks = [(name, function) for name, function in BENCHMARKS
+                  if args.benchmark is None or name in args.benchmark]
+
+    workdir = tempfile.mkdtemp()
+    try:
+        program_dir = os.path.join(workdir, 'programs')
+        os.makedirs(program_dir)
+        build_programs(program_dir)
+
+        results = []
+        for executor in executors:
+            backend = executor.__name__.split('.')[-1]
+            for name, function in benchmarks:
+                benchmark_dir = os.path.join(workdir, backend, name)
+                os.makedirs(benchmark_dir)
+                for params, run in function(
+                        executor, benchmark_dir, program_dir, args):
+                    result = {
+                        'benchmark': name,
+                        'backend': backend,
+                        'params': params,
+                    }
+                    result.update(time_runs(run, args.runs))
+                    results.append(result)
+                    print("%-15s %-18s %-35s cold %8.2f ms, warm %8.2f ms" % (
+                        name, backend, format_params(params),
+                        result['cold']['median'] * 1000,
+                        result['warm']['median'] * 1000))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'runs': args.runs,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nComparison with %s:" % args.baseline)
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print("\n%i regression(s) found." % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
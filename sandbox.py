@@ -37,7 +37,12 @@ def make_sandbox_for_command(command, source_tar, target,
     This is a dumb idea, because you have to unpack a tar, create a tar, then
     unpack it again to run it.
 
-    Better to have the executor take manifest and rootfs separately.
+    There's no need for it any more: `run-sandbox` can run a command in a
+    rootfs tarball or directory directly, for example:
+
+        run-sandbox baserock-minimal.tar '/bin/sh -c "echo foo && exit 1"'
+
+    and the manifest can be given separately with `--manifest`.
 
     '''
     tempdir = tempfile.mkdtemp()
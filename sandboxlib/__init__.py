@@ -22,11 +22,13 @@ docstrings that describe the different parameters.
 '''
 
 
+import collections
 import logging
 import os
 import platform
 import pipes
 import subprocess
+import sys
 import warnings
 
 
@@ -59,12 +61,95 @@ CAPTURE = subprocess.PIPE
 # Special value for 'stderr' parameter to indicate 'forward to stdout'.
 STDOUT = subprocess.STDOUT
 
+# Values of SandboxResult.timed_out, saying which limit the command exceeded.
+TIMEOUT_WALL_CLOCK = 'wall_clock'
+TIMEOUT_CPU_TIME = 'cpu_time'
+
+
+class SandboxResult(tuple):
+    '''The result of running a command in a sandbox.
+
+    This is a tuple of (exit code, stdout output, stderr output), so it can
+    be unpacked in the same way as the result of subprocess.communicate().
+    The same values are available as the 'exit', 'stdout' and 'stderr'
+    attributes.
+
+    The 'timings' attribute is an OrderedDict mapping the name of each phase
+    of running the sandbox to the number of seconds it took, as measured by
+    a monotonic clock. The phases depend on the backend, but may include:
+
+      - config: checking and converting the sandbox configuration
+      - writable_paths: working out which paths to make read-only
+      - mounts: mounting 'extra_mounts'
+      - spawn: starting the command, including any setup done in the child
+            process before it executes the command
+      - run: running the command and reading its output
+      - teardown: unmounting and removing temporary files
+      - trace: looking for changes to 'filesystem_root', if 'trace' was
+            given
+      - cgroup: creating and removing the cgroup, if 'resources' was given
+
+    The 'rusage' attribute is the resource usage of the command as returned
+    by os.wait4(), including any child processes that it waited for. It has
+    the same attributes as the result of resource.getrusage(), such as
+    'ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock',
+    'ru_nvcsw' and 'ru_nivcsw'. It is None if os.wait4() isn't available.
+
+    The 'timed_out' attribute is None if the command ran until it exited by
+    itself. If it was killed because it exceeded the 'timeout' given to
+    run_sandbox(), it is TIMEOUT_WALL_CLOCK, and if it was killed for using
+    more than 'cpu_time_limit' seconds of CPU time, it is TIMEOUT_CPU_TIME.
+    The exit code is then the negative number of the signal that killed it.
+
+    The 'cached' attribute is True if the result was taken from an
+    'action_cache' instead of running the command.
+
+    The 'file_accesses' attribute is a sandboxlib.trace.FileAccesses listing
+    the files that the command read, wrote, created and deleted, if the
+    'trace' parameter was given, and None otherwise.
+
+    The 'cgroup_usage' attribute is a sandboxlib.cgroup.CgroupUsage giving
+    the CPU time, peak memory use and OOM kills of everything that ran in
+    the sandbox, if the 'resources' parameter was given, and None otherwise.
+
+    '''
+
+    def __new__(cls, exit, stdout, stderr, timings=None, rusage=None,
+                timed_out=None, cached=False, file_accesses=None,
+                cgroup_usage=None):
+        self = tuple.__new__(cls, (exit, stdout, stderr))
+        self.timings = timings if timings is not None else \
+            collections.OrderedDict()
+        self.rusage = rusage
+        self.timed_out = timed_out
+        self.cached = cached
+        self.file_accesses = file_accesses
+        self.cgroup_usage = cgroup_usage
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def exit(self):
+        return self[0]
+
+    @property
+    def stdout(self):
+        return self[1]
+
+    @property
+    def stderr(self):
+        return self[2]
+
 
 def run_sandbox(command, cwd=None, env=None,
                 filesystem_root='/', filesystem_writable_paths='all',
                 mounts='undefined', extra_mounts=None,
                 network='undefined',
-                stderr=CAPTURE, stdout=CAPTURE):
+                stderr=CAPTURE, stdout=CAPTURE,
+                timeout=None, cpu_time_limit=None, action_cache=None,
+                trace=None, resources=None, scheduling=None):
     '''Run 'command' in a sandboxed environment.
 
     Parameters:
@@ -76,6 +161,9 @@ def run_sandbox(command, cwd=None, env=None,
       - env: environment variables to set
       - filesystem_root: the path to the root of the sandbox. Defaults to '/',
             which doesn't isolate the command from the host filesystem at all.
+            Backends may accept a sandboxlib.overlay.Overlay instead, in
+            which case the command's changes to the filesystem are written
+            to a separate directory rather than to the tree itself.
       - filesystem_writable_paths: defaults to 'all', which allows the command
             to write to anywhere under 'filesystem_root' that the user of the
             calling process could write to. Backends may accept a list of paths
@@ -102,11 +190,49 @@ def run_sandbox(command, cwd=None, env=None,
             data, if not, it will return None for that. If stdout=None, the
             data will be discarded -- it will NOT inherit the parent process's
             stdout, unlike with subprocess.Popen(). Set 'stdout=sys.stdout' if
-            you want that.
+            you want that. If a function is passed, it is called with each
+            chunk of output as it is produced, and the function will return
+            None for that stream. See sandboxlib/output.py for details.
       - stderr: same as stdout
+      - timeout: the number of seconds the command may run for. If it is
+            still running after that, it is killed with SIGKILL, along with
+            every process it started that is still in its process group (or,
+            in backends that use a PID namespace, in the sandbox). The output
+            read up to then is returned. Defaults to None, meaning no limit.
+      - cpu_time_limit: the number of seconds of CPU time that each process
+            in the sandbox may use, rounded up to a whole number of seconds.
+            This is enforced by the kernel using RLIMIT_CPU (see
+            setrlimit(2)). Defaults to None, meaning no limit.
+      - action_cache: a sandboxlib.actioncache.ActionCache. If given, and the
+            same command has already been run with the same configuration
+            and the same contents of 'filesystem_root', its recorded result
+            is returned and its changes to 'filesystem_root' are applied,
+            without running it again. Otherwise the result is recorded.
+            Defaults to None. This isn't supported by run_sandbox_async().
+      - trace: how to find out which files the command read and wrote,
+            either sandboxlib.trace.METADATA, which is cheap but can't see
+            reads, or sandboxlib.trace.FANOTIFY, which needs root. See
+            sandboxlib/trace.py for details. Defaults to None, meaning no
+            tracing.
+      - resources: a dict of cgroup v2 limits, such as {'memory.max':
+            1024 * 1024 * 1024, 'pids.max': 1000}. If given, the command is
+            run in a new cgroup with those limits, and its resource usage is
+            recorded. See sandboxlib/cgroup.py for the supported limits.
+            Defaults to None, meaning no cgroup is created.
+      - scheduling: a dict giving the CPUs and NUMA memory nodes that the
+            command should use, its nice value and its I/O scheduling class
+            and priority, such as {'cpus': [0, 1], 'nice': 10, 'io_class':
+            'idle'}. See sandboxlib/scheduling.py for details, and for
+            split_cpus(), which shares the CPUs out between sandboxes.
+            Defaults to None, meaning the command inherits these from the
+            calling process.
 
     Returns:
-      a tuple of (exit code, stdout output, stderr output).
+      a SandboxResult, which is a tuple of (exit code, stdout output, stderr
+      output) that also records how long each phase of running the sandbox
+      took, the resource usage of the command, whether it was killed for
+      exceeding 'timeout' or 'cpu_time_limit', the files it accessed, and the
+      resources its cgroup used.
 
     '''
     raise NotImplementedError()
@@ -124,6 +250,22 @@ def run_sandbox_with_redirection(command, **sandbox_config):
     raise NotImplementedError()
 
 
+def run_sandbox_async(command, stdout=CAPTURE, stderr=CAPTURE,
+                      **sandbox_config):
+    '''Run 'command' in a sandboxed environment, from an asyncio event loop.
+
+    This is a coroutine function, which needs Python 3.5 or later. The
+    parameters and the result are the same as for run_sandbox().
+
+    The command is run in a new process group. If the coroutine is cancelled,
+    the whole process group is killed with SIGKILL before the CancelledError
+    is propagated. The same happens if the 'timeout' expires, but the
+    coroutine then returns a SandboxResult as run_sandbox() does.
+
+    '''
+    raise NotImplementedError()
+
+
 def get_executor(name):
     '''Return the execution module with the given name.
 
@@ -170,7 +312,13 @@ def executor_for_platform():
                 "value %s." % backend_name)
 
     if backend is None and platform.uname()[0] == 'Linux':
-        log.info("Linux detected, looking for 'linux-user-chroot'.")
+        log.info("Linux detected, checking if namespaces are available.")
+        if sandboxlib.linux_namespaces.namespaces_available():
+            log.info("Choosing 'linux_namespaces' module.")
+            backend = sandboxlib.linux_namespaces
+
+    if backend is None and platform.uname()[0] == 'Linux':
+        log.info("Looking for 'linux-user-chroot'.")
         try:
             program = sandboxlib.linux_user_chroot.linux_user_chroot_program()
             log.info("Found %s, choosing 'linux_user_chroot' module.", program)
@@ -225,59 +373,51 @@ def argv_to_string(argv):
     return ' '.join(map(pipes.quote, argv))
 
 
-def _run_command(argv, stdout, stderr, cwd=None, env=None):
-    '''Wrapper around subprocess.Popen() with common settings.
-
-    This function blocks until the subprocess has terminated.
+def _run_command(argv, stdout, stderr, cwd=None, env=None, timeout=None):
+    '''Run a subprocess with common settings, and wait for it to finish.
 
     Unlike the subprocess.Popen() function, if stdout or stderr are None then
-    output is discarded.
+    output is discarded, and file descriptors of the calling process are not
+    shared with the subprocess.
 
     It then returns a tuple of (exit code, stdout output, stderr output).
-    If stdout was not equal to subprocess.PIPE, stdout will be None. Same for
-    stderr.
+    If stdout was not equal to CAPTURE, stdout will be None. Same for stderr.
 
-    '''
-    if stdout is None or stderr is None:
-        dev_null = open(os.devnull, 'w')
-        stdout = stdout or dev_null
-        stderr = stderr or dev_null
-    else:
-        dev_null = None
+    If 'timeout' is given, the subprocess runs in a new process group, which
+    is killed if it is still running after that many seconds.
 
+    '''
     log = logging.getLogger('sandboxlib')
     log.debug('Running: %s', argv_to_string(argv))
 
-    try:
-        process = subprocess.Popen(
-            argv,
-            # The default is to share file descriptors from the parent process
-            # to the subprocess, which is rarely good for sandboxing.
-            close_fds=True,
-            cwd=cwd,
-            env=env,
-            stdout=stdout,
-            stderr=stderr,
-        )
-
-        # The 'out' variable will be None unless subprocess.PIPE was passed as
-        # 'stdout' to subprocess.Popen(). Same for 'err' and 'stderr'. If
-        # subprocess.PIPE wasn't passed for either it'd be safe to use .wait()
-        # instead of .communicate(), but if they were then we must use
-        # .communicate() to avoid blocking the subprocess if one of the pipes
-        # becomes full. It's safe to use .communicate() in all cases.
-
-        out, err = process.communicate()
-    finally:
-        if dev_null is not None:
-            dev_null.close()
-
-    return process.returncode, out, err
+    process = sandboxlib.spawn.spawn(argv, stdout, stderr, cwd=cwd, env=env,
+                                     new_process_group=timeout is not None)
+    result = process.communicate(timeout=timeout)
+    if process.timed_out:
+        log.warning('Killed %s after %s seconds.', argv_to_string(argv),
+                    timeout)
+    return result
 
 
 # Executors
 import sandboxlib.chroot
+import sandboxlib.linux_namespaces
 import sandboxlib.linux_user_chroot
 
+import sandboxlib.actioncache
+import sandboxlib.cgroup
+import sandboxlib.cleanup
+import sandboxlib.digest
+import sandboxlib.libc
 import sandboxlib.load
+import sandboxlib.overlay
+import sandboxlib.output
+import sandboxlib.scheduling
+import sandboxlib.spawn
+import sandboxlib.trace
 import sandboxlib.utils
+
+if sys.version_info >= (3, 5):
+    import sandboxlib.aio
+    import sandboxlib.forkserver
+    import sandboxlib.pool
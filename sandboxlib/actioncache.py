@@ -0,0 +1,547 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Cache the results of sandboxed commands.
+
+A build runs the same commands in the same sandboxes over and over again.
+If a command is deterministic, running it again with the same inputs gives
+the same result, so the result can be recorded the first time and reused
+after that.
+
+An ActionCache identifies each run of a command (an 'action') by a digest of
+the command, its working directory and environment, the backend and sandbox
+configuration, and the contents of 'filesystem_root'. The first time an
+action is run, its exit code and output are recorded, along with the changes
+it made to the writable parts of 'filesystem_root'. The next time, the
+changes are applied to 'filesystem_root' and the recorded result is returned
+without running the command at all.
+
+Pass an ActionCache as the 'action_cache' parameter of a backend's
+run_sandbox() function to use it. Only use it for commands whose result
+depends on nothing but these inputs. In particular:
+
+  - the contents of the sources of 'bind' mounts are not part of the digest,
+    only their paths, so they should be content-addressed (such as the
+    entries of a sandboxlib.load.appc.ImageStore) or not change
+  - changes written through 'bind' mounts are not recorded
+  - if 'env' is None, the environment of the calling process is part of the
+    digest, as that is what the command sees
+  - the owner, group and modification time of the files that the command
+    creates are restored along with their contents, but only the 'root'
+    user can give files a different owner, so for other users the files
+    belong to them
+
+A command that is run while an identical one is in progress, in the same or
+another process, waits for it to finish and then uses its result. The cache
+is kept on disk, and can be shared by several processes and users.
+
+'''
+
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import sandboxlib
+
+
+# Increase this when the way that actions are digested or recorded changes.
+_CACHE_VERSION = 3
+
+_FILE = 'file'
+_DIRECTORY = 'directory'
+_SYMLINK = 'symlink'
+_DELETED = 'deleted'
+
+
+def default_action_cache_path():
+    '''Return the default location for an ActionCache.
+
+    This is $SANDBOXLIB_ACTION_CACHE if set, otherwise a 'sandboxlib/actions'
+    directory inside $XDG_CACHE_HOME (usually ~/.cache/).
+
+    '''
+    if 'SANDBOXLIB_ACTION_CACHE' in os.environ:
+        return os.environ['SANDBOXLIB_ACTION_CACHE']
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'sandboxlib', 'actions')
+
+
+def _write_to(stream, data):
+    if hasattr(stream, 'flush'):
+        stream.flush()
+    fd = stream if isinstance(stream, int) else stream.fileno()
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class _Recorder(object):
+    # Consumer that keeps a copy of the output of a command, as well as
+    # passing it on to where the caller asked for it to go.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def __call__(self, data):
+        self.chunks.append(data)
+        if callable(self.stream):
+            self.stream(data)
+        elif self.stream is not None and data:
+            _write_to(self.stream, data)
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+def _deliver(stream, data):
+    # Sends recorded output where the caller asked for it to go, returning
+    # the value that run_sandbox() would have returned for that stream.
+    if stream == sandboxlib.CAPTURE:
+        return data
+    if data is None or stream is None:
+        return None
+    if callable(stream):
+        if data:
+            stream(data)
+        stream(b'')
+    elif data:
+        _write_to(stream, data)
+    return None
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        sandboxlib.cleanup.remove_tree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _set_owner(path, change):
+    # Only root can give a file away, and a file already belongs to the
+    # user who created it.
+    if os.geteuid() == 0:
+        os.lchown(path, change['uid'], change['gid'])
+
+
+def _set_symlink_mtime(path, mtime):
+    try:
+        os.utime(path, (mtime, mtime), follow_symlinks=False)
+    except (TypeError, NotImplementedError):
+        # Python 2 can't set the times of a symlink itself.
+        pass
+
+
+class ActionCache(object):
+    '''Persistent cache of the results of sandboxed commands.
+
+    If 'max_size' is given, the least recently used entries are deleted
+    when the total size of the recorded results exceeds 'max_size' bytes.
+
+    Only runs that exit with code 0 are recorded, unless 'cache_failures' is
+    True. Runs that are killed for exceeding a 'timeout' or
+    'cpu_time_limit' are never recorded.
+
+    '''
+
+    def __init__(self, path=None, max_size=None, cache_failures=False):
+        self.path = path or default_action_cache_path()
+        self.max_size = max_size
+        self.cache_failures = cache_failures
+
+        self._actions_dir = os.path.join(self.path, 'actions')
+        self._tmp_dir = os.path.join(self.path, 'tmp')
+        self._trash_dir = os.path.join(self.path, 'trash')
+
+        for directory in [self._actions_dir, self._tmp_dir, self._trash_dir]:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another process may have created it at the same time.
+                    if not os.path.isdir(directory):
+                        raise
+
+        sandboxlib.cleanup.purge_trash(self._trash_dir)
+
+        # Most of the files in 'filesystem_root' are usually the same as last
+        # time, so they don't need to be read again.
+        self._stat_cache = sandboxlib.digest.StatCache(
+            os.path.join(self.path, 'stat-cache'))
+
+    def action_digest(self, command, cwd=None, env=None, filesystem_root='/',
+                      filesystem_writable_paths='all', mounts='undefined',
+                      extra_mounts=None, network='undefined', backend=None,
+                      filesystem_generation=None):
+        '''Return the digest that identifies running 'command' in a sandbox.
+
+        The 'backend' is the name of the backend module that runs the
+        command, as each backend sets up the sandbox differently. The other
+        parameters are the same as for run_sandbox(). Every file in
+        'filesystem_root' is read, apart from those hidden by
+        'extra_mounts', so the 'filesystem_generation' parameter of the
+        linux_user_chroot backend is ignored.
+
+        '''
+        if type(command) == str:
+            command = [command]
+        if env is None:
+            env = dict(os.environ)
+
+        extra_mounts = sandboxlib.validate_extra_mounts(extra_mounts)
+        excluded = sandboxlib.trace.excluded_paths(extra_mounts)
+
+        if sandboxlib.overlay.is_overlay(filesystem_root):
+            assert filesystem_root.changes is None, \
+                "The action cache can't record changes kept by an Overlay."
+            roots = filesystem_root.lower
+        else:
+            assert os.path.realpath(filesystem_root) != '/', \
+                "The action cache needs a 'filesystem_root' other than '/'."
+            roots = [filesystem_root]
+
+        action = collections.OrderedDict([
+            ('version', _CACHE_VERSION),
+            ('backend', backend),
+            ('command', command),
+            ('cwd', cwd),
+            ('env', sorted(env.items())),
+            ('filesystem_writable_paths', filesystem_writable_paths),
+            ('mounts', mounts),
+            ('extra_mounts', extra_mounts),
+            ('network', network),
+            ('filesystem_root', [
+                sandboxlib.digest.tree_digest(
+                    root, stat_cache=self._stat_cache,
+                    excluded=excluded).digest
+                for root in roots]),
+        ])
+        self._stat_cache.save()
+
+        return hashlib.sha256(
+            json.dumps(action).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, digest):
+        return os.path.join(self._actions_dir, digest)
+
+    def _entry_lock_path(self, digest):
+        return os.path.join(self._actions_dir, digest + '.lock')
+
+    def _changes(self, root, before, after):
+        # Returns a list of changes, in the order they should be applied, or
+        # None if something was created that we can't record.
+        deleted = set(path for path in before if path not in after)
+        changes = []
+        for path in sorted(deleted, reverse=True):
+            # Everything inside a deleted directory goes along with it.
+            if os.path.dirname(path) not in deleted:
+                changes.append({'type': _DELETED, 'path': path})
+
+        for path in sorted(after):
+            st_mode = after[path][0]
+            old = before.get(path)
+            if old == after[path]:
+                continue
+            if stat.S_ISDIR(st_mode):
+                if old is not None and old[0] == st_mode:
+                    # Only the modification time changed.
+                    continue
+                change = {'type': _DIRECTORY, 'mode': stat.S_IMODE(st_mode)}
+            elif stat.S_ISREG(st_mode):
+                change = {'type': _FILE, 'mode': stat.S_IMODE(st_mode)}
+            elif stat.S_ISLNK(st_mode):
+                change = {'type': _SYMLINK,
+                          'target': os.readlink(os.path.join(root, path))}
+            else:
+                return None
+            st = os.lstat(os.path.join(root, path))
+            change.update(path=path, uid=st.st_uid, gid=st.st_gid,
+                          mtime=st.st_mtime)
+            changes.append(change)
+        return changes
+
+    def _record(self, digest, root, changes, exit, out, err):
+        tempdir = tempfile.mkdtemp(dir=self._tmp_dir)
+        try:
+            size = 0
+            os.mkdir(os.path.join(tempdir, 'files'))
+            for i, change in enumerate(changes):
+                if change['type'] == _FILE:
+                    change['blob'] = str(i)
+                    blob_path = os.path.join(tempdir, 'files', str(i))
+                    shutil.copyfile(os.path.join(root, change['path']),
+                                    blob_path)
+                    size += os.path.getsize(blob_path)
+
+            for name, data in [('stdout', out), ('stderr', err)]:
+                if data is not None:
+                    with open(os.path.join(tempdir, name), 'wb') as f:
+                        f.write(data)
+                    size += len(data)
+
+            with open(os.path.join(tempdir, 'result.json'), 'w') as f:
+                json.dump({'exit': exit, 'changes': changes, 'size': size,
+                           'stdout': out is not None,
+                           'stderr': err is not None}, f)
+
+            os.rename(tempdir, self._entry_path(digest))
+        except:
+            sandboxlib.cleanup.remove_tree(tempdir, trash_dir=self._trash_dir)
+            raise
+
+    def _apply_changes(self, entry_path, root, changes):
+        directories = []
+        symlinks = []
+        for change in changes:
+            path = os.path.join(root, change['path']) if change['path'] \
+                else root
+            kind = change['type']
+
+            if kind == _DELETED:
+                _remove(path)
+            elif kind == _DIRECTORY:
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.unlink(path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                _set_owner(path, change)
+                directories.append((path, change))
+            elif kind == _FILE:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    _remove(path)
+                # Files are replaced atomically, in case something has them
+                # open.
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+                os.close(fd)
+                try:
+                    shutil.copyfile(
+                        os.path.join(entry_path, 'files', change['blob']),
+                        tmp_path)
+                    _set_owner(tmp_path, change)
+                    os.chmod(tmp_path, change['mode'])
+                    os.utime(tmp_path, (change['mtime'], change['mtime']))
+                    os.rename(tmp_path, path)
+                except:
+                    os.unlink(tmp_path)
+                    raise
+            elif kind == _SYMLINK:
+                _remove(path)
+                os.symlink(change['target'], path)
+                _set_owner(path, change)
+                symlinks.append((path, change))
+
+        # The modification times of symlinks and directories are set once
+        # their contents are in place. Permissions are set last, in case
+        # some directories are read-only.
+        for path, change in symlinks:
+            _set_symlink_mtime(path, change['mtime'])
+        for path, change in reversed(directories):
+            os.utime(path, (change['mtime'], change['mtime']))
+            os.chmod(path, change['mode'])
+
+    def _restore(self, digest, filesystem_root, stdout, stderr, timer):
+        entry_path = self._entry_path(digest)
+        with timer.phase('restore'):
+            # Mark the entry as recently used, for eviction.
+            os.utime(entry_path, None)
+
+            with open(os.path.join(entry_path, 'result.json'), 'r') as f:
+                result = json.load(f)
+
+            if result['changes']:
+                self._apply_changes(
+                    entry_path, filesystem_root, result['changes'])
+
+            output = {}
+            for name in ['stdout', 'stderr']:
+                output[name] = None
+                if result[name]:
+                    with open(os.path.join(entry_path, name), 'rb') as f:
+                        output[name] = f.read()
+
+            out = _deliver(stdout, output['stdout'])
+            if stderr == sandboxlib.STDOUT:
+                err = None
+            else:
+                err = _deliver(stderr, output['stderr'])
+
+        return sandboxlib.SandboxResult(
+            result['exit'], out, err, timings=timer.timings, cached=True)
+
+    def _run_and_record(self, digest, run_sandbox, command, stdout, stderr,
+                        sandbox_config, timer):
+        log = logging.getLogger('sandboxlib')
+
+        filesystem_root = sandbox_config.get('filesystem_root', '/')
+        excluded = sandboxlib.trace.excluded_paths(
+            sandbox_config.get('extra_mounts'))
+        output_paths = sandboxlib.trace.output_paths(
+            filesystem_root,
+            sandbox_config.get('filesystem_writable_paths', 'all'))
+
+        with timer.phase('snapshot'):
+            before = sandboxlib.trace.snapshot(
+                filesystem_root, output_paths, excluded)
+
+        # The output is recorded whatever the caller wants done with it.
+        recorders = {}
+        streams = {}
+        for name, stream in [('stdout', stdout), ('stderr', stderr)]:
+            if stream in [sandboxlib.CAPTURE, sandboxlib.STDOUT]:
+                streams[name] = stream
+            else:
+                streams[name] = recorders[name] = _Recorder(stream)
+
+        result = run_sandbox(command, stdout=streams['stdout'],
+                             stderr=streams['stderr'], **sandbox_config)
+        timer.timings.update(result.timings)
+
+        exit, out, err = result
+        recorded = {'stdout': out, 'stderr': err}
+        for name, recorder in recorders.items():
+            recorded[name] = recorder.getvalue()
+        if stderr == sandboxlib.STDOUT:
+            recorded['stderr'] = None
+
+        if result.timed_out is not None:
+            log.info("Not recording result of %s, which was killed.",
+                     sandboxlib.argv_to_string(command))
+        elif exit != 0 and not self.cache_failures:
+            log.debug("Not recording result of %s, which failed.",
+                      sandboxlib.argv_to_string(command))
+        else:
+            with timer.phase('record'):
+                after = sandboxlib.trace.snapshot(
+                    filesystem_root, output_paths, excluded)
+                changes = self._changes(filesystem_root, before, after)
+                if changes is None:
+                    log.info("Not recording result of %s, which created "
+                             "special files.",
+                             sandboxlib.argv_to_string(command))
+                else:
+                    self._record(digest, filesystem_root, changes, exit,
+                                 recorded['stdout'], recorded['stderr'])
+
+        return sandboxlib.SandboxResult(
+            exit, out, err, timings=timer.timings, rusage=result.rusage,
+            timed_out=result.timed_out, file_accesses=result.file_accesses,
+            cgroup_usage=result.cgroup_usage)
+
+    def run(self, run_sandbox, command, stdout=sandboxlib.CAPTURE,
+            stderr=sandboxlib.CAPTURE, timeout=None, cpu_time_limit=None,
+            trace=None, resources=None, scheduling=None, backend=None,
+            **sandbox_config):
+        '''Run 'command' with 'run_sandbox', unless the result is cached.
+
+        The 'run_sandbox' parameter is the run_sandbox() function of a
+        backend, and the other parameters are passed to it. The 'timeout',
+        'cpu_time_limit', 'trace', 'resources' and 'scheduling' aren't part
+        of the action digest. The 'backend' is, as for action_digest(), the
+        name of the backend module. It defaults to the module that
+        'run_sandbox' is defined in.
+
+        Returns a SandboxResult. If it was taken from the cache, its
+        'cached' attribute is True, it has no 'rusage', 'file_accesses' or
+        'cgroup_usage', and the output is passed to any consumer functions
+        or files in one go.
+
+        '''
+        if type(command) == str:
+            command = [command]
+
+        timer = sandboxlib.utils.PhaseTimer()
+        with timer.phase('digest'):
+            if backend is None:
+                backend = getattr(run_sandbox, '__module__', None)
+            digest = self.action_digest(command, backend=backend,
+                                        **sandbox_config)
+
+        entry_path = self._entry_path(digest)
+        lock_path = self._entry_lock_path(digest)
+
+        while True:
+            with sandboxlib.utils.lock_file(lock_path, shared=True):
+                if os.path.isdir(entry_path):
+                    return self._restore(
+                        digest, sandbox_config.get('filesystem_root', '/'),
+                        stdout, stderr, timer)
+
+            # Holding the lock while the command runs means that an identical
+            # run that starts in the meantime waits for our result.
+            with sandboxlib.utils.lock_file(lock_path):
+                if not os.path.isdir(entry_path):
+                    result = self._run_and_record(
+                        digest, run_sandbox, command, stdout, stderr,
+                        dict(sandbox_config, timeout=timeout,
+                             cpu_time_limit=cpu_time_limit, trace=trace,
+                             resources=resources, scheduling=scheduling),
+                        timer)
+                    break
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+        return result
+
+    def entries(self):
+        '''Return a list of (digest, size, last used time) for each entry.'''
+        result = []
+        for name in os.listdir(self._actions_dir):
+            entry_path = self._entry_path(name)
+            if not os.path.isdir(entry_path):
+                continue
+            try:
+                with open(os.path.join(entry_path, 'result.json'), 'r') as f:
+                    size = json.load(f)['size']
+                last_used = os.stat(entry_path).st_mtime
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            result.append((name, size, last_used))
+        return result
+
+    def evict(self, max_size):
+        '''Delete least recently used entries until the cache fits 'max_size'.
+
+        Entries which are being read by any process are skipped.
+
+        '''
+        log = logging.getLogger('sandboxlib')
+
+        with sandboxlib.utils.lock_file(os.path.join(self.path, 'lock')):
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total_size = sum(size for digest, size, last_used in entries)
+
+            for digest, size, last_used in entries:
+                if total_size <= max_size:
+                    break
+
+                lock = sandboxlib.utils.lock_file(
+                    self._entry_lock_path(digest), blocking=False)
+                with lock as locked:
+                    if not locked:
+                        continue
+
+                    log.debug("Evicting %s from action cache %s", digest,
+                              self.path)
+                    sandboxlib.cleanup.remove_tree(
+                        self._entry_path(digest), trash_dir=self._trash_dir)
+                    total_size -= size
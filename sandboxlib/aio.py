@@ -0,0 +1,213 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Run sandboxes from an 'asyncio' event loop.
+
+This module needs Python 3.5 or later. It isn't imported on older versions.
+
+The backends start their subprocesses with sandboxlib.spawn.spawn(), rather
+than asyncio.create_subprocess_exec(), so that sandbox setup errors are
+reported properly (see sandboxlib/spawn.py). The output of the subprocess is
+read when the event loop's add_reader() method says that it is ready. Where
+the kernel supports it, the exit of the subprocess is detected by watching a
+pidfd in the same way. Otherwise it is polled for, which avoids needing a
+thread or a SIGCHLD handler.
+
+Each subprocess is started in a new process group. If the coroutine is
+cancelled, the whole process group is killed and the subprocess is reaped
+before the CancelledError is propagated. The same is done when a 'timeout'
+expires, without raising an exception.
+
+'''
+
+
+import asyncio
+import errno
+import inspect
+import os
+
+import sandboxlib
+
+
+# Bounds of the interval between checks for exit, when we can't use a pidfd.
+_POLL_INTERVAL_MIN = 0.001
+_POLL_INTERVAL_MAX = 0.1
+
+
+async def _readable(loop, fd):
+    ready = loop.create_future()
+
+    def set_ready():
+        if not ready.done():
+            ready.set_result(None)
+
+    loop.add_reader(fd, set_ready)
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+
+
+async def _read_output(fd, consumer):
+    # Pass everything written to the pipe 'fd' to 'consumer', then close it.
+    # The consumer may return an awaitable, which is awaited before reading
+    # any more.
+    loop = asyncio.get_event_loop()
+    try:
+        os.set_blocking(fd, False)
+        while True:
+            try:
+                data = os.read(fd, 32768)
+            except BlockingIOError:
+                await _readable(loop, fd)
+                continue
+
+            result = consumer(data)
+            if inspect.isawaitable(result):
+                await result
+            if not data:
+                break
+    finally:
+        os.close(fd)
+
+
+def _open_pidfd(pid):
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError as e:
+        if e.errno in [errno.ENOSYS, errno.EPERM, errno.EINVAL]:
+            return None
+        raise
+
+
+async def wait(process):
+    '''Wait for a sandboxlib.spawn.Process to exit, and return its exit code.'''
+    loop = asyncio.get_event_loop()
+
+    pidfd = _open_pidfd(process.pid)
+    if pidfd is not None:
+        try:
+            exited = loop.create_future()
+
+            def set_exited():
+                if not exited.done():
+                    exited.set_result(None)
+
+            loop.add_reader(pidfd, set_exited)
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        return process.wait()
+
+    interval = _POLL_INTERVAL_MIN
+    while process.poll() is None:
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, _POLL_INTERVAL_MAX)
+    return process.returncode
+
+
+async def communicate(process, timeout=None):
+    '''Read all output, then wait for the subprocess to exit.
+
+    This is the asyncio equivalent of sandboxlib.spawn.Process.communicate(),
+    and returns the same tuple of (exit code, stdout output, stderr output).
+
+    Consumer functions are called in the same way as by communicate(). They
+    can also be coroutine functions, in which case no more output is read
+    until the coroutine has finished.
+
+    If the coroutine is cancelled, or fails, the subprocess (and its process
+    group, if it has one) is killed with SIGKILL and reaped. If it is still
+    running after 'timeout' seconds, it is killed in the same way, its
+    'timed_out' attribute is set, and the output read until then is returned.
+
+    '''
+    captured = {}
+    readers = []
+    for name in ['stdout', 'stderr']:
+        fd = getattr(process, name)
+        if fd is not None:
+            consumer = process.consumers.get(fd)
+            if consumer is None:
+                captured[name] = []
+                consumer = captured[name].append
+            readers.append(asyncio.ensure_future(_read_output(fd, consumer)))
+    process.stdout = process.stderr = None
+
+    async def finish():
+        for reader in readers:
+            await reader
+        return await wait(process)
+
+    try:
+        exit = await asyncio.wait_for(finish(), timeout)
+    except asyncio.TimeoutError:
+        # Cancelling the readers closes the pipes, in case something that
+        # escaped the process group is still holding them open.
+        process.timed_out = True
+        process.kill()
+        exit = process.wait()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+    except BaseException:
+        process.kill()
+        process.wait()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        raise
+
+    out = b''.join(captured['stdout']) if 'stdout' in captured else None
+    err = b''.join(captured['stderr']) if 'stderr' in captured else None
+    return exit, out, err
+
+
+async def run_sandbox(prepare_sandbox, command, stdout, stderr, timeout=None,
+                      cpu_time_limit=None, trace=None, resources=None,
+                      scheduling=None, **sandbox_config):
+    '''Run 'command' in a sandbox set up by a backend's prepare_sandbox().
+
+    This implements run_sandbox_async() for each of the backends, returning
+    a sandboxlib.SandboxResult.
+
+    '''
+    timer = sandboxlib.utils.PhaseTimer()
+    with sandboxlib.trace.tracing(trace, timer, **sandbox_config) as tracer, \
+            sandboxlib.cgroup.transient_cgroup(resources, timer) as cgroup:
+        context = prepare_sandbox(command, timer=timer, **sandbox_config)
+        with context as (argv, spawn_args):
+            spawn_args = sandboxlib.spawn.with_cpu_time_limit(
+                spawn_args, cpu_time_limit)
+            spawn_args = sandboxlib.scheduling.with_scheduling(
+                spawn_args, scheduling)
+            spawn_args = sandboxlib.cgroup.with_cgroup(spawn_args, cgroup)
+            with timer.phase('spawn'):
+                process = sandboxlib.spawn.spawn(
+                    argv, stdout, stderr, new_process_group=True,
+                    **spawn_args)
+            with timer.phase('run'):
+                exit, out, err = await communicate(process, timeout=timeout)
+        cgroup_usage = cgroup.usage() if cgroup else None
+    return sandboxlib.SandboxResult(
+        exit, out, err, timings=timer.timings, rusage=process.rusage,
+        timed_out=sandboxlib.spawn.timeout_reason(process, cpu_time_limit),
+        file_accesses=tracer.file_accesses if tracer else None,
+        cgroup_usage=cgroup_usage)
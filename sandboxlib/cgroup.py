@@ -0,0 +1,422 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Resource limits and accounting for sandboxes, using Linux cgroup v2.
+
+If the 'resources' parameter of run_sandbox() is given, the command is run
+in a new cgroup of its own, which is removed again when the command has
+finished. The 'resources' are a dict mapping the names of cgroup interface
+files to the values to write to them, for example:
+
+    {'memory.max': 512 * 1024 * 1024, 'pids.max': 100, 'cpu.max': '50000'}
+
+The supported files are listed in RESOURCES, and are described in the
+kernel's cgroup v2 documentation ('Documentation/admin-guide/cgroup-v2.rst').
+Each of them needs the controller it is named after to be available. The
+value for 'io.max' may be a list, with one entry for each device. Pass an
+empty dict to get the resource usage of the command without limiting it.
+
+The new cgroups are created inside $SANDBOXLIB_CGROUP if that is set, and in
+the cgroup of the calling process otherwise. The user must be able to create
+cgroups there, which usually means that the cgroup has been delegated to
+them (for example by systemd, with 'Delegate=yes'). A controller can only be
+enabled for the new cgroups if it is already enabled in the parent's
+'cgroup.subtree_control', or if the parent is the root of the hierarchy or
+has no processes of its own.
+
+'''
+
+
+import contextlib
+import errno
+import functools
+import itertools
+import os
+import signal
+import threading
+import time
+import warnings
+
+import sandboxlib
+
+
+RESOURCES = ['memory.max', 'memory.high', 'cpu.max', 'cpu.weight',
+             'pids.max', 'io.max']
+
+_CGROUP_PREFIX = 'sandboxlib-'
+
+# How long to wait for the processes in a cgroup to exit after they have
+# been killed, before giving up on removing it.
+_REMOVE_TIMEOUT = 5
+
+_counter = itertools.count()
+_counter_lock = threading.Lock()
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _read_keyed(path):
+    # Reads a 'flat keyed' file such as cpu.stat, returning None if it
+    # doesn't exist.
+    try:
+        lines = _read(path).splitlines()
+    except (IOError, OSError):
+        return None
+    return dict((key, int(value)) for key, value in
+                (line.split() for line in lines if line.strip()))
+
+
+def controller_for(name):
+    '''Return the controller that the interface file 'name' belongs to.'''
+    return name.split('.', 1)[0]
+
+
+def cgroup2_mount_point():
+    '''Return where the cgroup v2 hierarchy is mounted, or None.'''
+    try:
+        with open('/proc/self/mountinfo', 'r') as f:
+            for line in f:
+                fields, _, filesystem = line.partition(' - ')
+                if filesystem.split(' ', 1)[0] == 'cgroup2':
+                    return fields.split(' ')[4]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def current_cgroup():
+    '''Return the cgroup v2 path of the calling process, or None.'''
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            for line in f:
+                hierarchy, _, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0':
+                    return path
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def default_cgroup_parent():
+    '''Return the directory in which to create the cgroups for sandboxes.
+
+    This is $SANDBOXLIB_CGROUP, which may be an absolute path or a path
+    relative to where the cgroup v2 hierarchy is mounted, if it is set, and
+    the cgroup of the calling process otherwise. None is returned if there
+    is no cgroup v2 hierarchy, or the calling process can't create cgroups
+    there.
+
+    '''
+    mount_point = cgroup2_mount_point()
+    if mount_point is None:
+        return None
+
+    cgroup = os.environ.get('SANDBOXLIB_CGROUP') or current_cgroup()
+    if cgroup is None:
+        return None
+    if cgroup != mount_point and \
+            not cgroup.startswith(mount_point.rstrip('/') + '/'):
+        cgroup = os.path.join(mount_point, cgroup.lstrip('/'))
+    cgroup = os.path.normpath(cgroup)
+
+    if os.path.isfile(os.path.join(cgroup, 'cgroup.procs')) and \
+            os.access(cgroup, os.W_OK):
+        return cgroup
+    return None
+
+
+def usable_controllers(parent):
+    '''Return the set of controllers that new cgroups in 'parent' can use.'''
+    try:
+        enabled = set(_read(
+            os.path.join(parent, 'cgroup.subtree_control')).split())
+        available = set(_read(
+            os.path.join(parent, 'cgroup.controllers')).split())
+        # Controllers can't be enabled for the children of a cgroup that
+        # has processes of its own, unless it is the root.
+        can_enable = os.access(
+            os.path.join(parent, 'cgroup.subtree_control'), os.W_OK) and (
+                os.path.realpath(parent) == os.path.realpath(
+                    cgroup2_mount_point() or '') or
+                not _read(os.path.join(parent, 'cgroup.procs')).strip())
+    except (IOError, OSError):
+        return set()
+    return enabled | available if can_enable else enabled
+
+
+def check_resources(resources):
+    '''Check that 'resources' only sets interface files in RESOURCES.'''
+    assert isinstance(resources, dict), \
+        "The 'resources' parameter must be a dict. Got %r" % (resources,)
+    for name in resources:
+        sandboxlib.utils.check_parameter('resources', name, RESOURCES)
+
+
+def degrade_resources(out_config, backend, warn=True):
+    '''Remove anything in out_config['resources'] that can't be applied.
+
+    This is used by the degrade_config_for_capabilities() function of the
+    backends. If no cgroup can be created at all, 'resources' is set to
+    None, so the command runs without a cgroup of its own.
+
+    '''
+    resources = out_config.get('resources')
+    if resources is None:
+        return
+
+    def degrade_and_warn(reason, name=None):
+        if warn:
+            if name is None:
+                setting = 'resources=%s' % (resources,)
+            else:
+                setting = 'resources[%r]=%s' % (name, resources[name])
+            warnings.warn('Unable to set %s in a %s sandbox, because %s' %
+                          (setting, backend, reason))
+
+    parent = default_cgroup_parent()
+    if parent is None:
+        degrade_and_warn("there is no cgroup v2 hierarchy that the calling "
+                         "process can create cgroups in")
+        out_config['resources'] = None
+        return
+
+    usable = usable_controllers(parent)
+    out_config['resources'] = dict(resources)
+    for name in resources:
+        controller = controller_for(name)
+        if name not in RESOURCES:
+            degrade_and_warn("it is not supported", name)
+        elif controller not in usable:
+            degrade_and_warn("the '%s' controller is not available in %s" %
+                             (controller, parent), name)
+        else:
+            continue
+        del out_config['resources'][name]
+
+
+class CgroupUsage(object):
+    '''The resources used by the processes in a sandbox's cgroup.
+
+    The attributes are:
+
+      - cpu_usage: the CPU time used, in seconds
+      - cpu_user, cpu_system: the CPU time used in user and kernel mode
+      - memory_peak: the most memory used at once, in bytes. This is None
+            unless the 'memory' controller was enabled, and the kernel is
+            Linux 5.19 or later.
+      - oom_events: how many times the 'memory.max' limit was hit and the
+            OOM killer was run, or None if the 'memory' controller wasn't
+            enabled
+      - oom_kills: how many processes the OOM killer killed, or None
+
+    '''
+
+    def __init__(self, cpu_usage=None, cpu_user=None, cpu_system=None,
+                 memory_peak=None, oom_events=None, oom_kills=None):
+        self.cpu_usage = cpu_usage
+        self.cpu_user = cpu_user
+        self.cpu_system = cpu_system
+        self.memory_peak = memory_peak
+        self.oom_events = oom_events
+        self.oom_kills = oom_kills
+
+    def __repr__(self):
+        return '<CgroupUsage cpu_usage=%s memory_peak=%s oom_kills=%s>' % (
+            self.cpu_usage, self.memory_peak, self.oom_kills)
+
+
+class TransientCgroup(object):
+    '''A new cgroup in 'parent', with the limits given by 'resources'.
+
+    The processes in it are killed and the cgroup is removed by destroy().
+
+    '''
+
+    def __init__(self, parent, resources):
+        check_resources(resources)
+
+        with _counter_lock:
+            number = next(_counter)
+        self.path = os.path.join(
+            parent, '%s%i-%i' % (_CGROUP_PREFIX, os.getpid(), number))
+        self.resources = resources
+
+        self._enable_controllers(
+            parent, set(controller_for(name) for name in resources))
+
+        try:
+            os.mkdir(self.path)
+        except OSError as e:
+            raise RuntimeError("Unable to create cgroup %s: %s" %
+                               (self.path, e))
+
+        try:
+            for name, value in sorted(resources.items()):
+                self._set(name, value)
+        except BaseException:
+            self.destroy()
+            raise
+
+    def __repr__(self):
+        return '<TransientCgroup %s>' % self.path
+
+    def _enable_controllers(self, parent, controllers):
+        subtree_control = os.path.join(parent, 'cgroup.subtree_control')
+        try:
+            enabled = set(_read(subtree_control).split())
+            for controller in sorted(controllers - enabled):
+                _write(subtree_control, '+%s' % controller)
+        except (IOError, OSError) as e:
+            raise RuntimeError(
+                "Unable to enable the cgroup controllers %s in %s: %s" %
+                (', '.join(sorted(controllers)), parent, e))
+
+    def _set(self, name, value):
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for value in values:
+            try:
+                _write(os.path.join(self.path, name), str(value))
+            except (IOError, OSError) as e:
+                raise RuntimeError("Unable to set %s=%s in cgroup %s: %s" %
+                                   (name, value, self.path, e))
+
+    def join(self):
+        '''Move the calling process into the cgroup.'''
+        _write(os.path.join(self.path, 'cgroup.procs'), '0')
+
+    def usage(self):
+        '''Return a CgroupUsage with the resources used so far.'''
+        usage = CgroupUsage()
+
+        cpu_stat = _read_keyed(os.path.join(self.path, 'cpu.stat'))
+        if cpu_stat is not None:
+            usage.cpu_usage = cpu_stat.get('usage_usec', 0) / 1000000.0
+            usage.cpu_user = cpu_stat.get('user_usec', 0) / 1000000.0
+            usage.cpu_system = cpu_stat.get('system_usec', 0) / 1000000.0
+
+        try:
+            usage.memory_peak = int(
+                _read(os.path.join(self.path, 'memory.peak')))
+        except (IOError, OSError, ValueError):
+            pass
+
+        memory_events = _read_keyed(
+            os.path.join(self.path, 'memory.events'))
+        if memory_events is not None:
+            usage.oom_events = memory_events.get('oom', 0)
+            usage.oom_kills = memory_events.get('oom_kill', 0)
+
+        return usage
+
+    def _kill_processes(self):
+        kill_path = os.path.join(self.path, 'cgroup.kill')
+        if os.path.exists(kill_path):
+            # Linux 5.14 and later can kill everything in one go.
+            _write(kill_path, '1')
+            return
+        for pid in _read(os.path.join(self.path, 'cgroup.procs')).split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def destroy(self):
+        '''Kill any processes left in the cgroup, and remove it.'''
+        if not os.path.isdir(self.path):
+            return
+        deadline = time.time() + _REMOVE_TIMEOUT
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as e:
+                if e.errno != errno.EBUSY or time.time() > deadline:
+                    warnings.warn("Unable to remove cgroup %s: %s" %
+                                  (self.path, e))
+                    return
+            try:
+                self._kill_processes()
+            except (IOError, OSError):
+                pass
+            time.sleep(0.01)
+
+
+def _join_cgroup(cgroup, child_setup):
+    # Joining the cgroup first means that everything the child does to set
+    # up the sandbox is counted too.
+    cgroup.join()
+    if child_setup is not None:
+        child_setup()
+
+
+def with_cgroup(spawn_args, cgroup):
+    '''Return a copy of 'spawn_args' that starts the child in 'cgroup'.
+
+    The child joins the cgroup before any 'child_setup' function in
+    'spawn_args' is called. If 'cgroup' is None, 'spawn_args' is returned
+    unchanged.
+
+    '''
+    if cgroup is None:
+        return spawn_args
+    spawn_args = dict(spawn_args)
+    spawn_args['child_setup'] = functools.partial(
+        _join_cgroup, cgroup, spawn_args.get('child_setup'))
+    return spawn_args
+
+
+@contextlib.contextmanager
+def transient_cgroup(resources, timer):
+    '''Context of a TransientCgroup with 'resources', or None if that is None.
+
+    The cgroup is created in the directory given by default_cgroup_parent().
+    RuntimeError is raised if there isn't one, or if a controller that
+    'resources' needs can't be enabled there.
+
+    '''
+    if resources is None:
+        yield None
+        return
+
+    check_resources(resources)
+    parent = default_cgroup_parent()
+    if parent is None:
+        raise RuntimeError(
+            "Unable to use 'resources': there is no cgroup v2 hierarchy "
+            "that the calling process can create cgroups in.")
+
+    missing = set(controller_for(name) for name in resources) - \
+        usable_controllers(parent)
+    if missing:
+        raise RuntimeError(
+            "Unable to use 'resources': the cgroup controllers %s are not "
+            "available in %s." % (', '.join(sorted(missing)), parent))
+
+    with timer.phase('cgroup'):
+        cgroup = TransientCgroup(parent, resources)
+    try:
+        yield cgroup
+    finally:
+        with timer.phase('cgroup'):
+            cgroup.destroy()
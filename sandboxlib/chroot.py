@@ -21,8 +21,9 @@ This backend should work on any POSIX-compliant operating system. It has been
 tested on Linux and Mac OS X. The calling process must be able to use the
 chroot() syscall, which is likely to require 'root' priviliges.
 
-If any 'extra_mounts' are specified, there must be a working 'mount' binary in
-the host system.
+On Linux, any 'extra_mounts' are mounted by calling the C library directly.
+On other operating systems, there must be a working 'mount' binary in the
+host system.
 
 The code would be simpler if we just used the 'chroot' program, but it's not
 always practical to do that. First, it may not be installed. Second, we can't
@@ -34,18 +35,22 @@ that the sandbox contains a shell and we do some hack like running
 
 
 import contextlib
-import multiprocessing
+import errno
+import functools
 import os
-import subprocess
+import sys
 import warnings
 
 import sandboxlib
+import sandboxlib.cgroup
+import sandboxlib.spawn
 
 
 CAPABILITIES = {
     'network': ['undefined'],
     'mounts': ['undefined'],
     'filesystem_writable_paths': ['all'],
+    'resources': sandboxlib.cgroup.RESOURCES,
 }
 
 
@@ -73,6 +78,8 @@ def degrade_config_for_capabilities(in_config, warn=True):
     if out_config.get('filesystem_writable_paths', 'all') != 'all':
         degrade_and_warn('filesystem_writable_paths', 'all')
 
+    sandboxlib.cgroup.degrade_resources(out_config, 'chroot', warn=warn)
+
     return out_config
 
 
@@ -96,11 +103,10 @@ def process_writable_paths(fs_root, writable_paths):
     assert writable_paths == 'all'
 
 
-def mount(source, path, mount_type, mount_options):
-    # We depend on the host system's 'mount' program here, which is a
-    # little sad. It's possible to call the libc's mount() function
-    # directly from Python using the 'ctypes' library, and perhaps we
-    # should do that instead.
+def mount_with_program(source, path, mount_type, mount_options):
+    # On systems other than Linux we depend on the host system's 'mount'
+    # program, because the signature of the mount() system call differs
+    # between operating systems.
     argv = [
         'mount', '-t', mount_type, '-o', mount_options, source, path]
     exit, out, err = sandboxlib._run_command(
@@ -112,7 +118,7 @@ def mount(source, path, mount_type, mount_options):
                 argv, err.decode('utf-8')))
 
 
-def unmount(path):
+def unmount_with_program(path):
     argv = ['umount', path]
     exit, out, err = sandboxlib._run_command(
         argv, stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE)
@@ -122,8 +128,72 @@ def unmount(path):
             argv, err.decode('utf-8')))
 
 
+def mount(source, path, mount_type, mount_options):
+    if not sys.platform.startswith('linux'):
+        return mount_with_program(source, path, mount_type, mount_options)
+
+    try:
+        flags, data = sandboxlib.libc.parse_mount_options(mount_options)
+    except ValueError as e:
+        raise RuntimeError("Unable to mount %s: %s" % (path, e))
+
+    if mount_type in ['', 'none']:
+        mount_type = None
+
+    # The kernel requires a source, even for filesystems that don't use it.
+    # This is what mount(8) passes in that case.
+    source = source or mount_type or 'none'
+
+    try:
+        sandboxlib.libc.mount(source, path, mount_type, flags, data)
+
+        # Most flags are ignored when creating a bind mount, so mount(8)
+        # applies them with a second call. We do the same.
+        bind_flags = sandboxlib.libc.MS_BIND | sandboxlib.libc.MS_REC
+        if flags & sandboxlib.libc.MS_BIND and flags & ~bind_flags:
+            sandboxlib.libc.mount(
+                None, path, None,
+                flags & ~sandboxlib.libc.MS_REC | sandboxlib.libc.MS_REMOUNT,
+                None)
+    except OSError as e:
+        raise RuntimeError(
+            "Unable to mount %s on %s (type %s, options '%s'): %s" % (
+                source, path, mount_type, mount_options, e))
+
+
+def unmount(path, lazy=False):
+    '''Unmount 'path', issuing a warning if that fails.
+
+    If 'lazy' is True, the mount is detached immediately and cleaned up by
+    the kernel once it is no longer in use (see MNT_DETACH in umount(2)).
+    Otherwise, if the mount is still in use a lazy unmount is done anyway,
+    with a warning.
+
+    '''
+    if not sys.platform.startswith('linux'):
+        return unmount_with_program(path)
+
+    flags = sandboxlib.libc.MNT_DETACH if lazy else 0
+    try:
+        sandboxlib.libc.umount2(path, flags)
+    except OSError as e:
+        if e.errno == errno.EBUSY and not lazy:
+            warnings.warn("Unable to unmount %s, as it is still in use. "
+                          "Detaching it instead." % path)
+            unmount(path, lazy=True)
+        else:
+            warnings.warn("Unable to unmount %s: %s" % (path, e))
+
+
 @contextlib.contextmanager
-def mount_all(rootfs_path, mount_info_list):
+def mount_all(rootfs_path, mount_info_list, lazy_unmount=False):
+    '''Mount everything in 'mount_info_list', and unmount it afterwards.
+
+    Mounts are unmounted in the reverse order to which they were mounted. If
+    'lazy_unmount' is True, they are detached rather than unmounted, which is
+    faster and doesn't fail if something is still using them.
+
+    '''
     mounted = []
 
     try:
@@ -141,86 +211,124 @@ def mount_all(rootfs_path, mount_info_list):
 
         yield
     finally:
-        for mountpoint in mounted:
-            unmount(mountpoint)
-
-
-def run_command_in_chroot(pipe, stdout, stderr, extra_mounts, chroot_path,
-                          command, cwd, env):
-    # This function should be run in a multiprocessing.Process() subprocess,
-    # because it calls os.chroot(). There's no 'unchroot()' function! After
-    # chrooting, it calls sandboxlib._run_command(), which uses the
-    # 'subprocess' module to exec 'command'. This means there are actually
-    # two subprocesses, which is not ideal, but it seems to be the simplest
-    # implementation.
+        for mountpoint in reversed(mounted):
+            unmount(mountpoint, lazy=lazy_unmount)
+
+
+@contextlib.contextmanager
+def mount_root(filesystem_root):
+    '''Yield the path of 'filesystem_root', mounting it if it's an Overlay.'''
+    if not sandboxlib.overlay.is_overlay(filesystem_root):
+        yield filesystem_root
+        return
+
+    path = sandboxlib.overlay.overlay_mount_point()
+    try:
+        mounted = sandboxlib.overlay.mount_overlay(filesystem_root, path)
+        try:
+            yield mounted[-1]
+        finally:
+            # Detaching the tmpfs that holds the changes, if there is one,
+            # frees them without having to delete each file.
+            for mount_point in reversed(mounted):
+                unmount(mount_point, lazy=True)
+    finally:
+        os.rmdir(path)
+
+
+@contextlib.contextmanager
+def mount_sandbox(filesystem_root, extra_mounts):
+    '''Mount the sandbox root and 'extra_mounts', yielding the root path.'''
+    with mount_root(filesystem_root) as root_path:
+        # The command has exited by the time the mounts are removed, so
+        # there's no need to wait for them to be unmounted.
+        with mount_all(root_path, extra_mounts, lazy_unmount=True):
+            yield root_path
+
+
+def enter_chroot(chroot_path, cwd):
+    # This function is run in the child process by sandboxlib.spawn.spawn(),
+    # after it has forked and before it executes the command. It calls
+    # os.chroot(), which we can't do in the calling process as there's no
+    # 'unchroot()' function!
     #
-    # An alternative approach would be to use the 'preexec_fn' feature of
-    # subprocess.Popen() to call os.chroot(rootfs_path) and os.chdir(cwd).
-    # The Python 3 '_posixsubprocess' module hints in several places that
-    # deadlocks can occur when using preexec_fn, and it is very difficult to
-    # propagate exceptions from that function, so it seems best to avoid it.
+    # We don't use the 'preexec_fn' feature of subprocess.Popen() for this.
+    # It is very difficult to propagate exceptions from that function, where
+    # sandboxlib.spawn sends them back to the parent over a pipe.
+
+    # You have most likely got to be the 'root' user in order for this to
+    # work.
 
     try:
-        # You have most likely got to be the 'root' user in order for this to
-        # work.
+        os.chroot(chroot_path)
+    except OSError as e:
+        raise RuntimeError("Unable to chroot: %s" % e)
+
+    # This is important in case 'cwd' is a relative path.
+    os.chdir('/')
 
+    if cwd is not None:
         try:
-            os.chroot(chroot_path)
+            os.chdir(cwd)
         except OSError as e:
-            raise RuntimeError("Unable to chroot: %s" % e)
-
-        # This is important in case 'cwd' is a relative path.
-        os.chdir('/')
-
-        if cwd is not None:
-            try:
-                os.chdir(cwd)
-            except OSError as e:
-                raise RuntimeError(
-                    "Unable to set current working directory: %s" % e)
-
-        exit, out, err = sandboxlib._run_command(
-            command, stdout, stderr, env=env)
-        pipe.send([exit, out, err])
-        result = 0
-    except Exception as e:
-        pipe.send(e)
-        result = 1
-    os._exit(result)
-
-
-def run_sandbox(command, cwd=None, env=None,
-                filesystem_root='/', filesystem_writable_paths='all',
-                mounts='undefined', extra_mounts=None,
-                network='undefined',
-                stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE):
+            raise RuntimeError(
+                "Unable to set current working directory: %s" % e)
+
+
+@contextlib.contextmanager
+def prepare_sandbox(command, cwd=None, env=None,
+                    filesystem_root='/', filesystem_writable_paths='all',
+                    mounts='undefined', extra_mounts=None,
+                    network='undefined', timer=None):
+    '''Set up a sandbox, yielding the arguments to start 'command' in it.
+
+    Yields a tuple of (argv, spawn_args), where 'spawn_args' is a dict of
+    keyword arguments for sandboxlib.spawn.spawn(). The sandbox is torn down
+    when the context exits. If 'timer' is given, it should be a
+    sandboxlib.utils.PhaseTimer, which records how long each step takes.
+
+    '''
+    timer = timer or sandboxlib.utils.PhaseTimer()
+
     if type(command) == str:
         command = [command]
 
-    extra_mounts = process_mount_config(mounts, extra_mounts)
+    with timer.phase('config'):
+        extra_mounts = process_mount_config(mounts, extra_mounts)
+
+        process_network_config(network)
+
+        process_writable_paths(filesystem_root, filesystem_writable_paths)
+
+    mount_context = mount_sandbox(filesystem_root, extra_mounts)
+    with timer.timed_context(mount_context, 'mounts', 'teardown') as root_path:
+        yield command, dict(
+            env=env,
+            child_setup=functools.partial(enter_chroot, root_path, cwd))
+
+
+class Sandbox(sandboxlib.spawn.Sandbox):
+    '''A 'chroot' sandbox that can run many commands.
+
+    The 'extra_mounts' are mounted once, when the sandbox is opened, and
+    unmounted when it is closed. Anything written to them by one command can
+    be seen by the commands that run after it.
+
+    '''
 
-    process_network_config(network)
+    prepare_sandbox = staticmethod(prepare_sandbox)
 
-    process_writable_paths(filesystem_root, filesystem_writable_paths)
 
-    pipe_parent, pipe_child = multiprocessing.Pipe()
+def run_sandbox(command, stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE,
+                **sandbox_config):
+    return sandboxlib.spawn.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
 
-    with mount_all(filesystem_root, extra_mounts):
-        process = multiprocessing.Process(
-            target=run_command_in_chroot,
-            args=(pipe_child, stdout, stderr, extra_mounts, filesystem_root,
-                  command, cwd, env))
-        process.start()
-        process.join()
 
-    if process.exitcode == 0:
-        exit, out, err = pipe_parent.recv()
-        return exit, out, err
-    else:
-        # Note that no effort is made to pass on the original traceback, which
-        # will be within the _run_command_in_chroot() function somewhere.
-        exception = pipe_parent.recv()
-        raise exception
+def run_sandbox_async(command, stdout=sandboxlib.CAPTURE,
+                      stderr=sandboxlib.CAPTURE, **sandbox_config):
+    return sandboxlib.aio.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
 
 
 def run_sandbox_with_redirection(command, **sandbox_config):
@@ -0,0 +1,291 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Delete directory trees in the background.
+
+Deleting a large tree means unlinking every file in it, which can take a
+long time. remove_tree() instead renames the tree into a 'trash' directory
+on the same filesystem, which is a single, atomic operation, and returns
+straight away. A background thread then deletes the contents of the trash,
+at idle I/O priority (see ioprio_set(2)) so that it doesn't slow down the
+sandboxes that are running.
+
+The process that puts an entry in a trash directory holds an flock(2) lock
+on it until the entry has been deleted. The lock goes away with the process,
+so any entry that can be locked is a leftover of a process that exited
+before its trash was deleted, and is deleted by the next process to use that
+trash directory. This holds across PID namespaces, and after process IDs
+are reused, as long as the processes share the filesystem.
+
+wait_for_cleanup() blocks until everything that the calling process has
+thrown away has been deleted. The background thread doesn't keep the
+process alive, so it is also called when the interpreter exits; a short-lived
+program should still call it before it exits, so that nothing is left behind
+if it leaves with os._exit() or is killed.
+
+'''
+
+
+import atexit
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+import sandboxlib
+from sandboxlib import libc
+
+
+TRASH_DIR_NAME = '.sandboxlib-trash'
+
+
+def default_trash_dir(path):
+    '''Return the trash directory to use for 'path'.
+
+    This is in the temporary directory if that is on the same filesystem as
+    'path', and next to 'path' otherwise, so that 'path' can be renamed into
+    it. Either place may be shared with other users, so the name includes
+    the user ID, and remove_tree() only uses the directory if it belongs to
+    the user and nobody else can get into it.
+
+    '''
+    tmp_dir = tempfile.gettempdir()
+    parent = os.path.dirname(os.path.abspath(path))
+    name = '%s-%i' % (TRASH_DIR_NAME, os.geteuid())
+    if os.stat(tmp_dir).st_dev == os.stat(parent).st_dev:
+        return os.path.join(tmp_dir, name)
+    return os.path.join(parent, name)
+
+
+def _make_private_dir(path):
+    # Another user could have created 'path' first, or put a symlink there,
+    # so it is checked without following symlinks.
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or \
+            st.st_mode & 0o077:
+        raise RuntimeError(
+            "Refusing to use %s as a trash directory: it must be a directory "
+            "owned by user %i, which nobody else can access." %
+            (path, os.geteuid()))
+
+
+def _open_entry(path):
+    # The descriptor isn't inherited by commands that the process runs, so
+    # that they can't keep the entry locked after the process exits.
+    return os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+
+
+def _lock_new_entry(trash_dir):
+    # Another process may lock and delete the new entry before it is locked
+    # here, in which case it is gone once the lock is taken; try again.
+    while True:
+        path = tempfile.mkdtemp(prefix='%i-' % os.getpid(), dir=trash_dir)
+        try:
+            fd = _open_entry(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_nlink > 0:
+                return path, fd
+        except Exception:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def _delete(path):
+    # Like shutil.rmtree(), but copes with read-only directories, which the
+    # command in a sandbox may well have left behind.
+    def onerror(function, failed_path, exc_info):
+        error_number = getattr(exc_info[1], 'errno', None)
+        if error_number == errno.ENOENT:
+            return
+        if error_number in [errno.EACCES, errno.EPERM]:
+            try:
+                if function in [os.rmdir, os.unlink]:
+                    os.chmod(os.path.dirname(failed_path), 0o700)
+                    function(failed_path)
+                else:
+                    os.chmod(failed_path, 0o700)
+                    _delete(failed_path)
+                return
+            except OSError:
+                pass
+        logging.getLogger('sandboxlib').warning(
+            "Unable to delete %s: %s", failed_path, exc_info[1])
+
+    shutil.rmtree(path, onerror=onerror)
+
+
+class _Reaper(object):
+    # The thread that deletes the trash of one process.
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.recovered = set()
+        self.thread = threading.Thread(
+            target=self._run, name='sandboxlib-reaper')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        # On Linux the I/O priority and the nice value can be set for a
+        # single thread, so that the rest of the process isn't affected.
+        try:
+            libc.ioprio_set(
+                libc.IOPRIO_WHO_PROCESS, 0, libc.IOPRIO_CLASS_IDLE)
+        except (AttributeError, OSError):
+            pass
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            path, fd = self.queue.get()
+            try:
+                _delete(path)
+            except Exception as e:
+                logging.getLogger('sandboxlib').warning(
+                    "Unable to delete %s: %s", path, e)
+            finally:
+                # The entry stays locked until it is gone, so that no other
+                # process tries to delete it at the same time.
+                os.close(fd)
+                self.queue.task_done()
+
+    def recover(self, trash_dir):
+        # Queue the leftovers of processes that exited before their trash was
+        # deleted: the entries that nobody holds a lock on. Entries of this
+        # process are locked through other descriptors, so they are skipped.
+        # This is done once per trash directory.
+        if trash_dir in self.recovered:
+            return
+        self.recovered.add(trash_dir)
+        for name in os.listdir(trash_dir):
+            path = os.path.join(trash_dir, name)
+            try:
+                fd = _open_entry(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN]:
+                    continue
+                raise
+            if os.fstat(fd).st_nlink == 0:
+                # Deleted by its owner since it was listed.
+                os.close(fd)
+                continue
+            self.queue.put((path, fd))
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def _get_reaper():
+    global _reaper
+    with _reaper_lock:
+        # A forked child doesn't have the parent's thread, so it needs its
+        # own.
+        if _reaper is None or _reaper.pid != os.getpid():
+            if _reaper is None:
+                atexit.register(wait_for_cleanup)
+            _reaper = _Reaper()
+        return _reaper
+
+
+def remove_tree(path, trash_dir=None):
+    '''Delete the directory tree (or file) 'path', in the background.
+
+    The tree is moved into 'trash_dir', which defaults to the one chosen by
+    default_trash_dir(), and is created if needed. It must be on the same
+    filesystem as 'path'. If the tree can't be moved there, it is deleted
+    before this function returns. RuntimeError is raised if the default
+    trash directory exists but isn't private to the user.
+
+    '''
+    if trash_dir is None:
+        trash_dir = default_trash_dir(path)
+        _make_private_dir(trash_dir)
+    elif not os.path.isdir(trash_dir):
+        try:
+            os.makedirs(trash_dir, 0o700)
+        except OSError:
+            # Another process may have created it at the same time.
+            if not os.path.isdir(trash_dir):
+                raise
+
+    target, fd = _lock_new_entry(trash_dir)
+    try:
+        os.rename(path, os.path.join(target, 'tree'))
+    except OSError as e:
+        os.rmdir(target)
+        os.close(fd)
+        if e.errno not in [errno.EXDEV, errno.EBUSY]:
+            raise
+        if os.path.isdir(path) and not os.path.islink(path):
+            _delete(path)
+        else:
+            os.unlink(path)
+        return
+
+    reaper = _get_reaper()
+    reaper.recover(trash_dir)
+    reaper.queue.put((target, fd))
+
+
+def purge_trash(trash_dir):
+    '''Delete the leftovers in 'trash_dir' of processes that have exited.
+
+    These are the entries that no process holds a lock on. This happens anyway the first time remove_tree() uses 'trash_dir', but
+    it can be called to reclaim the space sooner. It doesn't wait for the
+    deletion to finish.
+
+    '''
+    if os.path.isdir(trash_dir) and os.listdir(trash_dir):
+        _get_reaper().recover(trash_dir)
+
+
+def wait_for_cleanup():
+    '''Wait until all the trees passed to remove_tree() have been deleted.'''
+    with _reaper_lock:
+        reaper = _reaper
+    if reaper is not None and reaper.pid == os.getpid():
+        reaper.queue.join()
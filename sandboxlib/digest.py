@@ -0,0 +1,344 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Digests of directory trees, such as the root of a sandbox.
+
+tree_digest() hashes a tree into a Merkle tree: the digest of a file is the
+SHA-256 of its contents, and the digest of a directory is the SHA-256 of the
+name, type, permissions and digest of each thing in it. The digest of every
+directory and file is kept, so parts of two trees can be compared without
+comparing everything else. Ownership and timestamps are left out, so copies
+of a tree have the same digest.
+
+Reading every file of a large tree takes a long time, so the contents of the
+files are hashed by a pool of threads, and a StatCache can be used to skip
+files that haven't changed since they were last hashed. A file is assumed to
+be unchanged if its device, inode number, size, modification time and change
+time are all the same as they were. The change time (ctime) is updated by
+the kernel whenever a file is written, and can't be set to an earlier value,
+so this is reliable unless the filesystem is changed behind the kernel's
+back.
+
+'''
+
+
+import binascii
+import hashlib
+import logging
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import sandboxlib
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Files changed less than this many seconds before they are hashed aren't
+# added to a StatCache, in case they change again within the resolution of
+# the filesystem's timestamps.
+_RACY_SECONDS = 2
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def relative_path(path):
+    '''Return 'path' relative to the root of a tree, with no leading '/'.
+
+    Paths in a sandbox configuration are relative to 'filesystem_root',
+    whether or not they start with '/'. The root itself is ''.
+
+    '''
+    path = os.path.normpath(path.lstrip('/') or '.')
+    return '' if path == '.' else path
+
+
+def _ns(st, name):
+    # Timestamps in nanoseconds. Python < 3.3 only has them as floats.
+    value = getattr(st, 'st_%s_ns' % name, None)
+    if value is None:
+        value = int(getattr(st, 'st_%s' % name) * 1000000000)
+    return value
+
+
+def default_threads():
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = 4
+    return max(2, min(cpus, 16))
+
+
+def file_digest(path):
+    '''Return the SHA-256 of the contents of 'path', as a hex string.'''
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StatCache(object):
+    '''Remembers the digests of files, keyed by their stat() results.
+
+    If 'path' is given, the cache is loaded from that file if it exists, and
+    save() appends the digests found since it was loaded or last saved.
+    Several processes can share the same file. Otherwise the cache is kept
+    in memory only.
+
+    Only the 'max_entries' most recently added entries are loaded. The file
+    is rewritten without the others when it is loaded, if they make up more
+    than half of it.
+
+    '''
+
+    # Device, inode, size, mtime and ctime (in nanoseconds) and the digest.
+    _RECORD = struct.Struct('=QQQqq32s')
+
+    def __init__(self, path=None, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self._digests = {}
+        self._new = []
+        self._lock = threading.Lock()
+
+        if path is not None:
+            self._load()
+
+    @staticmethod
+    def key(st):
+        '''Return the key for a file with the os.stat_result 'st'.'''
+        return (st.st_dev, st.st_ino, st.st_size, _ns(st, 'mtime'),
+                _ns(st, 'ctime'))
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+
+        size = self._RECORD.size
+        n_records = len(data) // size
+        # A partial record at the end is ignored.
+        for i in range(max(0, n_records - self.max_entries), n_records):
+            record = self._RECORD.unpack_from(data, i * size)
+            self._digests[record[:5]] = record[5]
+
+        if n_records > 1000 and n_records > 2 * len(self._digests):
+            self._compact()
+
+    def _compact(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for key, digest in self._digests.items():
+                    f.write(self._RECORD.pack(*(key + (digest,))))
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, st):
+        '''Return the digest of the file with stat() result 'st', or None.'''
+        digest = self._digests.get(self.key(st))
+        if digest is None:
+            return None
+        return binascii.hexlify(digest).decode('ascii')
+
+    def set(self, st, digest):
+        '''Record that the file with stat() result 'st' has 'digest'.'''
+        key = self.key(st)
+        raw_digest = binascii.unhexlify(digest)
+        with self._lock:
+            if self._digests.get(key) != raw_digest:
+                self._digests[key] = raw_digest
+                self._new.append(key)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def save(self):
+        '''Append the digests added since the cache was last saved.'''
+        with self._lock:
+            new, self._new = self._new, []
+        if self.path is None or not new:
+            return
+
+        data = b''.join(self._RECORD.pack(*(key + (self._digests[key],)))
+                        for key in new)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            # A single write to a file opened with O_APPEND can't be
+            # interleaved with a write from another process.
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+
+class TreeDigest(object):
+    '''The digests of a directory tree, and of everything inside it.
+
+    The 'digest' attribute is the digest of the whole tree. The 'digests'
+    attribute maps the path of each file and directory, relative to the
+    root of the tree, to its digest. The root is ''.
+
+    '''
+
+    def __init__(self, digests):
+        self.digests = digests
+
+    def __repr__(self):
+        return '<TreeDigest %s>' % self.digest
+
+    def __eq__(self, other):
+        return isinstance(other, TreeDigest) and self.digest == other.digest
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    @property
+    def digest(self):
+        return self.digests['']
+
+    def subtree_digest(self, path):
+        '''Return the digest of 'path', or None if it isn't in the tree.
+
+        The 'path' is relative to the root of the tree. It may be a file or
+        a directory.
+
+        '''
+        return self.digests.get(relative_path(path))
+
+    def changed_paths(self, other, paths):
+        '''Return those of 'paths' that differ between this tree and 'other'.
+
+        A path that is in only one of the trees counts as changed.
+
+        '''
+        return [path for path in paths
+                if self.subtree_digest(path) != other.subtree_digest(path)]
+
+
+def _hash_file(item):
+    # Runs in the thread pool.
+    relpath, path = item
+    return relpath, file_digest(path)
+
+
+def _directory_digest(entries):
+    hasher = hashlib.sha256()
+    for name, mode, digest in entries:
+        hasher.update(_encode(name) + b'\0')
+        hasher.update(('%o\0%s\0' % (mode, digest)).encode('ascii'))
+    return hasher.hexdigest()
+
+
+def tree_digest(path, stat_cache=None, threads=None, excluded=None):
+    '''Return a TreeDigest for the directory 'path'.
+
+    If 'stat_cache' is a StatCache, the digests of files that haven't
+    changed since they were added to it are taken from it, and the digests
+    of the other files are added. The caller should call its save() method
+    to store them. The files are read by 'threads' threads, which defaults
+    to the number of CPUs available, up to 16.
+
+    The paths in 'excluded', relative to 'path', are left out of the tree,
+    along with everything inside them. Symbolic links aren't followed.
+
+    '''
+    log = logging.getLogger('sandboxlib')
+    excluded = set(relative_path(p) for p in excluded or [])
+    threads = threads or default_threads()
+    racy_time = time.time() - _RACY_SECONDS
+
+    digests = {}
+    # Lists of (name, mode, relative path) for each directory, from the top
+    # down.
+    directories = []
+    to_hash = []
+    stats = {}
+
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        directory = os.path.join(path, relpath) if relpath else path
+        children = []
+        for entry in sandboxlib.utils.scan_directory(directory):
+            child = os.path.join(relpath, entry.name) if relpath \
+                else entry.name
+            if child in excluded:
+                continue
+            st = os.lstat(entry.path)
+            children.append((entry.name, st.st_mode, child))
+
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(child)
+            elif stat.S_ISREG(st.st_mode):
+                digest = stat_cache.get(st) if stat_cache else None
+                if digest is None:
+                    to_hash.append((child, entry.path))
+                    stats[child] = st
+                else:
+                    digests[child] = digest
+            elif stat.S_ISLNK(st.st_mode):
+                digests[child] = hashlib.sha256(
+                    b'symlink\0' + _encode(os.readlink(entry.path))
+                ).hexdigest()
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                digests[child] = hashlib.sha256(
+                    ('device\0%i' % st.st_rdev).encode('ascii')).hexdigest()
+            else:
+                # FIFOs and sockets have no contents.
+                digests[child] = hashlib.sha256(b'').hexdigest()
+        directories.append((relpath, children))
+
+    if to_hash:
+        log.debug("Hashing %i files in %s", len(to_hash), path)
+        pool = ThreadPool(min(threads, len(to_hash)))
+        try:
+            for relpath, digest in pool.imap_unordered(_hash_file, to_hash):
+                digests[relpath] = digest
+                st = stats[relpath]
+                if stat_cache is not None and \
+                        max(st.st_mtime, st.st_ctime) < racy_time:
+                    stat_cache.set(st, digest)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Every directory comes after its parent in 'directories', so going
+    # backwards means each directory's contents are done before it is.
+    for relpath, children in reversed(directories):
+        digests[relpath] = _directory_digest(
+            (name, mode, digests[child]) for name, mode, child in children)
+
+    return TreeDigest(digests)
@@ -0,0 +1,451 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Run many commands in the same sandbox, with less overhead per command.
+
+Setting up a sandbox has a fixed cost, which dominates the time taken to run
+short commands. A ForkServer sets the sandbox up once, in a long-lived
+helper process, and then starts each command from there. The helper process
+receives requests over a Unix socket, along with the file descriptors that
+the command should write its output to.
+
+How much of the setup is shared between commands depends on the backend:
+
+  - chroot: the 'extra_mounts' are mounted once, and the helper process
+        calls chroot() once.
+  - linux_namespaces: the namespaces and mounts are created once, in the
+        helper process. The helper process is 'init' for the PID namespace,
+        so all commands share one PID namespace.
+  - linux_user_chroot: the read-only paths and the temporary directories for
+        'extra_mounts' are worked out once, but each command still runs the
+        'linux-user-chroot' program.
+
+Since each command runs in the same sandbox, anything one command writes to
+the sandbox filesystem can be seen by the commands after it.
+
+This module needs Python 3.5 or later. It isn't imported on older versions.
+
+'''
+
+
+import array
+import errno
+import functools
+import os
+import pickle
+import select
+import signal
+import socket
+
+# os.wait4() needs this to create its result, and the helper process may not
+# be able to import it once it is inside the sandbox.
+import resource
+
+import sandboxlib
+
+
+# The largest request we expect, which is mostly the size of 'env'.
+_MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+def _send(connection, message, fds=None):
+    ancillary = []
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                      array.array('i', fds).tobytes())]
+    connection.sendmsg([pickle.dumps(message)], ancillary)
+
+
+def _receive(connection):
+    # Returns a tuple of (message, fds). The message is None if the other end
+    # of the connection has been closed.
+    fd_size = array.array('i').itemsize
+    data, ancillary, flags, address = connection.recvmsg(
+        _MAX_MESSAGE_SIZE, socket.CMSG_SPACE(3 * fd_size))
+
+    fds = array.array('i')
+    for level, kind, fd_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fd_size])
+    for fd in fds:
+        os.set_inheritable(fd, False)
+
+    if not data:
+        return None, list(fds)
+    return pickle.loads(data), list(fds)
+
+
+class ForkServerProcess(sandboxlib.spawn.Process):
+    '''A command that was started by a ForkServer.
+
+    This behaves like sandboxlib.spawn.Process, but the command is a child of
+    the helper process, so waiting for it and signalling it are done by
+    sending messages to the helper process.
+
+    '''
+
+    def __init__(self, connection, stdout=None, stderr=None, consumers=None):
+        super(ForkServerProcess, self).__init__(
+            None, stdout=stdout, stderr=stderr, consumers=consumers)
+        self.connection = connection
+
+    def _wait4(self, options):
+        if options & os.WNOHANG:
+            ready, _, _ = select.select([self.connection], [], [], 0)
+            if not ready:
+                return
+
+        message, fds = _receive(self.connection)
+        self.connection.close()
+        if message is None:
+            raise RuntimeError(
+                "The fork server exited before the command did.")
+        kind, self.returncode, self.rusage = message
+
+    def kill(self, signal_number=signal.SIGKILL):
+        if self.returncode is not None:
+            return
+        try:
+            _send(self.connection, ('kill', signal_number))
+        except (IOError, OSError) as e:
+            if e.errno not in [errno.EPIPE, errno.ECONNRESET]:
+                raise
+
+
+class ForkServer(object):
+    '''A helper process that runs commands in a sandbox that it has set up.
+
+    The 'executor' is a backend module, and 'sandbox_config' takes the same
+    parameters as its run_sandbox() function, apart from 'command', 'stdout'
+    and 'stderr'. The command, its environment and its output are given
+    separately to each call of run_sandbox().
+
+    The helper process is started when the ForkServer is used as a context
+    manager, or when start() is called, and stopped when the context exits
+    or close() is called. Commands that are still running when the helper
+    process stops are killed.
+
+    As with the 'child_setup' function of sandboxlib.spawn.spawn(), the
+    helper process is a forked copy of the calling process. It should be
+    started before the calling process starts any threads.
+
+    '''
+
+    def __init__(self, executor, **sandbox_config):
+        self.executor = executor
+        self.sandbox_config = sandbox_config
+
+        self._context = None
+        self._control = None
+        self._pid = None
+        self._argv_prefix = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        '''Set up the sandbox and start the helper process.'''
+        if self._control is not None:
+            return
+
+        # The command is appended to the argv for each request. It is empty
+        # for backends that set the sandbox up in the child process, and is
+        # the 'linux-user-chroot' commandline for that backend.
+        self._context = self.executor.prepare_sandbox(
+            [], **self.sandbox_config)
+        self._argv_prefix, spawn_args = self._context.__enter__()
+
+        try:
+            control, server_control = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+            pid = os.fork()
+            if pid == 0:
+                control.close()
+                _run_server(server_control, spawn_args)
+
+            server_control.close()
+            self._control = control
+            self._pid = pid
+
+            message, fds = _receive(control)
+            if message is None:
+                raise RuntimeError("The fork server exited during setup.")
+            kind, error = message
+            if kind == 'error':
+                raise error
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        '''Stop the helper process, and tear the sandbox down.'''
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+        if self._pid is not None:
+            sandboxlib.spawn.Process(self._pid).wait()
+            self._pid = None
+        if self._context is not None:
+            context, self._context = self._context, None
+            context.__exit__(None, None, None)
+
+    def spawn(self, command, stdout, stderr, env=None, cpu_time_limit=None):
+        '''Start 'command' in the sandbox, returning a ForkServerProcess.
+
+        The 'stdout' and 'stderr' parameters are as for
+        sandboxlib.spawn.spawn(). If 'env' is None, the environment given
+        to the ForkServer is used. If 'cpu_time_limit' is given, the
+        command's RLIMIT_CPU is set to it, as with the 'cpu_time_limit'
+        parameter of run_sandbox().
+
+        '''
+        if self._control is None:
+            raise RuntimeError("The fork server is not running.")
+
+        if type(command) == str:
+            command = [command]
+
+        fds = sandboxlib.spawn.OutputFds(stdout, stderr)
+        connection, server_connection = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            _send(self._control,
+                  (self._argv_prefix + command, env, cpu_time_limit),
+                  [server_connection.fileno(), fds.stdout_write,
+                   fds.stderr_write])
+            server_connection.close()
+            fds.close_write_ends()
+
+            message, _ = _receive(connection)
+            if message is None:
+                raise RuntimeError("The fork server exited unexpectedly.")
+            kind, error = message
+            if kind == 'error':
+                raise error
+        except:
+            connection.close()
+            server_connection.close()
+            fds.close_write_ends()
+            fds.close_read_ends()
+            raise
+
+        return ForkServerProcess(
+            connection, stdout=fds.stdout_read, stderr=fds.stderr_read,
+            consumers=fds.consumers)
+
+    def run_sandbox(self, command, env=None, stdout=sandboxlib.CAPTURE,
+                    stderr=sandboxlib.CAPTURE, timeout=None,
+                    cpu_time_limit=None):
+        '''Run 'command' in the sandbox, returning a SandboxResult.
+
+        If the command is still running after 'timeout' seconds, its process
+        group is killed, and if it uses more than 'cpu_time_limit' seconds of
+        CPU time the kernel kills it, as with the parameters of the same
+        names of run_sandbox().
+
+        '''
+        timer = sandboxlib.utils.PhaseTimer()
+        with timer.phase('spawn'):
+            process = self.spawn(command, stdout, stderr, env=env,
+                                 cpu_time_limit=cpu_time_limit)
+        with timer.phase('run'):
+            try:
+                exit, out, err = process.communicate(timeout=timeout)
+            except BaseException:
+                # Don't leave the command running in the helper process.
+                try:
+                    process.kill()
+                    process.wait()
+                except (IOError, OSError, RuntimeError):
+                    pass
+                raise
+        return sandboxlib.SandboxResult(
+            exit, out, err, timings=timer.timings, rusage=process.rusage,
+            timed_out=sandboxlib.spawn.timeout_reason(
+                process, cpu_time_limit=cpu_time_limit))
+
+    def run_sandbox_with_redirection(self, command, **kwargs):
+        exit, out, err = self.run_sandbox(command, **kwargs)
+        # out and err will be None
+        return exit
+
+
+_servers = {}
+
+
+def fork_server(executor, **sandbox_config):
+    '''Return a running ForkServer for 'executor' and 'sandbox_config'.
+
+    A ForkServer is started the first time this is called with a given
+    backend and configuration, and the same one is returned by later calls.
+    Use close_fork_servers() to stop them all.
+
+    '''
+    key = (executor.__name__, repr(sorted(sandbox_config.items())))
+    server = _servers.get(key)
+    if server is None:
+        server = ForkServer(executor, **sandbox_config)
+        server.start()
+        _servers[key] = server
+    return server
+
+
+def close_fork_servers():
+    '''Stop all of the ForkServer instances started by fork_server().'''
+    while _servers:
+        key, server = _servers.popitem()
+        server.close()
+
+
+def _run_server(control, spawn_args):
+    # This is the helper process. It never returns.
+    try:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in [0, 1, 2]:
+            os.dup2(devnull, fd)
+        os.closerange(3, control.fileno())
+        os.closerange(control.fileno() + 1, sandboxlib.spawn._max_fd())
+
+        # Let fork_in_child() close the control socket in the process that
+        # stays outside the new PID namespace, as it does for the status
+        # pipe in sandboxlib.spawn.
+        sandboxlib.spawn._child_status_fd = control.fileno()
+
+        child_setup = spawn_args.get('child_setup')
+        if child_setup is not None:
+            child_setup()
+        if spawn_args.get('cwd') is not None:
+            os.chdir(spawn_args['cwd'])
+    except BaseException as e:
+        try:
+            _send(control, ('error', e))
+        except Exception:
+            _send(control, ('error', RuntimeError(str(e))))
+        os._exit(1)
+
+    try:
+        _send(control, ('ready', None))
+        _serve(control, spawn_args.get('env'))
+    finally:
+        os._exit(0)
+
+
+def _serve(control, default_env):
+    # Commands are started in new process groups, so they can be killed
+    # along with their children. SIGCHLD is handled by writing to a pipe,
+    # so that select() returns when a command exits.
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signal_number, frame: None)
+
+    running = {}
+    connections = {}
+
+    def reap():
+        # We may be 'init' for a PID namespace, so we reap any process that
+        # exits, not just the ones we started.
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in running:
+                process, connection = running.pop(pid)
+                connections.pop(connection.fileno(), None)
+                process._set_returncode(status)
+                try:
+                    _send(connection,
+                          ('exit', process.returncode, rusage))
+                except (IOError, OSError):
+                    pass
+                connection.close()
+
+    def start(message, fds):
+        argv, env, cpu_time_limit = message
+        connection = socket.socket(fileno=fds[0])
+        child_setup = None
+        if cpu_time_limit is not None:
+            child_setup = functools.partial(
+                sandboxlib.spawn._set_cpu_time_limit, cpu_time_limit, None)
+        try:
+            process = sandboxlib.spawn.spawn(
+                argv, fds[1], fds[2], env=env or default_env,
+                child_setup=child_setup, new_process_group=True)
+        except Exception as e:
+            try:
+                _send(connection, ('error', e))
+            except Exception:
+                _send(connection, ('error', RuntimeError(str(e))))
+            connection.close()
+            return
+        finally:
+            os.close(fds[1])
+            os.close(fds[2])
+        _send(connection, ('started', None))
+        running[process.pid] = (process, connection)
+        connections[connection.fileno()] = process
+
+    try:
+        while True:
+            ready, _, _ = select.select(
+                [control, wakeup_read] + list(connections), [], [])
+
+            # reap() closes connections, and start() opens new ones, which
+            # may get the same file descriptor numbers. So the processes
+            # whose connections are ready are noted first.
+            ready_processes = [connections[fd] for fd in ready
+                               if fd in connections]
+
+            if wakeup_read in ready:
+                try:
+                    while os.read(wakeup_read, 4096):
+                        pass
+                except (IOError, OSError):
+                    pass
+                reap()
+
+            if control in ready:
+                message, fds = _receive(control)
+                if message is None:
+                    break
+                start(message, fds)
+
+            for process in ready_processes:
+                if process.pid not in running:
+                    # It exited, and reap() closed its connection.
+                    continue
+                connection = running[process.pid][1]
+                message, _ = _receive(connection)
+                if message is None:
+                    # The caller has gone away.
+                    del connections[connection.fileno()]
+                    process.kill()
+                else:
+                    kind, signal_number = message
+                    process.kill(signal_number)
+    finally:
+        for process, connection in running.values():
+            process.kill()
@@ -0,0 +1,307 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Access to C library functions that Python's 'os' module doesn't provide.
+
+The functions are called through the 'ctypes' module. Errors are raised as
+OSError, in the same way as the 'os' module does it.
+
+The constants and function signatures here are those of Linux.
+
+'''
+
+
+import ctypes
+import errno
+import os
+import platform
+import sys
+
+
+# Flags for unshare(), from <sched.h>.
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUTS = 0x04000000
+CLONE_NEWIPC = 0x08000000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWPID = 0x20000000
+CLONE_NEWNET = 0x40000000
+
+# Flags for mount(), from <sys/mount.h>.
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_REMOUNT = 32
+MS_MANDLOCK = 64
+MS_DIRSYNC = 128
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_MOVE = 8192
+MS_REC = 16384
+MS_SILENT = 32768
+MS_UNBINDABLE = 1 << 17
+MS_PRIVATE = 1 << 18
+MS_SLAVE = 1 << 19
+MS_SHARED = 1 << 20
+MS_RELATIME = 1 << 21
+MS_STRICTATIME = 1 << 24
+
+# Options from fstab(5) and mount(8) that correspond to mount() flags. Each
+# maps to a tuple of (flags to set, flags to clear).
+MOUNT_OPTION_FLAGS = {
+    'defaults': (0, 0),
+    'ro': (MS_RDONLY, 0),
+    'rw': (0, MS_RDONLY),
+    'nosuid': (MS_NOSUID, 0),
+    'suid': (0, MS_NOSUID),
+    'nodev': (MS_NODEV, 0),
+    'dev': (0, MS_NODEV),
+    'noexec': (MS_NOEXEC, 0),
+    'exec': (0, MS_NOEXEC),
+    'sync': (MS_SYNCHRONOUS, 0),
+    'async': (0, MS_SYNCHRONOUS),
+    'dirsync': (MS_DIRSYNC, 0),
+    'mand': (MS_MANDLOCK, 0),
+    'nomand': (0, MS_MANDLOCK),
+    'noatime': (MS_NOATIME, 0),
+    'atime': (0, MS_NOATIME),
+    'nodiratime': (MS_NODIRATIME, 0),
+    'diratime': (0, MS_NODIRATIME),
+    'relatime': (MS_RELATIME, 0),
+    'norelatime': (0, MS_RELATIME),
+    'strictatime': (MS_STRICTATIME, 0),
+    'silent': (MS_SILENT, 0),
+    'loud': (0, MS_SILENT),
+    'remount': (MS_REMOUNT, 0),
+    'bind': (MS_BIND, 0),
+    'rbind': (MS_BIND | MS_REC, 0),
+    'private': (MS_PRIVATE, 0),
+    'rprivate': (MS_PRIVATE | MS_REC, 0),
+    'slave': (MS_SLAVE, 0),
+    'rslave': (MS_SLAVE | MS_REC, 0),
+    'shared': (MS_SHARED, 0),
+    'rshared': (MS_SHARED | MS_REC, 0),
+    'unbindable': (MS_UNBINDABLE, 0),
+    'runbindable': (MS_UNBINDABLE | MS_REC, 0),
+}
+
+# Options from fstab(5) that only mean something to mount(8) or other
+# programs, and are ignored.
+IGNORED_MOUNT_OPTIONS = [
+    'auto', 'noauto', 'user', 'nouser', 'users', 'owner', 'group', 'nofail',
+    '_netdev',
+]
+
+# Flags for umount2().
+MNT_FORCE = 1
+MNT_DETACH = 2
+
+# Options for prctl(), from <sys/prctl.h>.
+PR_SET_PDEATHSIG = 1
+
+# Values for ioprio_set(), from <linux/ioprio.h>.
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_WHO_PGRP = 2
+IOPRIO_WHO_USER = 3
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Flags for fanotify_init() and fanotify_mark(), from <linux/fanotify.h>.
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_CLASS_NOTIF = 0x0
+FAN_UNLIMITED_QUEUE = 0x10
+FAN_MARK_ADD = 0x1
+FAN_MARK_REMOVE = 0x2
+FAN_MARK_MOUNT = 0x10
+FAN_MARK_FILESYSTEM = 0x100
+
+# Events reported by fanotify, from <linux/fanotify.h>.
+FAN_ACCESS = 0x1
+FAN_MODIFY = 0x2
+FAN_CLOSE_WRITE = 0x8
+FAN_CLOSE_NOWRITE = 0x10
+FAN_OPEN = 0x20
+FAN_Q_OVERFLOW = 0x4000
+FAN_NOFD = -1
+
+# struct fanotify_event_metadata: event_len, vers, reserved, metadata_len,
+# mask, fd and pid.
+FANOTIFY_EVENT_METADATA_FORMAT = '=IBBHQii'
+
+AT_FDCWD = -100
+
+# Modes for set_mempolicy(), from <linux/mempolicy.h>.
+MPOL_DEFAULT = 0
+MPOL_PREFERRED = 1
+MPOL_BIND = 2
+MPOL_INTERLEAVE = 3
+MPOL_PREFERRED_MANY = 5
+
+# The C library has no wrapper for ioprio_set(), so it is called by number,
+# which depends on the architecture.
+_SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+# The same goes for set_mempolicy(), which is provided by libnuma instead.
+_SYS_SET_MEMPOLICY = {
+    'x86_64': 238,
+    'i386': 276,
+    'i686': 276,
+    'aarch64': 237,
+    'armv7l': 321,
+    'ppc64le': 261,
+    's390x': 270,
+}
+
+
+_libc = None
+
+
+def parse_mount_options(options):
+    '''Convert an fstab-style options string into mount() flags and data.
+
+    Returns a tuple of (flags, data). Options that correspond to a mount()
+    flag are converted to flags, and any others are passed on to the
+    filesystem in 'data', which is None if there are no such options.
+
+    '''
+    flags = 0
+    data = []
+
+    for option in (options or '').split(','):
+        option = option.strip()
+        if not option or option in IGNORED_MOUNT_OPTIONS or \
+                option.startswith('x-') or option.startswith('comment='):
+            continue
+        elif option in MOUNT_OPTION_FLAGS:
+            set_flags, clear_flags = MOUNT_OPTION_FLAGS[option]
+            flags = (flags | set_flags) & ~clear_flags
+        elif option == 'loop' or option.startswith('loop='):
+            raise ValueError(
+                "The '%s' mount option requires setting up a loop device, "
+                "which is not supported." % option)
+        else:
+            data.append(option)
+
+    return flags, (','.join(data) if data else None)
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        # Loading the symbols of the running program gives us the C library
+        # without having to search for it.
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def _encode(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return value.encode(sys.getfilesystemencoding())
+
+
+def _check(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def unshare(flags):
+    '''Move the calling process into new namespaces. See unshare(2).'''
+    _check(_get_libc().unshare(ctypes.c_int(flags)))
+
+
+def mount(source, target, filesystem_type, flags=0, data=None):
+    '''Mount a filesystem. See mount(2).'''
+    _check(_get_libc().mount(
+        _encode(source), _encode(target), _encode(filesystem_type),
+        ctypes.c_ulong(flags), _encode(data)))
+
+
+def umount2(target, flags=0):
+    '''Unmount a filesystem. See umount2(2).'''
+    _check(_get_libc().umount2(_encode(target), ctypes.c_int(flags)))
+
+
+def prctl(option, arg2=0, arg3=0, arg4=0, arg5=0):
+    '''Control process attributes. See prctl(2).'''
+    return _check(_get_libc().prctl(
+        ctypes.c_int(option), ctypes.c_ulong(arg2), ctypes.c_ulong(arg3),
+        ctypes.c_ulong(arg4), ctypes.c_ulong(arg5)))
+
+
+def ioprio_set(which, who, ioprio_class, ioprio_data=0):
+    '''Set the I/O scheduling class and priority. See ioprio_set(2).
+
+    With which=IOPRIO_WHO_PROCESS and who=0, this applies to the calling
+    thread only. Raises OSError with ENOSYS on architectures where the
+    system call number isn't known.
+
+    '''
+    number = _SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    ioprio = (ioprio_class << IOPRIO_CLASS_SHIFT) | ioprio_data
+    _check(_get_libc().syscall(
+        ctypes.c_long(number), ctypes.c_int(which), ctypes.c_int(who),
+        ctypes.c_int(ioprio)))
+
+
+def set_mempolicy(mode, nodes=()):
+    '''Set the NUMA memory policy of the calling thread. See set_mempolicy(2).
+
+    The 'nodes' are a list of NUMA node numbers. Raises OSError with ENOSYS
+    on architectures where the system call number isn't known.
+
+    '''
+    number = _SYS_SET_MEMPOLICY.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (max(list(nodes) or [0]) // bits + 1))()
+    for node in nodes:
+        mask[node // bits] |= 1 << (node % bits)
+    # The kernel ignores the last bit of 'maxnode'.
+    _check(_get_libc().syscall(
+        ctypes.c_long(number), ctypes.c_int(mode), mask,
+        ctypes.c_ulong(len(mask) * bits + 1)))
+
+
+def fanotify_init(flags, event_f_flags=os.O_RDONLY):
+    '''Create a fanotify group, returning its fd. See fanotify_init(2).'''
+    return _check(_get_libc().fanotify_init(
+        ctypes.c_uint(flags), ctypes.c_uint(event_f_flags)))
+
+
+def fanotify_mark(fd, flags, mask, path, dirfd=AT_FDCWD):
+    '''Add, remove or modify a fanotify mark. See fanotify_mark(2).'''
+    _check(_get_libc().fanotify_mark(
+        ctypes.c_int(fd), ctypes.c_uint(flags), ctypes.c_uint64(mask),
+        ctypes.c_int(dirfd), _encode(path)))
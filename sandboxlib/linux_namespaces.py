@@ -0,0 +1,385 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Execute command in a sandbox, using Linux namespaces directly.
+
+This implements an API defined in sandboxlib/__init__.py.
+
+This backend does the same job as the 'linux-user-chroot' backend, but
+without needing the 'linux-user-chroot' program. The namespaces and mounts
+are set up by calling the C library from the child process, before it
+executes the command.
+
+Users other than 'root' can only use this backend if the kernel allows
+unprivileged processes to create user namespaces. Some distributions disable
+this, using the 'kernel.unprivileged_userns_clone' sysctl or similar.
+
+'''
+
+
+import contextlib
+import errno
+import functools
+import os
+import re
+import signal
+
+import sandboxlib
+import sandboxlib.cgroup
+import sandboxlib.spawn
+from sandboxlib import libc
+
+
+CAPABILITIES = {
+    'network': ['isolated', 'undefined'],
+    'mounts': ['isolated', 'undefined'],
+    'filesystem_writable_paths': ['all', 'any'],
+    'resources': sandboxlib.cgroup.RESOURCES,
+}
+
+
+def degrade_config_for_capabilities(in_config, warn=True):
+    # All of the options are supported, but resource limits depend on which
+    # cgroups the calling process is allowed to create.
+    out_config = in_config.copy()
+    sandboxlib.cgroup.degrade_resources(
+        out_config, 'linux-namespaces', warn=warn)
+    return out_config
+
+
+_namespaces_available = None
+
+
+def namespaces_available():
+    '''Return True if the calling process can use this backend.
+
+    The 'root' user can always create namespaces. Other users need to be able
+    to create a user namespace, which is tested by creating one in a child
+    process. The result is remembered.
+
+    '''
+    global _namespaces_available
+
+    if _namespaces_available is None:
+        if os.geteuid() == 0:
+            _namespaces_available = True
+        else:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    libc.unshare(libc.CLONE_NEWUSER | libc.CLONE_NEWNS)
+                    os._exit(0)
+                except BaseException:
+                    os._exit(1)
+            pid, status = os.waitpid(pid, 0)
+            _namespaces_available = (
+                os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+    return _namespaces_available
+
+
+def process_network_config(network):
+    sandboxlib.utils.check_parameter('network', network, CAPABILITIES['network'])
+
+    if network == 'isolated':
+        return libc.CLONE_NEWNET
+    else:
+        return 0
+
+
+def process_mount_config(mounts, extra_mounts):
+    # We always create a new mount namespace, so 'isolated' and 'undefined'
+    # mean the same thing.
+    sandboxlib.utils.check_parameter('mounts', mounts, CAPABILITIES['mounts'])
+
+    extra_mounts = sandboxlib.validate_extra_mounts(extra_mounts)
+
+    for source, target, mount_type, mount_options in extra_mounts:
+        # Check for errors here, rather than in the child process.
+        mount_args_for_extra_mount(source, target, mount_type, mount_options)
+
+    return extra_mounts
+
+
+def process_writable_paths(writable_paths):
+    if writable_paths == 'all':
+        return 'all'
+    elif type(writable_paths) != list:
+        assert writable_paths in [None, 'none']
+        return []
+    else:
+        return writable_paths
+
+
+def mount_args_for_extra_mount(source, target, mount_type, mount_options):
+    '''Return the arguments for libc.mount() for an 'extra_mounts' entry.
+
+    The target is returned unchanged, so it is still relative to the sandbox
+    root.
+
+    '''
+    def is_none(value):
+        return value in [None, 'none', '']
+
+    if mount_type == 'proc':
+        if not is_none(mount_options):
+            raise AssertionError(
+                "No options for 'proc' filesystems are supported in the "
+                "linux-namespaces backend. Got '%s'" % mount_options)
+        return ('proc', target, 'proc',
+                libc.MS_NOSUID | libc.MS_NODEV | libc.MS_NOEXEC, None)
+    elif mount_type == 'tmpfs':
+        flags, data = libc.parse_mount_options(mount_options)
+        return ('tmpfs', target, 'tmpfs', flags, data)
+    elif mount_options == 'bind':
+        if not is_none(mount_type):
+            raise AssertionError(
+                "Type cannot be specified for 'bind' mounts. Got '%s'" %
+                mount_type)
+        return (source, target, None, libc.MS_BIND | libc.MS_REC, None)
+    else:
+        raise AssertionError(
+            "Unsupported mount type '%s' for linux-namespaces backend." %
+            mount_type)
+
+
+def path_in_sandbox(filesystem_root, path):
+    return os.path.join(filesystem_root, path.lstrip('/'))
+
+
+def mount_points_under(path):
+    '''Return the mount points at or below 'path', from /proc/self/mountinfo.'''
+    result = []
+    with open('/proc/self/mountinfo', 'r') as f:
+        for line in f:
+            # Field 5 is the mount point, with spaces and some other
+            # characters escaped as octal.
+            mount_point = re.sub(
+                r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)),
+                line.split(' ')[4])
+            if mount_point == path or mount_point.startswith(
+                    path.rstrip('/') + '/'):
+                result.append(mount_point)
+    return result
+
+
+# Mount flags that we need to preserve when remounting a mount read-only,
+# as pairs of (statvfs() flag, mount() flag). The kernel refuses to clear
+# any of these flags inside a user namespace, if they were set when the mount
+# namespace was created. The values are from <sys/statvfs.h>.
+_PRESERVED_MOUNT_FLAGS = [
+    (2, libc.MS_NOSUID),
+    (4, libc.MS_NODEV),
+    (8, libc.MS_NOEXEC),
+    (1024, libc.MS_NOATIME),
+    (2048, libc.MS_NODIRATIME),
+    (4096, libc.MS_RELATIME),
+]
+
+
+def remount_readonly(path):
+    flags = libc.MS_BIND | libc.MS_REMOUNT | libc.MS_RDONLY
+    statvfs_flags = os.statvfs(path).f_flag
+    for statvfs_flag, mount_flag in _PRESERVED_MOUNT_FLAGS:
+        if statvfs_flags & statvfs_flag:
+            flags |= mount_flag
+    libc.mount(None, path, None, flags, None)
+
+
+def setup_filesystem(filesystem_root, extra_mounts, writable_paths,
+                     overlay_path=None, user_namespace=False):
+    '''Set up the sandbox filesystem, in a new mount namespace.
+
+    If 'filesystem_root' is a sandboxlib.overlay.Overlay, it is mounted
+    using the empty directory 'overlay_path'.
+
+    '''
+
+    def mount(source, target, filesystem_type, flags, data):
+        try:
+            libc.mount(source, target, filesystem_type, flags, data)
+        except OSError as e:
+            raise RuntimeError("Unable to mount %s on %s: %s" % (
+                source, target, e))
+
+    # Make sure none of our mounts propagate back to the parent namespace.
+    mount(None, '/', None, libc.MS_REC | libc.MS_PRIVATE, None)
+
+    if sandboxlib.overlay.is_overlay(filesystem_root):
+        filesystem_root = sandboxlib.overlay.mount_overlay(
+            filesystem_root, overlay_path, user_namespace=user_namespace)[-1]
+
+    # The root needs to be a mount point, so that it can be made read-only.
+    mount(filesystem_root, filesystem_root, None,
+          libc.MS_BIND | libc.MS_REC, None)
+
+    for mount_info in extra_mounts:
+        source, target, mount_type, flags, data = \
+            mount_args_for_extra_mount(*mount_info)
+        target = path_in_sandbox(filesystem_root, target)
+        if not os.path.exists(target):
+            os.makedirs(target)
+        mount(source, target, mount_type, flags, data)
+
+    if writable_paths != 'all':
+        # Each writable path becomes a mount point of its own. Every other
+        # mount point in the sandbox is then made read-only.
+        writable_mount_points = []
+        for path in writable_paths:
+            path = path_in_sandbox(filesystem_root, path)
+            if os.path.exists(path) and not os.path.islink(path):
+                mount(path, path, None, libc.MS_BIND | libc.MS_REC, None)
+                writable_mount_points.append(path.rstrip('/'))
+
+        def is_writable(mount_point):
+            return any(mount_point == path or mount_point.startswith(path + '/')
+                       for path in writable_mount_points)
+
+        for mount_point in mount_points_under(filesystem_root):
+            if is_writable(mount_point):
+                continue
+            try:
+                remount_readonly(mount_point)
+            except OSError as e:
+                if e.errno in [errno.ENOENT, errno.EACCES]:
+                    # Hidden or inaccessible mount point.
+                    continue
+                raise RuntimeError(
+                    "Unable to make %s read-only: %s" % (mount_point, e))
+
+    try:
+        os.chroot(filesystem_root)
+    except OSError as e:
+        raise RuntimeError("Unable to chroot: %s" % e)
+
+    # This is important in case 'cwd' is a relative path.
+    os.chdir('/')
+
+
+def write_id_maps(uid, gid):
+    # A process can map just its own user and group ID into a new user
+    # namespace. It must give up the ability to call setgroups() in order to
+    # map its group ID.
+    with open('/proc/self/setgroups', 'w') as f:
+        f.write('deny')
+    with open('/proc/self/uid_map', 'w') as f:
+        f.write('%i %i 1' % (uid, uid))
+    with open('/proc/self/gid_map', 'w') as f:
+        f.write('%i %i 1' % (gid, gid))
+
+
+def setup_sandbox(namespace_flags, filesystem_root, extra_mounts,
+                  writable_paths, overlay_path=None):
+    '''Set up the sandbox in the child process, before exec().'''
+    uid, gid = os.geteuid(), os.getegid()
+
+    if uid != 0:
+        namespace_flags |= libc.CLONE_NEWUSER
+
+    try:
+        libc.unshare(namespace_flags)
+    except OSError as e:
+        raise RuntimeError("Unable to create namespaces: %s" % e)
+
+    if uid != 0:
+        write_id_maps(uid, gid)
+
+    # The new PID namespace only applies to our children. The first child
+    # becomes 'init' for the namespace, so when it exits every other process
+    # in the sandbox is killed too.
+    sandboxlib.spawn.fork_in_child()
+
+    # If the process waiting for us is killed, take the sandbox down too.
+    libc.prctl(libc.PR_SET_PDEATHSIG, signal.SIGKILL)
+
+    setup_filesystem(filesystem_root, extra_mounts, writable_paths,
+                     overlay_path=overlay_path, user_namespace=uid != 0)
+
+
+@contextlib.contextmanager
+def prepare_sandbox(command, cwd=None, env=None,
+                    filesystem_root='/', filesystem_writable_paths='all',
+                    mounts='undefined', extra_mounts=None,
+                    network='undefined', timer=None):
+    '''Set up a sandbox, yielding the arguments to start 'command' in it.
+
+    Yields a tuple of (argv, spawn_args), where 'spawn_args' is a dict of
+    keyword arguments for sandboxlib.spawn.spawn(). Everything is set up in
+    the child process, so there is nothing to tear down, and the time taken
+    to set up the sandbox is counted by 'timer' as part of the 'spawn' phase.
+
+    '''
+    timer = timer or sandboxlib.utils.PhaseTimer()
+
+    if type(command) == str:
+        command = [command]
+
+    with timer.phase('config'):
+        namespace_flags = libc.CLONE_NEWNS | libc.CLONE_NEWPID
+        namespace_flags |= process_network_config(network)
+
+        extra_mounts = process_mount_config(mounts, extra_mounts)
+
+        writable_paths = process_writable_paths(filesystem_writable_paths)
+
+    if not sandboxlib.overlay.is_overlay(filesystem_root):
+        child_setup = functools.partial(
+            setup_sandbox, namespace_flags, os.path.realpath(filesystem_root),
+            extra_mounts, writable_paths)
+        yield command, dict(cwd=cwd, env=env, child_setup=child_setup)
+        return
+
+    # The overlay is mounted in the child process's mount namespace, so the
+    # directory it is mounted on is left empty in ours, and the changes are
+    # discarded along with the namespace unless they are kept.
+    overlay_path = sandboxlib.overlay.overlay_mount_point()
+    try:
+        child_setup = functools.partial(
+            setup_sandbox, namespace_flags, filesystem_root, extra_mounts,
+            writable_paths, overlay_path=overlay_path)
+        yield command, dict(cwd=cwd, env=env, child_setup=child_setup)
+    finally:
+        os.rmdir(overlay_path)
+
+
+class Sandbox(sandboxlib.spawn.Sandbox):
+    '''A 'linux-namespaces' sandbox that can run many commands.
+
+    The configuration is checked once, when the sandbox is opened. Each
+    command still gets new namespaces and its own 'extra_mounts', so nothing
+    written to a 'tmpfs' mount by one command is seen by the next. Use
+    sandboxlib.forkserver.ForkServer to share them between commands.
+
+    '''
+
+    prepare_sandbox = staticmethod(prepare_sandbox)
+
+
+def run_sandbox(command, stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE,
+                **sandbox_config):
+    return sandboxlib.spawn.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
+
+
+def run_sandbox_async(command, stdout=sandboxlib.CAPTURE,
+                      stderr=sandboxlib.CAPTURE, **sandbox_config):
+    return sandboxlib.aio.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
+
+
+def run_sandbox_with_redirection(command, **sandbox_config):
+    exit, out, err = run_sandbox(command, **sandbox_config)
+    # out and err will be None
+    return exit
@@ -23,30 +23,49 @@ with Linux.
 The 'linux-user-chroot' program is intended to be 'setuid', and thus usable by
 non-'root' users at the discretion of the system administrator.
 
+This backend accepts one extra parameter, 'filesystem_generation'. Working
+out which paths to make read-only means reading the directories along the
+'filesystem_writable_paths', and the result is cached. By default the cache
+checks whether those directories have changed each time. A caller that knows
+when 'filesystem_root' changes can pass any token as 'filesystem_generation'
+instead, and change the token when the tree changes. The result is then
+reused for as long as the same token is passed, without checking anything.
+readonly_paths_cache.invalidate() drops cached results explicitly.
+
 Much of this code is adapted from Morph, from the Baserock project, from code
 written by Joe Burmeister, Richard Maw, Lars Wirzenius and others.
 
 '''
 
 
+import collections
 import contextlib
+import logging
 import os
-import shutil
 import tempfile
+import threading
+import time
 
 import sandboxlib
+import sandboxlib.cgroup
+import sandboxlib.spawn
 
 
 CAPABILITIES = {
     'network': ['isolated', 'undefined'],
     'mounts': ['isolated', 'undefined'],
     'filesystem_writable_paths': ['all', 'any'],
+    'resources': sandboxlib.cgroup.RESOURCES,
 }
 
 
 def degrade_config_for_capabilities(in_config, warn=True):
-    # This backend has the most features, right now!
-    return in_config
+    # This backend has the most features, right now! Resource limits depend
+    # on which cgroups the calling process is allowed to create.
+    out_config = in_config.copy()
+    sandboxlib.cgroup.degrade_resources(
+        out_config, 'linux-user-chroot', warn=warn)
+    return out_config
 
 
 def tmpfs_for_user():
@@ -131,8 +150,9 @@ def process_mount_config(mounts, extra_mounts):
         yield extra_linux_user_chroot_args
     finally:
         # The tmpfs dir is a directory *in* a pre-existing tmpfs, so we need
-        # to delete its contents.
-        shutil.rmtree(tmpfs_dir)
+        # to delete its contents. That is done in the background, as the
+        # command may have written a lot to it.
+        sandboxlib.cleanup.remove_tree(tmpfs_dir)
 
 
 def process_network_config(network):
@@ -154,13 +174,51 @@ def process_network_config(network):
     return extra_linux_user_chroot_args
 
 
+def path_components(path):
+    '''Split 'path' into a list of normalised components.
+
+    The path is treated as relative to the root whether or not it starts
+    with a '/', so '/foo/bar', 'foo/bar/' and '/foo/../foo/bar' all give
+    ['foo', 'bar'].
+
+    '''
+    return [component for component in
+            os.path.normpath(os.sep + path).split(os.sep) if component]
+
+
+def path_trie(paths):
+    '''Return a prefix tree of the components of each path in `paths`.
+
+    The tree is a dict mapping each first path component to a subtree of the
+    same form. A subtree of None marks the end of a listed path, which
+    covers everything below it too. If the root itself is listed, None is
+    returned.
+
+    Paths are normalised, and treated as relative to the same root whether or
+    not they start with a '/'.
+
+    '''
+    trie = {}
+    for path in paths:
+        components = path_components(path)
+
+        if not components:
+            return None
+
+        node = trie
+        for component in components[:-1]:
+            node = node.setdefault(component, {})
+            if node is None:
+                # A parent path is already listed.
+                break
+        else:
+            node[components[-1]] = None
+
+    return trie
+
+
 # This function is mostly taken from Morph, from the Baserock project, from
 # file morphlib/fsutils.py.
-#
-# It is used to convert the whitelist 'filesystem_writable_paths' into a
-# blacklist of '--mount-readonly' arguments for linux-user-chroot. It would
-# be better if we could pass the whitelist into linux-user-chroot itself,
-# all that is needed is a patch to linux-user-chroot.
 def invert_paths(tree_walker, paths):
     '''List paths from `tree_walker` that are not in `paths`.
 
@@ -187,32 +245,31 @@ def invert_paths(tree_walker, paths):
     Each path in `paths` is expected to begin with the same path as
     yielded by the tree walker.
 
+    The sandboxlib backends use invert_writable_paths() instead, which is
+    faster because it doesn't need to visit the whole tree.
+
     '''
 
-    def normpath(path):
-        if path == '.':
-            return path
-        path = os.path.normpath(path)
-        if not os.path.isabs(path):
-            path = os.path.join('.', path)
-        return path
-    def any_paths_are_subpath_of(prefix):
-        prefix = normpath(prefix)
-        norm_paths = (normpath(path) for path in paths)
-        return any(path[:len(prefix)] == prefix
-                   for path in norm_paths)
-
-    def path_is_listed(path):
-        return any(normpath(path) == normpath(other)
-                   for other in paths)
+    trie = path_trie(paths)
+
+    def lookup(path):
+        # Returns None if 'path' is listed, a subtree if some paths below it
+        # are listed, or an empty dict if it's not listed at all.
+        node = trie
+        for component in path_components(path):
+            if node is None:
+                break
+            node = node.get(component, {})
+        return node
 
     for dirpath, dirnames, filenames in tree_walker:
+        node = lookup(dirpath)
 
-        if path_is_listed(dirpath):
+        if node is None:
             # No subpaths need to be considered
             del dirnames[:]
             del filenames[:]
-        elif any_paths_are_subpath_of(dirpath):
+        elif node:
             # Subpaths may be marked, or may not, need to leave this
             # writable, so don't yield, but we don't cull.
             pass
@@ -225,13 +282,168 @@ def invert_paths(tree_walker, paths):
 
         for filename in filenames:
             fullpath = os.path.join(dirpath, filename)
-            if path_is_listed(fullpath):
+            if lookup(fullpath) is not None:
+                yield fullpath
+
+
+def invert_writable_paths(fs_root, writable_paths, directory_stats=None):
+    '''List the paths in `fs_root` that are not covered by `writable_paths`.
+
+    The `writable_paths` are relative to `fs_root`. The result is a list of
+    paths in depth-first, alphabetical order, relative to `fs_root` and
+    starting with '/'. These can all be made read-only while leaving
+    everything in `writable_paths` writable. Symbolic links are never
+    included, as they can't be mounted over.
+
+    Only the directories which contain a writable path are listed, so the
+    amount of work done depends on the depth of the writable paths and the
+    size of the directories along the way, not on the size of the whole tree.
+
+    If `directory_stats` is a list, a tuple of (path, os.stat() result) is
+    appended to it for each directory that is read, before it is read.
+
+    '''
+    trie = path_trie(writable_paths)
+
+    if trie is None:
+        return []
+    if not trie:
+        return ['/']
+
+    result = []
+
+    def visit(dirpath, relpath, node):
+        if directory_stats is not None:
+            directory_stats.append((dirpath, os.stat(dirpath)))
+
+        for entry in sandboxlib.utils.scan_directory(dirpath):
+            if entry.is_symlink():
+                continue
+
+            entry_relpath = relpath + '/' + entry.name
+            subtree = node.get(entry.name, {})
+            if subtree is None:
+                # Writable, along with everything below it.
                 pass
+            elif subtree and entry.is_dir(follow_symlinks=False):
+                # Some paths below this one are writable.
+                visit(entry.path, entry_relpath, subtree)
             else:
-                yield fullpath
+                result.append(entry_relpath)
 
+    visit(fs_root, '', trie)
+    return result
 
-def process_writable_paths(fs_root, writable_paths):
+
+def directory_signature(stat_result):
+    # A directory's mtime and ctime change whenever an entry is added to it,
+    # removed from it or renamed, which is all that invert_writable_paths()
+    # depends on.
+    return (stat_result.st_dev, stat_result.st_ino,
+            getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime),
+            getattr(stat_result, 'st_ctime_ns', stat_result.st_ctime))
+
+
+class ReadOnlyPathsCache(object):
+    '''Memoises the results of invert_writable_paths().
+
+    Results are keyed on the absolute path of the filesystem root and the
+    normalised set of writable paths. By default, a result is reused only if
+    none of the directories that were read to compute it have been modified
+    since, which costs one stat() per directory along the writable paths.
+
+    Callers which know when the filesystem root changes can pass a
+    'generation' token instead, in which case a result is reused for as long
+    as the same token is passed, without checking the filesystem at all.
+
+    The 'hits' and 'misses' attributes count lookups. The cache holds at most
+    'max_entries' results, discarding the least recently used.
+
+    '''
+
+    # Directories modified less than this many seconds before they were read
+    # could be modified again without their mtime changing, because of the
+    # granularity of filesystem timestamps.
+    RACY_INTERVAL = 1.0
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, fs_root, writable_paths, generation):
+        normalised_paths = sorted(set(
+            tuple(path_components(path)) for path in writable_paths))
+        return (os.path.abspath(fs_root), tuple(normalised_paths), generation)
+
+    def _is_valid(self, directory_signatures):
+        for path, signature in directory_signatures:
+            try:
+                if directory_signature(os.stat(path)) != signature:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def readonly_paths(self, fs_root, writable_paths, generation=None):
+        '''Return invert_writable_paths(fs_root, writable_paths), memoised.'''
+        key = self._key(fs_root, writable_paths, generation)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            readonly_paths, directory_signatures = entry
+            if generation is not None or self._is_valid(directory_signatures):
+                with self._lock:
+                    self.hits += 1
+                    if key in self._entries:
+                        self._entries.pop(key)
+                        self._entries[key] = entry
+                return list(readonly_paths)
+
+        with self._lock:
+            self.misses += 1
+
+        scan_time = time.time()
+        directory_stats = []
+        readonly_paths = invert_writable_paths(
+            fs_root, writable_paths, directory_stats=directory_stats)
+
+        racy = any(stat_result.st_mtime >= scan_time - self.RACY_INTERVAL
+                   for path, stat_result in directory_stats)
+
+        if generation is not None or not racy:
+            directory_signatures = [
+                (path, directory_signature(stat_result))
+                for path, stat_result in directory_stats]
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = (readonly_paths, directory_signatures)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return list(readonly_paths)
+
+    def invalidate(self, fs_root=None):
+        '''Forget results for 'fs_root', or all results if it is None.'''
+        with self._lock:
+            if fs_root is None:
+                self._entries.clear()
+            else:
+                fs_root = os.path.abspath(fs_root)
+                for key in list(self._entries):
+                    if key[0] == fs_root:
+                        del self._entries[key]
+
+
+readonly_paths_cache = ReadOnlyPathsCache()
+
+
+def process_writable_paths(fs_root, writable_paths, generation=None):
     if writable_paths == 'all':
         extra_linux_user_chroot_args = []
     else:
@@ -246,16 +458,10 @@ def process_writable_paths(fs_root, writable_paths):
 
         extra_linux_user_chroot_args = []
 
-        absolute_writable_paths = [
-            os.path.join(fs_root, path.lstrip('/')) for path in writable_paths]
-
-        readonly_paths = invert_paths(
-            os.walk(fs_root), absolute_writable_paths)
-        for d in sorted(readonly_paths):
-            if not os.path.islink(d):
-                rel_path = '/' + os.path.relpath(d, fs_root)
-                extra_linux_user_chroot_args.extend(
-                    ['--mount-readonly', rel_path])
+        readonly_paths = readonly_paths_cache.readonly_paths(
+            fs_root, writable_paths, generation=generation)
+        for path in readonly_paths:
+            extra_linux_user_chroot_args.extend(['--mount-readonly', path])
 
     return extra_linux_user_chroot_args
 
@@ -276,36 +482,82 @@ def linux_user_chroot_program():
     return sandboxlib.utils.find_program('linux-user-chroot')
 
 
-def run_sandbox(command, cwd=None, env=None,
-                filesystem_root='/', filesystem_writable_paths='all',
-                mounts='undefined', extra_mounts=None,
-                network='undefined',
-                stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE):
+@contextlib.contextmanager
+def prepare_sandbox(command, cwd=None, env=None,
+                    filesystem_root='/', filesystem_writable_paths='all',
+                    mounts='undefined', extra_mounts=None,
+                    network='undefined', filesystem_generation=None,
+                    timer=None):
+    '''Set up a sandbox, yielding the arguments to start 'command' in it.
+
+    Yields a tuple of (argv, spawn_args), where 'spawn_args' is a dict of
+    keyword arguments for sandboxlib.spawn.spawn(). Any mounts made by the
+    calling process are removed when the context exits. If 'timer' is given,
+    it should be a sandboxlib.utils.PhaseTimer, which records how long each
+    step takes. See the module docstring for 'filesystem_generation'.
+
+    '''
+    timer = timer or sandboxlib.utils.PhaseTimer()
+
     if type(command) == str:
         command = [command]
 
-    linux_user_chroot_command = [linux_user_chroot_program()]
+    with timer.phase('config'):
+        assert not sandboxlib.overlay.is_overlay(filesystem_root), \
+            "Overlays are not supported by the linux-user-chroot backend."
 
-    extra_mounts = sandboxlib.validate_extra_mounts(extra_mounts)
+        linux_user_chroot_command = [linux_user_chroot_program()]
 
-    linux_user_chroot_command += process_network_config(network)
+        extra_mounts = sandboxlib.validate_extra_mounts(extra_mounts)
 
-    if cwd is not None:
-        linux_user_chroot_command.extend(['--chdir', cwd])
+        linux_user_chroot_command += process_network_config(network)
 
-    linux_user_chroot_command += process_writable_paths(
-        filesystem_root, filesystem_writable_paths)
+        if cwd is not None:
+            linux_user_chroot_command.extend(['--chdir', cwd])
 
-    create_mount_points_if_missing(filesystem_root, extra_mounts)
+    with timer.phase('writable_paths'):
+        linux_user_chroot_command += process_writable_paths(
+            filesystem_root, filesystem_writable_paths,
+            generation=filesystem_generation)
+
+    with timer.phase('mounts'):
+        create_mount_points_if_missing(filesystem_root, extra_mounts)
 
     mount_context = process_mount_config(
         mounts=mounts, extra_mounts=extra_mounts or [])
-    with mount_context as linux_user_chroot_mount_args:
+    with timer.timed_context(mount_context, 'mounts', 'teardown') as \
+            linux_user_chroot_mount_args:
         linux_user_chroot_command.extend(linux_user_chroot_mount_args)
 
         argv = linux_user_chroot_command + [filesystem_root] + command
-        exit, out, err = sandboxlib._run_command(argv, stdout, stderr, env=env)
-    return exit, out, err
+        log = logging.getLogger('sandboxlib')
+        log.debug('Running: %s', sandboxlib.argv_to_string(argv))
+        yield argv, dict(env=env)
+
+
+class Sandbox(sandboxlib.spawn.Sandbox):
+    '''A 'linux-user-chroot' sandbox that can run many commands.
+
+    The list of read-only paths and the temporary directories for 'tmpfs'
+    mounts are created once, when the sandbox is opened, and removed when it
+    is closed. Anything written to them by one command can be seen by the
+    commands that run after it.
+
+    '''
+
+    prepare_sandbox = staticmethod(prepare_sandbox)
+
+
+def run_sandbox(command, stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE,
+                **sandbox_config):
+    return sandboxlib.spawn.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
+
+
+def run_sandbox_async(command, stdout=sandboxlib.CAPTURE,
+                      stderr=sandboxlib.CAPTURE, **sandbox_config):
+    return sandboxlib.aio.run_sandbox(
+        prepare_sandbox, command, stdout, stderr, **sandbox_config)
 
 
 def run_sandbox_with_redirection(command, **sandbox_config):
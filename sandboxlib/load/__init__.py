@@ -16,4 +16,7 @@
 '''sandboxlib loaders module.'''
 
 
+import sandboxlib.load.extract
+import sandboxlib.load.image
 import sandboxlib.load.appc
+import sandboxlib.load.tree
@@ -17,13 +17,15 @@
 
 
 import contextlib
+import hashlib
 import json
 import logging
 import os
-import shutil
 import tarfile
 import tempfile
 
+import sandboxlib
+
 
 # Mandated by https://github.com/appc/spec/blob/master/SPEC.md#execution-environment
 BASE_ENVIRONMENT = {
@@ -35,13 +37,407 @@ def is_app_container_image(path):
     return path.endswith('.aci')
 
 
+def _is_string(value):
+    try:
+        return isinstance(value, basestring)
+    except NameError:
+        # Python 3.
+        return isinstance(value, str)
+
+
+def validate_manifest(manifest_data):
+    '''Raise ValueError if 'manifest_data' isn't a usable image manifest.
+
+    Only the parts of the manifest that sandboxlib uses are checked: the
+    'name', and the 'exec', 'workingDirectory' and 'environment' of the
+    'app', if there is one.
+
+    '''
+    if not isinstance(manifest_data, dict):
+        raise ValueError("The image manifest is not a JSON object.")
+    if not _is_string(manifest_data.get('name')):
+        raise ValueError("The image manifest has no 'name'.")
+
+    app = manifest_data.get('app')
+    if app is None:
+        return
+    if not isinstance(app, dict):
+        raise ValueError("The 'app' in the image manifest is not an object.")
+
+    if 'exec' in app:
+        if not isinstance(app['exec'], list) or not app['exec'] or \
+                not all(_is_string(arg) for arg in app['exec']):
+            raise ValueError(
+                "The 'exec' in the image manifest is not a list of strings.")
+    if 'workingDirectory' in app and not _is_string(app['workingDirectory']):
+        raise ValueError(
+            "The 'workingDirectory' in the image manifest is not a string.")
+    for item in app.get('environment', []):
+        if not isinstance(item, dict) or not _is_string(item.get('name')) \
+                or not _is_string(item.get('value')):
+            raise ValueError(
+                "Invalid 'environment' entry in the image manifest: %s" %
+                item)
+
+
+def load_manifest(manifest_file):
+    '''Read and validate an image manifest from the file 'manifest_file'.'''
+    with open(manifest_file, 'r') as f:
+        try:
+            manifest_data = json.load(f)
+        except ValueError as e:
+            raise ValueError("Invalid manifest %s: %s" % (manifest_file, e))
+    validate_manifest(manifest_data)
+    return manifest_data
+
+
+def _read_manifest_member(image_file):
+    # Read the tarball only as far as the 'manifest' member. The rest of
+    # the image isn't decompressed.
+    stream = sandboxlib.load.extract.open_decompressed(image_file)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as tf:
+            for member in tf:
+                name = os.path.normpath(member.name.lstrip('/'))
+                if name == 'manifest' and member.isreg():
+                    data = tf.extractfile(member).read()
+                    break
+            else:
+                raise ValueError("%s has no manifest." % image_file)
+    finally:
+        stream.close()
+
+    try:
+        manifest_data = json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise ValueError("Invalid manifest in %s: %s" % (image_file, e))
+    validate_manifest(manifest_data)
+    return manifest_data
+
+
+def read_manifest(image_file, store=None):
+    '''Return the manifest of 'image_file', without unpacking the image.
+
+    Only the start of the image is read, up to the end of the 'manifest'
+    member, which is usually the first one. If 'store' is an ImageStore,
+    the manifest is cached there, so later calls for the same image don't
+    need to read the image at all. The cache is keyed on the file's stat()
+    details, like ImageStore.image_id(), so the image is never hashed.
+
+    Raises ValueError if the image has no manifest, or it isn't valid.
+
+    '''
+    if store is not None:
+        return store.manifest(image_file)
+    return _read_manifest_member(image_file)
+
+
+def image_digest(image_file):
+    '''Return the image ID of 'image_file', as defined by the App Container spec.
+
+    This is the SHA-512 hash of the image file, prefixed with 'sha512-'.
+
+    '''
+    hasher = hashlib.sha512()
+    with open(image_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return 'sha512-' + hasher.hexdigest()
+
+
+def default_image_store_path():
+    '''Return the default location for an ImageStore.
+
+    This is $SANDBOXLIB_IMAGE_STORE if set, otherwise a 'sandboxlib/images'
+    directory inside $XDG_CACHE_HOME (usually ~/.cache/).
+
+    '''
+    if 'SANDBOXLIB_IMAGE_STORE' in os.environ:
+        return os.environ['SANDBOXLIB_IMAGE_STORE']
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'sandboxlib', 'images')
+
+
+class ImageStore(object):
+    '''Persistent, content-addressed store of unpacked App Container images.
+
+    Each image is unpacked once, into a directory named after its image ID,
+    and the rootfs and manifest are then reused by every later run of the
+    same image. Several processes can share a store safely: entries are
+    unpacked into a temporary directory and renamed into place, and each
+    entry is protected by a lock file which is held (shared) for as long as
+    the entry is in use.
+
+    The unpacked trees are shared between all users of the store, so they
+    must be treated as read-only. Pass filesystem_writable_paths to the
+    executor to enforce this, where the backend supports it.
+
+    If 'max_size' is given, the least recently used entries are deleted
+    when the total size of the unpacked images exceeds 'max_size' bytes.
+    Entries that are in use are never deleted.
+
+    '''
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or default_image_store_path()
+        self.max_size = max_size
+
+        self._images_dir = os.path.join(self.path, 'images')
+        self._digests_dir = os.path.join(self.path, 'digests')
+        self._manifests_dir = os.path.join(self.path, 'manifests')
+        self._tmp_dir = os.path.join(self.path, 'tmp')
+        self._trash_dir = os.path.join(self.path, 'trash')
+
+        for directory in [self._images_dir, self._digests_dir,
+                          self._manifests_dir, self._tmp_dir,
+                          self._trash_dir]:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another process may have created it at the same time.
+                    if not os.path.isdir(directory):
+                        raise
+
+        # Delete anything left behind by processes that exited before they
+        # finished evicting entries.
+        sandboxlib.cleanup.purge_trash(self._trash_dir)
+
+    def _stat_key(self, image_file):
+        # Identifies the current contents of 'image_file' by its device,
+        # inode, size and modification time.
+        st = os.stat(image_file)
+        stat_key = '%i:%i:%i:%s' % (
+            st.st_dev, st.st_ino, st.st_size,
+            getattr(st, 'st_mtime_ns', st.st_mtime))
+        return hashlib.sha1(stat_key.encode('utf-8')).hexdigest()
+
+    def image_id(self, image_file):
+        '''Return the image ID of 'image_file'.
+
+        Hashing a large image takes a while, so the result is remembered,
+        keyed on the device, inode, size and modification time of the file.
+
+        '''
+        digest_path = os.path.join(
+            self._digests_dir, self._stat_key(image_file))
+
+        try:
+            with open(digest_path, 'r') as f:
+                return f.read()
+        except (IOError, OSError):
+            pass
+
+        digest = image_digest(image_file)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._digests_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(digest)
+        os.rename(tmp_path, digest_path)
+
+        return digest
+
+    def manifest(self, image_file):
+        '''Return the manifest of 'image_file', using the cache if possible.
+
+        See read_manifest(). The parsed manifests are kept in the store until
+        it is deleted. They are small, and aren't counted towards 'max_size'.
+        Like the image IDs, they are keyed on the stat() details of the file,
+        so that the image doesn't have to be hashed.
+
+        '''
+        manifest_path = os.path.join(
+            self._manifests_dir, self._stat_key(image_file))
+
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+        manifest_data = _read_manifest_member(image_file)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._manifests_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest_data, f)
+        os.rename(tmp_path, manifest_path)
+
+        return manifest_data
+
+    def _entry_path(self, image_id):
+        return os.path.join(self._images_dir, image_id)
+
+    def _entry_lock_path(self, image_id):
+        return os.path.join(self._images_dir, image_id + '.lock')
+
+    def _unpack_entry(self, image_id, image_file):
+        log = logging.getLogger('sandboxlib')
+        log.info("Unpacking %s into image store %s", image_file, self.path)
+
+        tempdir = tempfile.mkdtemp(dir=self._tmp_dir)
+        try:
+            # FIXME: you gotta be root, sorry.
+            size = sandboxlib.load.extract.extract_tarball(image_file, tempdir)
+
+            with open(os.path.join(tempdir, 'info'), 'w') as f:
+                json.dump({'size': size}, f)
+
+            os.rename(tempdir, self._entry_path(image_id))
+        except:
+            sandboxlib.cleanup.remove_tree(tempdir, trash_dir=self._trash_dir)
+            raise
+
+    @contextlib.contextmanager
+    def unpack(self, image_file):
+        '''Return a context providing the rootfs and manifest of 'image_file'.
+
+        The image is only unpacked if it isn't already in the store.
+
+        '''
+        image_id = self.image_id(image_file)
+        entry_path = self._entry_path(image_id)
+        lock_path = self._entry_lock_path(image_id)
+
+        while True:
+            with sandboxlib.utils.lock_file(lock_path, shared=True):
+                if os.path.isdir(entry_path):
+                    # Mark the entry as recently used, for eviction.
+                    os.utime(entry_path, None)
+
+                    with open(os.path.join(entry_path, 'manifest'), 'r') as f:
+                        manifest_data = json.load(f)
+
+                    yield os.path.join(entry_path, 'rootfs'), manifest_data
+                    break
+
+            with sandboxlib.utils.lock_file(lock_path):
+                # Someone else may have unpacked it while we were waiting.
+                if not os.path.isdir(entry_path):
+                    self._unpack_entry(image_id, image_file)
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def _convert_entry(self, name, image_file, filesystem_type):
+        log = logging.getLogger('sandboxlib')
+        log.info("Converting %s to a %s image in image store %s", image_file,
+                 filesystem_type, self.path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        os.close(fd)
+        try:
+            sandboxlib.load.image.convert_tarball(
+                image_file, tmp_path, filesystem_type=filesystem_type,
+                tmp_dir=self._tmp_dir)
+            os.rename(tmp_path, self._entry_path(name))
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def filesystem_image(self, image_file,
+                         filesystem_type='squashfs'):
+        '''Return a context providing 'image_file' as a filesystem image.
+
+        The first time an image is used this way, it is converted to a
+        squashfs or erofs image (see sandboxlib.load.image.convert_tarball())
+        which is kept in the store. The image contains the 'manifest' and
+        'rootfs' of the App Container image, as the unpacked entries do.
+
+        '''
+        name = '%s.%s' % (self.image_id(image_file), filesystem_type)
+        entry_path = self._entry_path(name)
+        lock_path = self._entry_lock_path(name)
+
+        while True:
+            with sandboxlib.utils.lock_file(lock_path, shared=True):
+                if os.path.isfile(entry_path):
+                    os.utime(entry_path, None)
+                    yield entry_path
+                    break
+
+            with sandboxlib.utils.lock_file(lock_path):
+                if not os.path.isfile(entry_path):
+                    self._convert_entry(name, image_file, filesystem_type)
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def entries(self):
+        '''Return a list of (image ID, size, last used time) for each entry.
+
+        Filesystem images created by filesystem_image() are entries of their
+        own, named after the image ID and the type of filesystem.
+
+        '''
+        result = []
+        for name in os.listdir(self._images_dir):
+            entry_path = self._entry_path(name)
+            try:
+                if os.path.isdir(entry_path):
+                    with open(os.path.join(entry_path, 'info'), 'r') as f:
+                        size = json.load(f)['size']
+                elif name.endswith('.lock'):
+                    continue
+                else:
+                    size = os.stat(entry_path).st_size
+                last_used = os.stat(entry_path).st_mtime
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            result.append((name, size, last_used))
+        return result
+
+    def evict(self, max_size):
+        '''Delete least recently used entries until the store fits 'max_size'.
+
+        Entries which are currently in use by any process are skipped.
+
+        '''
+        log = logging.getLogger('sandboxlib')
+
+        with sandboxlib.utils.lock_file(os.path.join(self.path, 'lock')):
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total_size = sum(size for image_id, size, last_used in entries)
+
+            for image_id, size, last_used in entries:
+                if total_size <= max_size:
+                    break
+
+                lock = sandboxlib.utils.lock_file(
+                    self._entry_lock_path(image_id), blocking=False)
+                with lock as locked:
+                    if not locked:
+                        continue
+
+                    log.info("Evicting %s from image store %s", image_id,
+                             self.path)
+
+                    # The entry is renamed into the trash, so it disappears
+                    # atomically, and is deleted in the background.
+                    sandboxlib.cleanup.remove_tree(
+                        self._entry_path(image_id), trash_dir=self._trash_dir)
+                    total_size -= size
+
+
 @contextlib.contextmanager
-def unpack_app_container_image(image_file):
+def unpack_app_container_image(image_file, store=None):
+    '''Unpack 'image_file', returning a context of (rootfs path, manifest).
+
+    If 'store' is an ImageStore, the unpacked image is kept in the store and
+    reused next time. Otherwise the image is unpacked into a temporary
+    directory, which is deleted when the context exits.
+
+    '''
+    if store is not None:
+        with store.unpack(image_file) as (rootfs_path, manifest_data):
+            yield rootfs_path, manifest_data
+        return
+
     tempdir = tempfile.mkdtemp()
     try:
         # FIXME: you gotta be root, sorry.
-        with tarfile.open(image_file, 'r') as tf:
-            tf.extractall(path=tempdir)
+        sandboxlib.load.extract.extract_tarball(image_file, tempdir)
 
         manifest_path = os.path.join(tempdir, 'manifest')
         rootfs_path = os.path.join(tempdir, 'rootfs')
@@ -51,4 +447,51 @@ def unpack_app_container_image(image_file):
 
         yield rootfs_path, manifest_data
     finally:
-        shutil.rmtree(tempdir)
+        sandboxlib.cleanup.remove_tree(tempdir)
+
+
+@contextlib.contextmanager
+def mount_app_container_image(image_file, store=None, writable_paths=None,
+                              filesystem_type='squashfs'):
+    '''Mount 'image_file', returning a context of (rootfs path, manifest).
+
+    This is an alternative to unpack_app_container_image() which doesn't
+    extract the rootfs. Instead, the image is converted to a squashfs or
+    erofs image, which is mounted read-only, with 'writable_paths' layered
+    on top (see sandboxlib.load.image.writable_layers()).
+
+    If 'store' is an ImageStore, the converted image is kept in the store,
+    so it only needs converting once. Otherwise it is converted into a
+    temporary file, which is deleted when the context exits. Like the rest
+    of sandboxlib.load.image, this needs the 'root' user.
+
+    '''
+    if store is not None:
+        converted_image = store.filesystem_image(
+            image_file, filesystem_type=filesystem_type)
+    else:
+        converted_image = _converted_image(image_file, filesystem_type)
+
+    with converted_image as converted_image_file:
+        mount_context = sandboxlib.load.image.mount_filesystem_image(
+            converted_image_file, filesystem_type=filesystem_type)
+        with mount_context as mount_point:
+            with open(os.path.join(mount_point, 'manifest'), 'r') as f:
+                manifest_data = json.load(f)
+
+            rootfs_path = os.path.join(mount_point, 'rootfs')
+            with sandboxlib.load.image.writable_layers(
+                    rootfs_path, writable_paths):
+                yield rootfs_path, manifest_data
+
+
+@contextlib.contextmanager
+def _converted_image(image_file, filesystem_type):
+    fd, tmp_path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        sandboxlib.load.image.convert_tarball(
+            image_file, tmp_path, filesystem_type=filesystem_type)
+        yield tmp_path
+    finally:
+        os.unlink(tmp_path)
@@ -0,0 +1,450 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Fast extraction of (compressed) tarballs.
+
+Python's 'tarfile' module decompresses the archive and writes out each file
+in turn, all in one thread, so it can use only one CPU core however large the
+archive is. Instead, extract_tarball():
+
+  - decompresses the archive with a multi-threaded program such as 'pigz'
+    or 'xz -T0', if one is installed, falling back to the decompressors in
+    the Python standard library otherwise
+  - reads the archive as a stream, and hands the contents of each file to a
+    pool of writer threads, so reading and writing overlap
+  - creates hardlinks, and applies ownership, permissions and modification
+    times, in a final pass once every file has been written
+
+The result is the same as extracting the archive with tarfile, except that
+ownership is always set from the numeric user and group IDs in the archive,
+as with 'tar --numeric-owner'. The names of the owners are ignored, as they
+refer to the users of the image, not those of the host.
+
+'''
+
+
+import bz2
+import collections
+import errno
+import gzip
+import logging
+import os
+import signal
+import stat
+import tarfile
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+import sandboxlib
+
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+# The first bytes of a file compressed in each format.
+_MAGIC = [
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'\xfd7zXZ\x00', XZ),
+    (b'\x28\xb5\x2f\xfd', ZSTD),
+]
+
+# Programs that can decompress each format to stdout, most preferred first.
+# The file to decompress is appended to the argv.
+DECOMPRESSORS = {
+    GZIP: [['pigz', '-dc'], ['gzip', '-dc']],
+    BZIP2: [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    XZ: [['xz', '-dc', '-T0']],
+    ZSTD: [['zstd', '-dcq']],
+}
+
+# How much of a decompressor program's error output to report.
+_MAX_ERROR_OUTPUT = 4096
+
+# Files larger than this are written by the reading thread, in chunks, so
+# that the data waiting for the writer threads stays small.
+_MAX_QUEUED_FILE_SIZE = 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def compression_format(path):
+    '''Return the compression format of 'path', or None if uncompressed.'''
+    with open(path, 'rb') as f:
+        header = f.read(6)
+    for magic, compression in _MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def decompressor_program(compression):
+    '''Return the argv of a program that can decompress 'compression'.
+
+    Returns None if no suitable program is installed.
+
+    '''
+    for argv in DECOMPRESSORS.get(compression, []):
+        try:
+            program = sandboxlib.utils.find_program(argv[0])
+        except sandboxlib.ProgramNotFound:
+            continue
+        return [program] + argv[1:]
+    return None
+
+
+class _DecompressorOutput(object):
+    # File-like object for the output of a decompressor program.
+
+    def __init__(self, argv):
+        self.argv = argv
+        # The error output explains why a corrupt or truncated archive
+        # couldn't be read. It goes to a file, so that the program can't
+        # block writing it while we read its output.
+        self.errors = tempfile.TemporaryFile()
+        self.process = sandboxlib.spawn.spawn(
+            argv, sandboxlib.CAPTURE, self.errors)
+        self.file = os.fdopen(self.process.stdout, 'rb')
+        self.finished = False
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data and size != 0:
+            self.finished = True
+        return data
+
+    def _error_output(self):
+        self.errors.seek(0, os.SEEK_END)
+        self.errors.seek(max(0, self.errors.tell() - _MAX_ERROR_OUTPUT))
+        return self.errors.read().decode('utf-8', 'replace').strip()
+
+    def close(self):
+        # If we stopped reading early, the program is killed rather than
+        # left blocked on a full pipe. If it had already exited, we probably
+        # stopped because its output ended early, and its errors say why.
+        self.file.close()
+        try:
+            if not self.finished:
+                self.process.kill()
+                if self.process.wait() == -signal.SIGKILL:
+                    return
+            if self.process.wait() != 0:
+                raise RuntimeError("%s failed with exit code %i: %s" % (
+                    sandboxlib.argv_to_string(self.argv),
+                    self.process.returncode, self._error_output()))
+        finally:
+            self.errors.close()
+
+
+def open_decompressed(path):
+    '''Return a file-like object giving the decompressed contents of 'path'.
+
+    A multi-threaded decompressor program is used where possible. The caller
+    must call close() on the result, which raises RuntimeError if the
+    decompressor program failed.
+
+    '''
+    compression = compression_format(path)
+    if compression is None:
+        return open(path, 'rb')
+
+    argv = decompressor_program(compression)
+    if argv is not None:
+        return _DecompressorOutput(argv + [path])
+
+    if compression == GZIP:
+        return gzip.GzipFile(path, 'rb')
+    elif compression == BZIP2:
+        return bz2.BZ2File(path, 'rb')
+    elif compression == XZ:
+        try:
+            import lzma
+        except ImportError:
+            raise RuntimeError(
+                "Unable to decompress %s: no 'xz' program found, and the "
+                "'lzma' module needs Python 3.3 or later." % path)
+        return lzma.LZMAFile(path, 'rb')
+    else:
+        raise RuntimeError(
+            "Unable to decompress %s: no '%s' program found." % (
+                path, compression))
+
+
+def _member_path(root, member):
+    # Like 'tar', we extract absolute paths relative to the root. Names with
+    # '..' in them are refused; _check_parents() deals with symlinks.
+    name = member.name.lstrip('/')
+    if name in ['', '.']:
+        return root
+    parts = name.split('/')
+    if '..' in parts:
+        raise RuntimeError(
+            "Refusing to extract %s, which is outside the target directory."
+            % member.name)
+    return os.path.join(root, *[part for part in parts if part not in
+                                ['', '.']])
+
+
+def _check_parents(root, path, checked):
+    # Refuses to extract anything through a symlink in the tree, which could
+    # point outside it. The directories in 'checked' are known to be real
+    # ones. They can't be replaced by symlinks later on, as extract_tarball()
+    # never removes a directory.
+    directory = os.path.dirname(path)
+    missing = []
+    while directory != root and directory not in checked:
+        try:
+            st = os.lstat(directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            missing.append(directory)
+        else:
+            if not stat.S_ISDIR(st.st_mode):
+                raise RuntimeError(
+                    "Refusing to extract %s, because %s is not a directory."
+                    % (path, directory))
+            checked.add(directory)
+        directory = os.path.dirname(directory)
+
+    for directory in reversed(missing):
+        os.mkdir(directory, 0o700)
+        checked.add(directory)
+
+
+def _open_for_writing(path):
+    # O_NOFOLLOW makes sure that a symlink which has appeared at 'path' isn't
+    # followed out of the tree.
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                   getattr(os, 'O_NOFOLLOW', 0), 0o600)
+
+
+def _write_file(path, data):
+    fd = _open_for_writing(path)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _link(source, target):
+    # If 'source' is a symlink, the link is to the symlink itself, never to
+    # whatever it points at, which may be outside the tree.
+    try:
+        os.link(source, target, follow_symlinks=False)
+    except TypeError:
+        # Python 2, where os.link() calls link(), which doesn't follow
+        # symlinks on Linux.
+        os.link(source, target)
+
+
+def _apply_metadata(path, member, set_owner):
+    # Nothing follows symlinks here, so that a symlink at 'path' can't be
+    # used to change anything outside the tree.
+    if set_owner:
+        os.lchown(path, member.uid, member.gid)
+    if not member.issym():
+        os.chmod(path, member.mode & 0o7777)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+class _WriterPool(object):
+    # Threads that write the contents of files. Errors are saved, and raised
+    # by join(). The paths that are still to be written are tracked, so that
+    # the caller can wait for them before replacing or deleting them.
+
+    def __init__(self, n_threads):
+        self.queue = queue.Queue(maxsize=n_threads * 4)
+        self.errors = []
+        self.pending = collections.defaultdict(int)
+        self.condition = threading.Condition()
+        self.threads = []
+        for i in range(n_threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, function, args = item
+            try:
+                if not self.errors:
+                    function(path, *args)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                with self.condition:
+                    self.pending[path] -= 1
+                    if not self.pending[path]:
+                        del self.pending[path]
+                        self.condition.notify_all()
+
+    def submit(self, path, function, *args):
+        if self.errors:
+            raise self.errors[0]
+        with self.condition:
+            self.pending[path] += 1
+        self.queue.put((path, function, args))
+
+    def wait_for(self, path):
+        # Blocks until nothing is waiting to be written to 'path'.
+        with self.condition:
+            while path in self.pending:
+                self.condition.wait()
+        if self.errors:
+            raise self.errors[0]
+
+    def join(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def default_writer_threads():
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = 4
+    return max(2, min(cpus, 16))
+
+
+def extract_tarball(tarball, path, writer_threads=None):
+    '''Extract 'tarball' into the existing directory 'path'.
+
+    The tarball may be uncompressed, or compressed with gzip, bzip2, xz or
+    zstd. The contents of files are written by 'writer_threads' threads,
+    which defaults to the number of CPUs available, up to 16. Returns the
+    total size of the files in the archive, in bytes.
+
+    '''
+    log = logging.getLogger('sandboxlib')
+    set_owner = os.geteuid() == 0
+    writer_threads = writer_threads or default_writer_threads()
+
+    directories = []
+    # Only the last member with each name counts, as with tarfile.
+    others = collections.OrderedDict()
+    hardlinks = collections.OrderedDict()
+    checked = set()
+    size = 0
+
+    stream = open_decompressed(tarball)
+    try:
+        pool = _WriterPool(writer_threads)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tf:
+                for member in tf:
+                    target = _member_path(path, member)
+                    if target == path:
+                        if member.isdir():
+                            directories.append((target, member))
+                        continue
+                    _check_parents(path, target, checked)
+                    pool.wait_for(target)
+                    others.pop(target, None)
+                    hardlinks.pop(target, None)
+
+                    if member.isdir():
+                        if os.path.islink(target) or \
+                                (os.path.lexists(target) and
+                                 not os.path.isdir(target)):
+                            os.unlink(target)
+                        if not os.path.isdir(target):
+                            os.mkdir(target, 0o700)
+                        checked.add(target)
+                        directories.append((target, member))
+                        continue
+
+                    if os.path.lexists(target) and not member.islnk():
+                        os.unlink(target)
+
+                    if member.isreg():
+                        size += member.size
+                        source = tf.extractfile(member)
+                        if member.size <= _MAX_QUEUED_FILE_SIZE:
+                            pool.submit(target, _write_file, source.read())
+                        else:
+                            fd = _open_for_writing(target)
+                            with os.fdopen(fd, 'wb') as f:
+                                for chunk in iter(
+                                        lambda: source.read(_CHUNK_SIZE), b''):
+                                    f.write(chunk)
+                    elif member.islnk():
+                        hardlinks[target] = member
+                        continue
+                    elif member.issym():
+                        os.symlink(member.linkname, target)
+                    elif member.ischr() or member.isblk():
+                        device_type = stat.S_IFCHR if member.ischr() \
+                            else stat.S_IFBLK
+                        os.mknod(target, device_type | 0o600,
+                                 os.makedev(member.devmajor, member.devminor))
+                    elif member.isfifo():
+                        os.mkfifo(target, 0o600)
+                    else:
+                        log.warning("Skipping %s in %s, which is of an "
+                                    "unsupported type.", member.name, tarball)
+                        continue
+                    others[target] = member
+
+            # Reading to the end makes sure that the whole archive was
+            # decompressed successfully, not just the part that tarfile read.
+            while stream.read(_CHUNK_SIZE):
+                pass
+        finally:
+            pool.join()
+    finally:
+        stream.close()
+
+    # Hard links may refer to files that were still being written above.
+    for target, member in hardlinks.items():
+        source = _member_path(path, tarfile.TarInfo(member.linkname))
+        _check_parents(path, source, checked)
+        _check_parents(path, target, checked)
+        if stat.S_ISDIR(os.lstat(source).st_mode):
+            raise RuntimeError(
+                "Refusing to extract %s, which is a hard link to the "
+                "directory %s." % (member.name, member.linkname))
+        if os.path.lexists(target):
+            os.unlink(target)
+        _link(source, target)
+
+    for target, member in others.items():
+        _apply_metadata(target, member, set_owner)
+
+    # Directories go last, deepest first, so that writing their contents
+    # doesn't change their modification times, and read-only directories
+    # are filled before they become read-only.
+    for target, member in reversed(directories):
+        _apply_metadata(target, member, set_owner)
+
+    return size
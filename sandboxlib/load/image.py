@@ -0,0 +1,263 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Sandbox loader module for filesystem images.
+
+Rather than extracting a tarball, a squashfs or erofs image can be mounted
+read-only and used as 'filesystem_root' directly. Nothing is copied, so the
+time taken to set up the sandbox doesn't depend on the size of the image,
+and sandboxes that use the same image share its pages in the page cache.
+
+The image is mounted through a loop device, which needs the 'root' user.
+The mount is made in the calling process's mount namespace, so the mounted
+tree can be used with any backend, but only the 'chroot' backend can be
+expected to be usable by the same user. The paths that should be writable
+are covered with a tmpfs, or with a bind mount of a host directory.
+
+This module only works on Linux.
+
+'''
+
+
+import contextlib
+import errno
+import fcntl
+import os
+import struct
+import tempfile
+
+import sandboxlib
+
+
+SQUASHFS = 'squashfs'
+EROFS = 'erofs'
+
+# ioctl() requests for loop devices, from <linux/loop.h>.
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+
+# struct loop_info64, from <linux/loop.h>. Only 'lo_flags' is set.
+_LOOP_INFO64_FORMAT = '=QQQQQIIII64s64s32sQQ'
+
+
+def filesystem_image_type(path):
+    '''Return the type of the filesystem image at 'path', if it is one.
+
+    The result is SQUASHFS, EROFS, or None if 'path' isn't an image of a
+    type that this module knows about.
+
+    '''
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(1028)
+    except (IOError, OSError):
+        return None
+
+    if header[0:4] == b'hsqs':
+        return SQUASHFS
+    if header[1024:1028] == struct.pack('<I', 0xE0F5E1E2):
+        return EROFS
+    return None
+
+
+def is_filesystem_image(path):
+    return filesystem_image_type(path) is not None
+
+
+def _attach_loop_device(fd):
+    # Returns the path of a loop device for the image open as 'fd'. Another
+    # process may take the free device before we do, in which case we try
+    # again with the next one.
+    control = os.open('/dev/loop-control', os.O_RDWR | os.O_CLOEXEC)
+    try:
+        while True:
+            number = fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+            device_path = '/dev/loop%i' % number
+            device = os.open(device_path, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                fcntl.ioctl(device, LOOP_SET_FD, fd)
+            except (IOError, OSError) as e:
+                os.close(device)
+                if e.errno == errno.EBUSY:
+                    continue
+                raise
+            return device_path, device
+    finally:
+        os.close(control)
+
+
+@contextlib.contextmanager
+def loop_device(image_file):
+    '''Attach 'image_file' to a read-only loop device, yielding its path.
+
+    The loop device is set to detach itself once nothing is using it, so a
+    filesystem that was mounted from it in the context stays mounted after
+    the context exits. The device is freed when that filesystem is unmounted.
+
+    '''
+    fd = os.open(image_file, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        try:
+            device_path, device = _attach_loop_device(fd)
+        except (IOError, OSError) as e:
+            raise RuntimeError(
+                "Unable to set up a loop device for %s: %s" % (image_file, e))
+    finally:
+        os.close(fd)
+
+    try:
+        info = struct.pack(
+            _LOOP_INFO64_FORMAT, 0, 0, 0, 0, 0, 0, 0, 0,
+            LO_FLAGS_READ_ONLY | LO_FLAGS_AUTOCLEAR, b'', b'', b'', 0, 0)
+        try:
+            fcntl.ioctl(device, LOOP_SET_STATUS64, info)
+        except (IOError, OSError) as e:
+            fcntl.ioctl(device, LOOP_CLR_FD, 0)
+            raise RuntimeError(
+                "Unable to set up a loop device for %s: %s" % (image_file, e))
+
+        yield device_path
+    finally:
+        os.close(device)
+
+
+@contextlib.contextmanager
+def mount_filesystem_image(image_file, mount_point=None,
+                           filesystem_type=None):
+    '''Mount 'image_file' read-only, yielding the path it is mounted at.
+
+    If 'mount_point' is None, a temporary directory is created for it, and
+    removed again when the context exits. The type of the image is found
+    with filesystem_image_type() if 'filesystem_type' isn't given.
+
+    '''
+    if filesystem_type is None:
+        filesystem_type = filesystem_image_type(image_file)
+        if filesystem_type is None:
+            raise RuntimeError(
+                "%s is not a squashfs or erofs image." % image_file)
+
+    tempdir = None
+    if mount_point is None:
+        mount_point = tempdir = tempfile.mkdtemp()
+
+    try:
+        with loop_device(image_file) as device_path:
+            try:
+                sandboxlib.libc.mount(
+                    device_path, mount_point, filesystem_type,
+                    sandboxlib.libc.MS_RDONLY | sandboxlib.libc.MS_NODEV)
+            except OSError as e:
+                raise RuntimeError(
+                    "Unable to mount %s on %s (type %s): %s" % (
+                        image_file, mount_point, filesystem_type, e))
+
+        try:
+            yield mount_point
+        finally:
+            sandboxlib.chroot.unmount(mount_point, lazy=True)
+    finally:
+        if tempdir is not None:
+            os.rmdir(tempdir)
+
+
+@contextlib.contextmanager
+def writable_layers(root, writable_paths):
+    '''Make each of 'writable_paths' inside 'root' writable.
+
+    Each entry of 'writable_paths' is either a path, which is covered with
+    an empty tmpfs, or a tuple of (path, host directory), in which case the
+    host directory is bind-mounted there. The paths are relative to 'root',
+    and must already exist in it, as 'root' is expected to be read-only.
+    Everything is unmounted when the context exits.
+
+    '''
+    mount_info_list = []
+    for entry in writable_paths or []:
+        if isinstance(entry, tuple):
+            path, source = entry
+            mount_info_list.append((source, path, None, 'bind'))
+        else:
+            path = entry
+            mount_info_list.append((None, path, 'tmpfs', None))
+
+        if not os.path.isdir(os.path.join(root, os.path.relpath(path, '/'))):
+            raise RuntimeError(
+                "Writable path %s must be a directory that exists in the "
+                "image." % path)
+
+    with sandboxlib.chroot.mount_all(root, mount_info_list, lazy_unmount=True):
+        yield root
+
+
+@contextlib.contextmanager
+def mount_image_as_root(image_file, writable_paths=None):
+    '''Mount 'image_file' to use as a 'filesystem_root', yielding its path.
+
+    The image is mounted read-only, with 'writable_paths' layered on top as
+    described for writable_layers(). Pass filesystem_writable_paths='all' to
+    the executor, as the read-only parts of the tree are enforced by the
+    mount itself.
+
+    '''
+    with mount_filesystem_image(image_file) as mount_point:
+        with writable_layers(mount_point, writable_paths) as root:
+            yield root
+
+
+def convert_tree(path, image_file, filesystem_type=SQUASHFS):
+    '''Create a filesystem image at 'image_file' from the directory 'path'.
+
+    This uses the 'mksquashfs' or 'mkfs.erofs' program, which must be
+    installed. Ownership and permissions are kept as they are in 'path'.
+
+    '''
+    if filesystem_type == SQUASHFS:
+        argv = [sandboxlib.utils.find_program('mksquashfs'), path,
+                image_file, '-noappend']
+    elif filesystem_type == EROFS:
+        argv = [sandboxlib.utils.find_program('mkfs.erofs'), image_file,
+                path]
+    else:
+        raise AssertionError(
+            "Unsupported filesystem image type '%s'" % filesystem_type)
+
+    exit, out, err = sandboxlib._run_command(
+        argv, stdout=sandboxlib.CAPTURE, stderr=sandboxlib.STDOUT)
+    if exit != 0:
+        raise RuntimeError("%s failed: %s" % (
+            argv, out.decode('utf-8', 'replace')))
+
+
+def convert_tarball(tarball, image_file, filesystem_type=SQUASHFS,
+                    tmp_dir=None):
+    '''Create a filesystem image at 'image_file' from the contents of a tar.
+
+    The tarball is extracted into a temporary directory inside 'tmp_dir',
+    which is deleted once the image has been created.
+
+    '''
+    tempdir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        # FIXME: you gotta be root, sorry.
+        sandboxlib.load.extract.extract_tarball(tarball, tempdir)
+        convert_tree(tempdir, image_file, filesystem_type=filesystem_type)
+    finally:
+        sandboxlib.cleanup.remove_tree(tempdir)
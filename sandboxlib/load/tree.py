@@ -0,0 +1,94 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Sandbox loader module for directory trees and plain tarballs.
+
+A sandbox doesn't need to be packed into an App Container image to be run.
+A directory can be used as 'filesystem_root' as it is, and a tarball of a
+root filesystem can be extracted straight into a temporary directory. The
+manifest, if there is one, can be given separately.
+
+A directory with the layout of an unpacked App Container image, that is a
+'manifest' file next to a 'rootfs' directory, is also recognised.
+
+'''
+
+
+import contextlib
+import os
+import tarfile
+import tempfile
+
+import sandboxlib
+
+
+def is_app_container_directory(path):
+    '''Return True if 'path' is a directory with a 'manifest' and 'rootfs'.'''
+    return os.path.isfile(os.path.join(path, 'manifest')) and \
+        os.path.isdir(os.path.join(path, 'rootfs'))
+
+
+def is_tarball(path):
+    '''Return True if 'path' looks like a tarball, compressed or not.'''
+    if not os.path.isfile(path):
+        return False
+    if sandboxlib.load.extract.compression_format(path) is not None:
+        return True
+    return tarfile.is_tarfile(path)
+
+
+@contextlib.contextmanager
+def open_directory(path, manifest_file=None):
+    '''Return a context of (rootfs path, manifest) for the directory 'path'.
+
+    If 'path' has the layout of an unpacked App Container image, its rootfs
+    and manifest are used, unless 'manifest_file' is given. Otherwise 'path'
+    is the rootfs, and the manifest is read from 'manifest_file', or is None
+    if that isn't given. Nothing is copied.
+
+    '''
+    if is_app_container_directory(path):
+        rootfs_path = os.path.join(path, 'rootfs')
+        manifest_file = manifest_file or os.path.join(path, 'manifest')
+    else:
+        rootfs_path = path
+
+    manifest_data = None
+    if manifest_file is not None:
+        manifest_data = sandboxlib.load.appc.load_manifest(manifest_file)
+
+    yield rootfs_path, manifest_data
+
+
+@contextlib.contextmanager
+def unpack_tarball(tarball, manifest_file=None):
+    '''Return a context of (rootfs path, manifest) for a rootfs tarball.
+
+    The tarball is extracted into a temporary directory, which becomes the
+    rootfs, and is deleted when the context exits. The manifest is read from
+    'manifest_file', or is None if that isn't given.
+
+    '''
+    manifest_data = None
+    if manifest_file is not None:
+        manifest_data = sandboxlib.load.appc.load_manifest(manifest_file)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        # FIXME: you gotta be root, sorry.
+        sandboxlib.load.extract.extract_tarball(tarball, tempdir)
+        yield tempdir, manifest_data
+    finally:
+        sandboxlib.cleanup.remove_tree(tempdir)
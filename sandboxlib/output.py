@@ -0,0 +1,117 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Consumers for streaming the output of a sandboxed command.
+
+Any callable can be passed as the 'stdout' or 'stderr' parameter of
+run_sandbox(). It is called with each chunk of output as a 'bytes' object,
+as soon as the chunk is read, and then once with b'' when the stream is
+closed. The output is not kept anywhere else, so memory use doesn't grow
+with the size of the output.
+
+Output is only read from the subprocess when the previous call to the
+consumer has returned, so a slow consumer applies backpressure: once the
+pipe buffer is full, the subprocess blocks until the consumer catches up.
+
+The classes here provide some common kinds of consumer.
+
+'''
+
+
+import collections
+
+
+class TailBuffer(object):
+    '''Keep the last 'max_size' bytes of output in memory.
+
+    If 'spill_file' is given, all of the output is also written to that file
+    object, which must be open in binary mode.
+
+    '''
+
+    def __init__(self, max_size=65536, spill_file=None):
+        self.max_size = max_size
+        self.spill_file = spill_file
+        self.total_size = 0
+
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def __call__(self, data):
+        if self.spill_file is not None:
+            self.spill_file.write(data)
+        if not data:
+            return
+
+        self.total_size += len(data)
+
+        if len(data) >= self.max_size:
+            self._chunks.clear()
+            self._chunks.append(data[len(data) - self.max_size:])
+            self._size = self.max_size
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.max_size:
+            self._size -= len(self._chunks.popleft())
+
+    @property
+    def truncated(self):
+        '''True if some output has been dropped from the buffer.'''
+        return self.total_size > self.max_size
+
+    def getvalue(self):
+        '''Return the last 'max_size' bytes of output.'''
+        data = b''.join(self._chunks)
+        return data[max(0, len(data) - self.max_size):]
+
+
+class LineSplitter(object):
+    '''Call 'callback' with each line of output.
+
+    Each line is passed with its trailing newline. When the stream is closed,
+    any incomplete last line is passed without one. Lines longer than
+    'max_line_length' bytes are passed in pieces of that size, so that a
+    command that never writes a newline can't use unbounded memory.
+
+    '''
+
+    def __init__(self, callback, max_line_length=65536):
+        self.callback = callback
+        self.max_line_length = max_line_length
+
+        self._partial = b''
+
+    def __call__(self, data):
+        if not data:
+            if self._partial:
+                self.callback(self._partial)
+                self._partial = b''
+            return
+
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._emit(line + b'\n')
+        while len(self._partial) >= self.max_line_length:
+            self.callback(self._partial[:self.max_line_length])
+            self._partial = self._partial[self.max_line_length:]
+
+    def _emit(self, line):
+        while len(line) > self.max_line_length:
+            self.callback(line[:self.max_line_length])
+            line = line[self.max_line_length:]
+        self.callback(line)
@@ -0,0 +1,154 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Copy-on-write sandbox filesystems, using Linux overlayfs.
+
+An Overlay can be passed as 'filesystem_root' instead of a path. The sandbox
+then sees the 'lower' tree, but anything the command writes goes into a
+separate 'upper' directory, so the lower tree is never changed. This makes
+it safe to share one unpacked image between many sandboxes without copying
+it for each one.
+
+By default the upper directory is inside a tmpfs that is created for each
+sandbox, and the changes are thrown away by unmounting it, however many
+files were written. If a 'changes' directory is given instead, the changes
+are kept in 'changes/upper', where they can be inspected after the command
+has finished. Files that were deleted appear there as 'whiteouts', as
+described in the kernel's overlayfs documentation.
+
+Overlays are supported by the 'chroot' backend, which needs root, and by the
+'linux_namespaces' backend. Users other than root need a kernel that allows
+overlayfs to be mounted in a user namespace (Linux 5.11 or later), and the
+files in the lower tree must belong to them, or they can't be changed.
+
+'''
+
+
+import os
+import tempfile
+
+import sandboxlib
+from sandboxlib import libc
+
+
+class Overlay(object):
+    '''A copy-on-write view of 'lower', for use as 'filesystem_root'.
+
+    The 'lower' parameter is a directory, or a list of directories which are
+    stacked with the first one on top. If 'changes' is given, it is a
+    directory in which 'upper' and 'work' subdirectories are created for
+    overlayfs, and changes made by sandboxes that use the same directory
+    accumulate there. Otherwise they are discarded when each sandbox is
+    torn down.
+
+    '''
+
+    def __init__(self, lower, changes=None):
+        if isinstance(lower, (list, tuple)):
+            self.lower = [os.path.realpath(path) for path in lower]
+        else:
+            self.lower = [os.path.realpath(lower)]
+        self.changes = os.path.realpath(changes) if changes else None
+
+        for path in self.lower + [self.changes or '']:
+            # These characters separate the overlayfs mount options.
+            assert ',' not in path and ':' not in path, \
+                "Overlay paths may not contain ',' or ':'. Got '%s'" % path
+
+    def __repr__(self):
+        return '<Overlay %s>' % ':'.join(self.lower)
+
+    @property
+    def upper(self):
+        '''The directory holding the changes, or None if they are discarded.'''
+        if self.changes is None:
+            return None
+        return os.path.join(self.changes, 'upper')
+
+    def discard_changes(self):
+        '''Delete the changes kept in the 'changes' directory, if any.'''
+        if self.changes is None:
+            return
+        for name in ['upper', 'work']:
+            path = os.path.join(self.changes, name)
+            if os.path.exists(path):
+                sandboxlib.cleanup.remove_tree(path)
+
+
+def is_overlay(filesystem_root):
+    return isinstance(filesystem_root, Overlay)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def mount_overlay(overlay, path, user_namespace=False):
+    '''Mount 'overlay' using the empty directory 'path'.
+
+    Returns a list of the mount points that were created, in the order they
+    were mounted. The last one is the root of the overlay. If the changes
+    are discarded, 'path' is a tmpfs which contains the upper directory and
+    the root of the overlay. Otherwise the overlay is mounted on 'path'.
+
+    If 'user_namespace' is True, overlayfs keeps its own extended attributes
+    in the 'user.overlay.' namespace, as it must do when the calling process
+    is in a user namespace.
+
+    '''
+    mounted = []
+
+    try:
+        if overlay.changes is None:
+            libc.mount('tmpfs', path, 'tmpfs', 0, 'mode=0755')
+            mounted.append(path)
+            changes_dir = path
+            root = os.path.join(path, 'root')
+            os.mkdir(root)
+        else:
+            changes_dir = overlay.changes
+            root = path
+
+        upper = os.path.join(changes_dir, 'upper')
+        work = os.path.join(changes_dir, 'work')
+        _makedirs(upper)
+        _makedirs(work)
+
+        # The root of the overlay takes its ownership and permissions from
+        # the upper directory.
+        lower_st = os.stat(overlay.lower[0])
+        os.chmod(upper, lower_st.st_mode & 0o7777)
+        if os.geteuid() == 0:
+            os.chown(upper, lower_st.st_uid, lower_st.st_gid)
+
+        options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+            ':'.join(overlay.lower), upper, work)
+        if user_namespace:
+            options += ',userxattr'
+        libc.mount('overlay', root, 'overlay', 0, options)
+        mounted.append(root)
+    except OSError as e:
+        for mount_point in reversed(mounted):
+            libc.umount2(mount_point, libc.MNT_DETACH)
+        raise RuntimeError("Unable to mount overlay of %s: %s" % (
+            ':'.join(overlay.lower), e))
+
+    return mounted
+
+
+def overlay_mount_point():
+    '''Return a new empty directory, on which an overlay can be mounted.'''
+    return tempfile.mkdtemp(prefix='sandboxlib-overlay-')
@@ -0,0 +1,283 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Run many sandboxed commands in parallel.
+
+Each command is described by a Job. Jobs can depend on other jobs, in which
+case they are only started once those have succeeded. A SandboxPool runs as
+many jobs at once as the available CPUs and memory allow, and returns each
+job as it finishes.
+
+The jobs are run with the run_sandbox_async() function of their backend, from
+an asyncio event loop that runs in the calling thread while the caller waits
+for the next job to finish. No threads are used.
+
+This module needs Python 3.5 or later. It isn't imported on older versions.
+
+'''
+
+
+import asyncio
+import collections
+import os
+
+import sandboxlib
+
+
+# Job states.
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+
+
+def available_cpus():
+    '''Return the number of CPUs that the calling process may run on.'''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory():
+    '''Return the number of bytes of memory available, or None if unknown.
+
+    This is the 'MemAvailable' value from /proc/meminfo, which is the Linux
+    kernel's estimate of how much memory can be used without swapping.
+
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class Job(object):
+    '''A command to run in a sandbox, as part of a SandboxPool.
+
+    The 'command' and 'sandbox_config' parameters are passed to the
+    run_sandbox_async() function of 'executor'. If 'executor' is None, the
+    pool's executor is used.
+
+    The job is only started once every job in 'depends' has succeeded. If
+    one of them fails, this job is skipped.
+
+    The 'cpus' and 'memory' parameters give the number of CPUs and bytes of
+    memory that the job is expected to use, which the pool uses to decide
+    how many jobs to run at once.
+
+    Once the job is finished, 'state' is one of SUCCEEDED, FAILED, SKIPPED
+    or CANCELLED. The 'result' attribute holds the SandboxResult, if the
+    command was run, and 'error' holds the exception if running it raised
+    one. A job fails if the command exits with a non-zero exit code, or if
+    running it raises an exception.
+
+    '''
+
+    def __init__(self, command, name=None, depends=None, executor=None,
+                 cpus=1, memory=None, **sandbox_config):
+        self.command = command
+        self.name = name if name is not None else \
+            sandboxlib.argv_to_string(
+                [command] if type(command) == str else command)
+        self.depends = list(depends or [])
+        self.executor = executor
+        self.cpus = cpus
+        self.memory = memory or 0
+        self.sandbox_config = sandbox_config
+
+        self.state = PENDING
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Job %s (%s)>' % (self.name, self.state)
+
+    @property
+    def finished(self):
+        return self.state not in [PENDING, RUNNING]
+
+
+def _check_dependencies(jobs):
+    # Raise ValueError if a job depends on a job that isn't in the list, or
+    # if there is a cycle in the dependencies.
+    job_set = set(jobs)
+    visited = set()
+    in_progress = set()
+
+    def visit(job):
+        if job in visited:
+            return
+        if job in in_progress:
+            raise ValueError("Job %s depends on itself." % job.name)
+        in_progress.add(job)
+        for dependency in job.depends:
+            if dependency not in job_set:
+                raise ValueError(
+                    "Job %s depends on job %s, which is not in the list of "
+                    "jobs to run." % (job.name, dependency.name))
+            visit(dependency)
+        in_progress.remove(job)
+        visited.add(job)
+
+    for job in jobs:
+        visit(job)
+
+
+class SandboxPool(object):
+    '''Run many Jobs, with a limit on how many run at once.
+
+    At most 'max_cpus' CPUs' worth of jobs run at once, and the 'memory' of
+    the running jobs adds up to at most 'max_memory' bytes. The defaults are
+    the CPUs and memory available when the pool is created. A job that needs
+    more than the limit on its own is run when no other jobs are running.
+
+    Jobs that don't set an executor use 'executor', which defaults to the one
+    chosen by sandboxlib.executor_for_platform().
+
+    If 'keep_going' is False, the first job to fail causes every running job
+    to be killed, and no more to be started. Otherwise, only the jobs that
+    depend on a failed job are skipped.
+
+    '''
+
+    def __init__(self, executor=None, max_cpus=None, max_memory=None,
+                 keep_going=False):
+        self.executor = executor or sandboxlib.executor_for_platform()
+        self.max_cpus = max_cpus or available_cpus()
+        self.max_memory = max_memory if max_memory is not None else \
+            available_memory()
+        self.keep_going = keep_going
+
+    def run(self, jobs):
+        '''Run 'jobs', returning an iterator of the jobs as they finish.
+
+        Every job is returned exactly once, including jobs that were skipped
+        or cancelled. If the iterator isn't used to the end, any jobs that are
+        still running when it is closed or garbage collected are killed.
+
+        '''
+        jobs = list(jobs)
+        _check_dependencies(jobs)
+        return self._run(jobs)
+
+    def _fits(self, job, cpus_in_use, memory_in_use, n_running):
+        if n_running == 0:
+            return True
+        if cpus_in_use + job.cpus > self.max_cpus:
+            return False
+        if self.max_memory is not None and \
+                memory_in_use + job.memory > self.max_memory:
+            return False
+        return True
+
+    def _start(self, loop, job):
+        executor = job.executor or self.executor
+        job.state = RUNNING
+        return loop.create_task(
+            executor.run_sandbox_async(job.command, **job.sandbox_config))
+
+    def _finish(self, job, task):
+        try:
+            job.result = task.result()
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+            return
+        except Exception as e:
+            job.error = e
+            job.state = FAILED
+            return
+        job.state = SUCCEEDED if job.result.exit == 0 else FAILED
+
+    def _run(self, jobs):
+        loop = asyncio.new_event_loop()
+        pending = collections.OrderedDict((job, None) for job in jobs)
+        running = {}
+        stopping = False
+
+        try:
+            while pending or running:
+                cpus_in_use = sum(job.cpus for job in running.values())
+                memory_in_use = sum(job.memory for job in running.values())
+
+                for job in list(pending):
+                    if stopping:
+                        job.state = CANCELLED
+                    elif any(dependency.state in [FAILED, SKIPPED, CANCELLED]
+                             for dependency in job.depends):
+                        job.state = SKIPPED
+                    elif all(dependency.state == SUCCEEDED
+                             for dependency in job.depends) and \
+                            self._fits(job, cpus_in_use, memory_in_use,
+                                       len(running)):
+                        running[self._start(loop, job)] = job
+                        cpus_in_use += job.cpus
+                        memory_in_use += job.memory
+                        del pending[job]
+                        continue
+                    else:
+                        continue
+
+                    del pending[job]
+                    yield job
+
+                if not running:
+                    continue
+
+                done, _ = loop.run_until_complete(asyncio.wait(
+                    list(running), return_when=asyncio.FIRST_COMPLETED))
+
+                for task in done:
+                    job = running.pop(task)
+                    self._finish(job, task)
+                    if job.state == FAILED and not self.keep_going:
+                        stopping = True
+                    yield job
+
+                if stopping and running:
+                    for task in running:
+                        task.cancel()
+                    loop.run_until_complete(asyncio.wait(list(running)))
+                    for task, job in list(running.items()):
+                        del running[task]
+                        self._finish(job, task)
+                        yield job
+        finally:
+            if running:
+                for task in running:
+                    task.cancel()
+                loop.run_until_complete(asyncio.wait(list(running)))
+                for task, job in running.items():
+                    self._finish(job, task)
+            loop.close()
+
+
+def run_many(jobs, executor=None, max_cpus=None, max_memory=None,
+             keep_going=False):
+    '''Run 'jobs' in a SandboxPool, returning an iterator of finished jobs.
+
+    This is a shortcut for SandboxPool(...).run(jobs). The 'jobs' can be Job
+    instances, or lists of commands to run with the default configuration.
+
+    '''
+    jobs = [job if isinstance(job, Job) else Job(job) for job in jobs]
+    pool = SandboxPool(executor=executor, max_cpus=max_cpus,
+                       max_memory=max_memory, keep_going=keep_going)
+    return pool.run(jobs)
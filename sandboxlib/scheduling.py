@@ -0,0 +1,266 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''CPU, memory and I/O scheduling of sandboxed commands.
+
+The 'scheduling' parameter of run_sandbox() is a dict, which can contain:
+
+  - cpus: a list of the CPUs that the command may run on. See
+        sched_setaffinity(2).
+  - memory_nodes: a list of the NUMA nodes that the command should allocate
+        memory from, when they have memory free. See set_mempolicy(2).
+  - nice: the nice value of the command, from -20 (the highest priority)
+        to 19 (the lowest). Only root can lower it. See setpriority(2).
+  - io_class: the I/O scheduling class of the command: 'realtime',
+        'best-effort' or 'idle'. Only root can use 'realtime'. See
+        ioprio_set(2).
+  - io_priority: the priority within the I/O scheduling class, from 0 (the
+        highest) to 7 (the lowest). The class defaults to 'best-effort'.
+
+These are set in the child process before the backend sets up the sandbox,
+and every process that the command starts inherits them. They need Linux.
+
+When several sandboxes run at once, each of them can be given a share of
+the CPUs, as returned by split_cpus(). On hosts with more than one NUMA
+node this keeps each sandbox on as few nodes as possible, along with its
+memory.
+
+'''
+
+
+import functools
+import multiprocessing
+import os
+
+import sandboxlib
+from sandboxlib import libc
+
+
+SCHEDULING_OPTIONS = ['cpus', 'memory_nodes', 'nice', 'io_class',
+                      'io_priority']
+
+IO_CLASSES = {
+    'realtime': libc.IOPRIO_CLASS_RT,
+    'best-effort': libc.IOPRIO_CLASS_BE,
+    'idle': libc.IOPRIO_CLASS_IDLE,
+}
+
+_NODE_DIR = '/sys/devices/system/node'
+
+
+def parse_cpu_list(text):
+    '''Return the numbers in a list such as '0-3,8-11', as a sorted list.
+
+    This is the format of the files in /sys/devices/system/cpu/ and
+    /sys/devices/system/node/.
+
+    '''
+    numbers = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        numbers.update(range(int(first), int(last or first) + 1))
+    return sorted(numbers)
+
+
+def available_cpus():
+    '''Return a sorted list of the CPUs the calling process may run on.'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        return list(range(multiprocessing.cpu_count()))
+    except NotImplementedError:
+        return [0]
+
+
+def numa_nodes():
+    '''Return a dict mapping each NUMA node to a sorted list of its CPUs.
+
+    The dict is empty if the kernel doesn't report any NUMA nodes.
+
+    '''
+    nodes = {}
+    try:
+        names = os.listdir(_NODE_DIR)
+    except OSError:
+        return nodes
+    for name in names:
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        try:
+            with open(os.path.join(_NODE_DIR, name, 'cpulist'), 'r') as f:
+                nodes[int(name[4:])] = parse_cpu_list(f.read())
+        except (IOError, OSError, ValueError):
+            continue
+    return nodes
+
+
+def split_cpus(count, cpus=None):
+    '''Share 'cpus' out evenly between 'count' sandboxes.
+
+    Returns a list of 'count' dicts, each suitable as the 'scheduling'
+    parameter of run_sandbox() or as a starting point for it. Each gives a
+    sandbox its share of the CPUs, and the NUMA nodes those CPUs belong to
+    as its 'memory_nodes' if the host has more than one. The CPUs are those
+    that the calling process may run on, unless 'cpus' is given.
+
+    If 'count' is a multiple of the number of NUMA nodes that the CPUs
+    belong to, each node's CPUs are split between the same number of
+    sandboxes, so no sandbox spans more than one node. Otherwise the CPUs
+    are split in order, which keeps each node's CPUs together but may give
+    some sandboxes CPUs from two nodes. If there are more sandboxes than
+    CPUs, the CPUs are shared.
+
+    '''
+    assert count > 0, "Can't split CPUs between %i sandboxes." % count
+
+    cpus = sorted(set(cpus if cpus is not None else available_cpus()))
+    assert cpus, "No CPUs to split between sandboxes."
+
+    node_of_cpu = {}
+    nodes = numa_nodes()
+    for node, node_cpus in nodes.items():
+        for cpu in node_cpus:
+            node_of_cpu[cpu] = node
+
+    # CPUs that aren't in any node are treated as a node of their own.
+    groups = {}
+    for cpu in cpus:
+        groups.setdefault(node_of_cpu.get(cpu, -1), []).append(cpu)
+
+    if count % len(groups) == 0:
+        shares = []
+        for node in sorted(groups):
+            shares.extend(_split(groups[node], count // len(groups)))
+    else:
+        cpus.sort(key=lambda cpu: (node_of_cpu.get(cpu, -1), cpu))
+        shares = _split(cpus, count)
+
+    result = []
+    for share in shares:
+        scheduling = {'cpus': sorted(share)}
+        if len(nodes) > 1:
+            scheduling['memory_nodes'] = sorted(set(
+                node_of_cpu[cpu] for cpu in share if cpu in node_of_cpu))
+        result.append(scheduling)
+    return result
+
+
+def _split(cpus, count):
+    # Split the list 'cpus' into 'count' runs of about the same length.
+    if count <= len(cpus):
+        return [cpus[i * len(cpus) // count:(i + 1) * len(cpus) // count]
+                for i in range(count)]
+    return [[cpus[i % len(cpus)]] for i in range(count)]
+
+
+def check_scheduling(scheduling):
+    '''Check the contents of a 'scheduling' dict, raising AssertionError.'''
+    assert isinstance(scheduling, dict), \
+        "The 'scheduling' parameter must be a dict. Got %r" % (scheduling,)
+    for name in scheduling:
+        sandboxlib.utils.check_parameter(
+            'scheduling', name, SCHEDULING_OPTIONS)
+
+    for name in ['cpus', 'memory_nodes']:
+        if scheduling.get(name) is not None:
+            assert len(scheduling[name]) > 0, \
+                "'%s' must not be empty." % name
+    if scheduling.get('nice') is not None:
+        assert -20 <= scheduling['nice'] <= 19, \
+            "'nice' must be between -20 and 19. Got %s" % scheduling['nice']
+    if scheduling.get('io_class') is not None:
+        sandboxlib.utils.check_parameter(
+            'io_class', scheduling['io_class'], sorted(IO_CLASSES))
+    if scheduling.get('io_priority') is not None:
+        assert 0 <= scheduling['io_priority'] <= 7, \
+            "'io_priority' must be between 0 and 7. Got %s" % \
+            scheduling['io_priority']
+
+
+def _set_memory_nodes(nodes):
+    nodes = sorted(set(nodes))
+    if len(nodes) > 1:
+        try:
+            libc.set_mempolicy(libc.MPOL_PREFERRED_MANY, nodes)
+            return
+        except OSError:
+            # Linux < 5.15 can only prefer a single node.
+            pass
+    libc.set_mempolicy(libc.MPOL_PREFERRED, nodes[:1])
+
+
+def _apply_scheduling(scheduling, child_setup):
+    # This runs in the child process, so everything set here is inherited
+    # by the command and any processes it starts.
+    memory_nodes = scheduling.get('memory_nodes')
+    if memory_nodes is not None:
+        try:
+            _set_memory_nodes(memory_nodes)
+        except OSError as e:
+            raise RuntimeError("Unable to prefer memory from NUMA nodes %s: "
+                               "%s" % (memory_nodes, e))
+
+    cpus = scheduling.get('cpus')
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            raise RuntimeError("Unable to set CPU affinity to %s: %s" %
+                               (cpus, e))
+
+    nice = scheduling.get('nice')
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except (AttributeError, OSError) as e:
+            raise RuntimeError("Unable to set nice value %s: %s" % (nice, e))
+
+    io_class = scheduling.get('io_class')
+    io_priority = scheduling.get('io_priority')
+    if io_class is not None or io_priority is not None:
+        io_class = io_class or 'best-effort'
+        if io_class == 'idle':
+            io_priority = 0
+        elif io_priority is None:
+            io_priority = 4
+        try:
+            libc.ioprio_set(libc.IOPRIO_WHO_PROCESS, 0, IO_CLASSES[io_class],
+                            io_priority)
+        except OSError as e:
+            raise RuntimeError(
+                "Unable to set I/O scheduling class %s, priority %s: %s" %
+                (io_class, io_priority, e))
+
+    if child_setup is not None:
+        child_setup()
+
+
+def with_scheduling(spawn_args, scheduling):
+    '''Return a copy of 'spawn_args' that applies 'scheduling' in the child.
+
+    The settings are applied before any 'child_setup' function in
+    'spawn_args' is called. If 'scheduling' is None, 'spawn_args' is
+    returned unchanged.
+
+    '''
+    if scheduling is None:
+        return spawn_args
+    check_scheduling(scheduling)
+    spawn_args = dict(spawn_args)
+    spawn_args['child_setup'] = functools.partial(
+        _apply_scheduling, scheduling, spawn_args.get('child_setup'))
+    return spawn_args
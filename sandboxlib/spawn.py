@@ -0,0 +1,767 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Start a subprocess, running some setup code in the child before exec().
+
+The subprocess.Popen() class has a 'preexec_fn' parameter that does this,
+but any exception raised in that function is reported to the parent process
+only as "Exception occurred in preexec_fn", which makes sandbox setup errors
+very hard to diagnose.
+
+The spawn() function here forks the child itself. The child reports any
+exception raised during setup, or by exec() itself, by writing it to a
+'status' pipe. The write end of that pipe has the close-on-exec flag set,
+so if the parent reads EOF from the pipe it knows that the exec() was
+successful.
+
+As with 'preexec_fn', the setup code runs in a forked copy of the calling
+process, so it should avoid anything that might need a lock held by another
+thread of the parent.
+
+'''
+
+
+import errno
+import fcntl
+import functools
+import math
+import os
+import pickle
+import resource
+import select
+import signal
+import time
+
+import sandboxlib
+
+
+# Python ignores these signals, and ignored signals stay ignored across
+# exec(). The subprocess.Popen() class resets them, and so do we.
+_RESET_SIGNALS = ['SIGPIPE', 'SIGXFZ', 'SIGXFSZ']
+
+
+# The write end of the status pipe, in a child process that is running its
+# setup code. See fork_in_child().
+_child_status_fd = None
+
+# Bounds of the interval between checks for exit, when waiting with a timeout.
+_POLL_INTERVAL_MIN = 0.001
+_POLL_INTERVAL_MAX = 0.1
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def _fileno(stream):
+    if isinstance(stream, int):
+        return stream
+    return stream.fileno()
+
+
+def _max_fd():
+    try:
+        return os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError):
+        return 256
+
+
+class Process(object):
+    '''A running subprocess, as returned by spawn().
+
+    The 'stdout' and 'stderr' attributes are the read ends of pipes connected
+    to the output of the subprocess, if it was started with
+    sandboxlib.CAPTURE or a consumer function for that stream, or None
+    otherwise. The 'consumers' attribute maps each of these file descriptors
+    to its consumer function, if it has one.
+
+    Once the subprocess has exited, the 'rusage' attribute holds its resource
+    usage as returned by os.wait4(), or None if that isn't available. The
+    'timed_out' attribute is True if it was killed by communicate() because
+    its timeout expired.
+
+    '''
+
+    def __init__(self, pid, stdout=None, stderr=None, process_group=False,
+                 consumers=None):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.process_group = process_group
+        self.consumers = consumers or {}
+        self.returncode = None
+        self.rusage = None
+        self.timed_out = False
+
+    def kill(self, signal_number=signal.SIGKILL):
+        '''Send a signal to the subprocess, if it is still running.
+
+        If the subprocess was started in a new process group, the signal is
+        sent to the whole group.
+
+        '''
+        if self.returncode is not None:
+            return
+        try:
+            if self.process_group:
+                os.killpg(self.pid, signal_number)
+            else:
+                os.kill(self.pid, signal_number)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _set_returncode(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def _wait4(self, options):
+        # os.wait4() also gives us the resource usage of the subprocess, and
+        # of any of its children that it waited for.
+        if hasattr(os, 'wait4'):
+            pid, status, self.rusage = os.wait4(self.pid, options)
+        else:
+            pid, status = os.waitpid(self.pid, options)
+        if pid != 0:
+            self._set_returncode(status)
+
+    def poll(self):
+        '''Return the exit code if the subprocess has exited, or None.'''
+        if self.returncode is None:
+            self._wait4(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        '''Wait for the subprocess to exit, and return its exit code.
+
+        As with subprocess.Popen, a negative exit code -N means that the
+        subprocess was killed by signal N.
+
+        '''
+        while self.returncode is None:
+            try:
+                self._wait4(0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+        return self.returncode
+
+    def _time_out(self):
+        self.timed_out = True
+        self.kill()
+
+    def _wait_until(self, deadline):
+        # Waits for the subprocess to exit, killing it if it is still running
+        # at 'deadline'.
+        interval = _POLL_INTERVAL_MIN
+        while self.poll() is None:
+            remaining = deadline - sandboxlib.utils.monotonic()
+            if remaining <= 0:
+                self._time_out()
+                return
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, _POLL_INTERVAL_MAX)
+
+    def communicate(self, timeout=None):
+        '''Read all output, then wait for the subprocess to exit.
+
+        Returns a tuple of (exit code, stdout output, stderr output). The
+        output is None for streams that weren't captured. Streams that have a
+        consumer function are passed to it as they are read, instead of being
+        captured.
+
+        If the subprocess is still running 'timeout' seconds after this is
+        called, it is killed with SIGKILL (along with its process group, if
+        it has one), the 'timed_out' attribute is set, and the output read
+        up to that point is returned.
+
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = sandboxlib.utils.monotonic() + timeout
+
+        captured = {}
+        consumers = {}
+        open_fds = []
+        for fd in [self.stdout, self.stderr]:
+            if fd is not None:
+                if fd in self.consumers:
+                    consumers[fd] = self.consumers[fd]
+                else:
+                    captured[fd] = []
+                    consumers[fd] = captured[fd].append
+                open_fds.append(fd)
+
+        while open_fds:
+            select_args = [open_fds, [], []]
+            if deadline is not None:
+                remaining = deadline - sandboxlib.utils.monotonic()
+                if remaining <= 0:
+                    # Something that escaped the process group may still be
+                    # holding the pipes open, so we don't wait for EOF.
+                    self._time_out()
+                    for fd in open_fds:
+                        os.close(fd)
+                    break
+                select_args.append(remaining)
+            try:
+                ready, _, _ = select.select(*select_args)
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 32768)
+                consumers[fd](data)
+                if not data:
+                    os.close(fd)
+                    open_fds.remove(fd)
+
+        if deadline is not None and not self.timed_out:
+            self._wait_until(deadline)
+
+        out = b''.join(captured[self.stdout]) \
+            if self.stdout in captured else None
+        err = b''.join(captured[self.stderr]) \
+            if self.stderr in captured else None
+        self.stdout = self.stderr = None
+
+        return self.wait(), out, err
+
+
+class OutputFds(object):
+    '''File descriptors for the output of a subprocess that is to be started.
+
+    The 'stdout' and 'stderr' parameters are as for spawn(). The
+    'stdout_write' and 'stderr_write' attributes are the file descriptors that
+    the subprocess should write to. The 'stdout_read' and 'stderr_read'
+    attributes are the read ends of the pipes that are created for streams
+    that are to be captured or passed to a consumer function, or None.
+
+    Once the subprocess is started, the calling process should call
+    close_write_ends(). It should call close_read_ends() instead if starting
+    the subprocess failed.
+
+    '''
+
+    def __init__(self, stdout, stderr):
+        self.consumers = {}
+        self._write_ends = []
+        self._read_ends = []
+
+        try:
+            self.stdout_read, self.stdout_write = self._fds(stdout)
+            if stderr == sandboxlib.STDOUT:
+                self.stderr_read, self.stderr_write = None, self.stdout_write
+            else:
+                self.stderr_read, self.stderr_write = self._fds(stderr)
+        except:
+            self.close_read_ends()
+            self.close_write_ends()
+            raise
+
+    def _fds(self, stream):
+        if stream == sandboxlib.CAPTURE or callable(stream):
+            read_fd, write_fd = os.pipe()
+            _set_cloexec(read_fd)
+            self._write_ends.append(write_fd)
+            self._read_ends.append(read_fd)
+            if callable(stream):
+                self.consumers[read_fd] = stream
+            return read_fd, write_fd
+        elif stream is None:
+            fd = os.open(os.devnull, os.O_WRONLY)
+            self._write_ends.append(fd)
+            return None, fd
+        else:
+            return None, _fileno(stream)
+
+    def close_write_ends(self):
+        for fd in self._write_ends:
+            os.close(fd)
+        self._write_ends = []
+
+    def close_read_ends(self):
+        for fd in self._read_ends:
+            os.close(fd)
+        self._read_ends = []
+
+
+def _exec_child(argv, cwd, env, child_setup, stdout_fd, stderr_fd,
+                status_fd):
+    global _child_status_fd
+    _child_status_fd = status_fd
+
+    try:
+        for name in _RESET_SIGNALS:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), signal.SIG_DFL)
+
+        # Move the output fds out of the way first, in case one of them is
+        # already 1 or 2.
+        stdout_fd = fcntl.fcntl(stdout_fd, fcntl.F_DUPFD, 3)
+        stderr_fd = fcntl.fcntl(stderr_fd, fcntl.F_DUPFD, 3)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+
+        # The default is to share file descriptors from the parent process
+        # to the subprocess, which is rarely good for sandboxing.
+        os.closerange(3, status_fd)
+        os.closerange(status_fd + 1, _max_fd())
+
+        if child_setup is not None:
+            child_setup()
+
+        if cwd is not None:
+            os.chdir(cwd)
+
+        try:
+            if env is None:
+                os.execvp(argv[0], argv)
+            else:
+                os.execvpe(argv[0], argv, env)
+        except OSError as e:
+            e.filename = argv[0]
+            raise
+    except BaseException as e:
+        try:
+            data = pickle.dumps(e)
+        except Exception:
+            data = pickle.dumps(RuntimeError(str(e)))
+        try:
+            os.write(_child_status_fd, data)
+        except OSError:
+            pass
+    finally:
+        os._exit(127)
+
+
+def _inheritable_fds():
+    # Returns the file descriptors above 2 that would be inherited by a child
+    # process, on systems where we can list them cheaply.
+    try:
+        fds = [int(name) for name in os.listdir('/proc/self/fd')]
+    except OSError:
+        return []
+    result = []
+    for fd in fds:
+        try:
+            if fd > 2 and not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                result.append(fd)
+        except (IOError, OSError):
+            # The fd used to list the directory, which is now closed.
+            pass
+    return result
+
+
+def _posix_spawn(argv, env, stdout_fd, stderr_fd, new_process_group):
+    # posix_spawn() is usually implemented with vfork(), so unlike fork() it
+    # doesn't need to copy the page tables of the calling process. This makes
+    # it much faster when the calling process is large.
+    to_close = []
+    try:
+        # Move the output fds out of the way first, in case one of them is
+        # already 1 or 2.
+        stdout_fd = fcntl.fcntl(stdout_fd, fcntl.F_DUPFD_CLOEXEC, 3)
+        to_close.append(stdout_fd)
+        stderr_fd = fcntl.fcntl(stderr_fd, fcntl.F_DUPFD_CLOEXEC, 3)
+        to_close.append(stderr_fd)
+
+        file_actions = [
+            (os.POSIX_SPAWN_DUP2, stdout_fd, 1),
+            (os.POSIX_SPAWN_DUP2, stderr_fd, 2),
+        ]
+        for fd in _inheritable_fds():
+            file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+
+        signals = [getattr(signal, name) for name in _RESET_SIGNALS
+                   if hasattr(signal, name)]
+
+        kwargs = {}
+        if new_process_group:
+            kwargs['setpgroup'] = 0
+
+        try:
+            return os.posix_spawnp(
+                argv[0], argv, os.environ if env is None else env,
+                file_actions=file_actions, setsigdef=signals, **kwargs)
+        except OSError as e:
+            e.filename = argv[0]
+            raise
+    finally:
+        for fd in to_close:
+            os.close(fd)
+
+
+def _fork_exec(argv, cwd, env, child_setup, stdout_fd, stderr_fd,
+               new_process_group):
+    # Returns the pid of the child, and a pickled exception if there was an
+    # error before the exec() succeeded.
+    status_read_fd, status_write_fd = os.pipe()
+    try:
+        _set_cloexec(status_read_fd)
+        _set_cloexec(status_write_fd)
+
+        pid = os.fork()
+        if pid == 0:
+            if new_process_group:
+                os.setpgid(0, 0)
+            _exec_child(argv, cwd, env, child_setup, stdout_fd, stderr_fd,
+                        status_write_fd)
+
+        if new_process_group:
+            # Do this in the parent too, so that the process group exists by
+            # the time we return. It fails harmlessly if the child got there
+            # first and has already run exec().
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                pass
+
+        os.close(status_write_fd)
+        status_write_fd = None
+
+        chunks = []
+        while True:
+            try:
+                data = os.read(status_read_fd, 32768)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        os.close(status_read_fd)
+        if status_write_fd is not None:
+            os.close(status_write_fd)
+
+    return pid, b''.join(chunks)
+
+
+def spawn(argv, stdout, stderr, cwd=None, env=None, child_setup=None,
+          new_process_group=False):
+    '''Start 'argv' in a subprocess, returning a Process instance.
+
+    The 'stdout' and 'stderr' parameters can be sandboxlib.CAPTURE, a file
+    object or file descriptor to redirect the output to, a consumer function
+    (see sandboxlib/output.py), or None to discard the output. The 'stderr'
+    parameter can also be sandboxlib.STDOUT.
+
+    If 'child_setup' is given, it is called with no arguments in the child
+    process before 'cwd' is changed to and 'argv' is executed. Any exception
+    raised in the child before the exec() succeeds is re-raised in the calling
+    process by this function.
+
+    If 'new_process_group' is True, the subprocess is put into a new process
+    group, so that it and all of its children can be signalled together.
+
+    When there's no 'child_setup' or 'cwd', posix_spawn() is used if it is
+    available, instead of fork() and exec().
+
+    '''
+    fds = OutputFds(stdout, stderr)
+    try:
+        if child_setup is None and cwd is None and \
+                hasattr(os, 'posix_spawnp'):
+            pid = _posix_spawn(argv, env, fds.stdout_write, fds.stderr_write,
+                               new_process_group)
+            error = None
+        else:
+            pid, error = _fork_exec(
+                argv, cwd, env, child_setup, fds.stdout_write,
+                fds.stderr_write, new_process_group)
+    except:
+        fds.close_read_ends()
+        raise
+    finally:
+        fds.close_write_ends()
+
+    process = Process(pid, stdout=fds.stdout_read, stderr=fds.stderr_read,
+                      process_group=new_process_group,
+                      consumers=fds.consumers)
+
+    if error:
+        process.communicate()
+        raise pickle.loads(error)
+
+    return process
+
+
+def fork_in_child():
+    '''Fork again from a 'child_setup' function, returning in the new child.
+
+    Some settings, such as a new PID namespace, only apply to the children of
+    the process that makes them. This function can be used by 'child_setup'
+    to create such a child. The new child carries on with the setup and the
+    exec(), while the original child waits for it and then exits with the
+    same status.
+
+    '''
+    pid = os.fork()
+    if pid == 0:
+        return
+
+    # Don't hold the status pipe or output streams open, otherwise the parent
+    # wouldn't know when the grandchild had run exec(), or exited.
+    os.close(_child_status_fd)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+
+    while True:
+        try:
+            pid, status = os.waitpid(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                os._exit(127)
+
+    if os.WIFSIGNALED(status):
+        # SIGKILL can't have its handler changed, but doesn't need to.
+        if os.WTERMSIG(status) != signal.SIGKILL:
+            signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+        os.kill(os.getpid(), os.WTERMSIG(status))
+    os._exit(os.WEXITSTATUS(status))
+
+
+def _set_cpu_time_limit(seconds, child_setup):
+    # RLIMIT_CPU counts whole seconds. The kernel sends SIGXCPU when the soft
+    # limit is reached, and SIGKILL a second later in case that was caught or
+    # ignored. Processes started by the command get the same limit each.
+    seconds = int(math.ceil(seconds))
+    soft, hard = seconds, seconds + 1
+    _, current_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if current_hard != resource.RLIM_INFINITY:
+        hard = min(hard, current_hard)
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+    if child_setup is not None:
+        child_setup()
+
+
+def with_cpu_time_limit(spawn_args, cpu_time_limit):
+    '''Return a copy of 'spawn_args' that limits the CPU time of the child.
+
+    The limit is set with setrlimit(RLIMIT_CPU) in the child process, before
+    any 'child_setup' function in 'spawn_args' is called. If
+    'cpu_time_limit' is None, 'spawn_args' is returned unchanged.
+
+    '''
+    if cpu_time_limit is None:
+        return spawn_args
+    spawn_args = dict(spawn_args)
+    spawn_args['child_setup'] = functools.partial(
+        _set_cpu_time_limit, cpu_time_limit, spawn_args.get('child_setup'))
+    return spawn_args
+
+
+def timeout_reason(process, cpu_time_limit=None):
+    '''Return which limit the exited 'process' was killed for exceeding.
+
+    The result is sandboxlib.TIMEOUT_WALL_CLOCK if communicate() killed it
+    because its timeout expired, sandboxlib.TIMEOUT_CPU_TIME if it was killed
+    by the kernel for using more than 'cpu_time_limit' seconds of CPU time,
+    and None otherwise.
+
+    '''
+    if process.timed_out:
+        return sandboxlib.TIMEOUT_WALL_CLOCK
+    if cpu_time_limit is None:
+        return None
+    if process.returncode == -signal.SIGXCPU:
+        return sandboxlib.TIMEOUT_CPU_TIME
+    if process.returncode == -signal.SIGKILL and process.rusage is not None:
+        # The init process of a PID namespace ignores SIGXCPU, so the
+        # command only gets the SIGKILL.
+        cpu_time = process.rusage.ru_utime + process.rusage.ru_stime
+        if cpu_time >= int(math.ceil(cpu_time_limit)):
+            return sandboxlib.TIMEOUT_CPU_TIME
+    return None
+
+
+def run_sandbox(prepare_sandbox, command, stdout, stderr, timeout=None,
+                cpu_time_limit=None, action_cache=None, trace=None,
+                resources=None, scheduling=None, **sandbox_config):
+    '''Run 'command' in a sandbox set up by a backend's prepare_sandbox().
+
+    This implements run_sandbox() for each of the backends, returning a
+    sandboxlib.SandboxResult.
+
+    If a 'timeout' is given, the command is started in a new process group,
+    so that it can be killed along with everything it started. The sandbox
+    is torn down once it has been killed.
+
+    If 'trace' is given, the sandbox is set up and torn down while tracing,
+    so that the files it leaves behind are seen as they were left. If
+    'resources' is given, the child process joins a new cgroup before it
+    sets up the sandbox, and the cgroup is removed after the sandbox has
+    been torn down.
+
+    '''
+    if action_cache is not None:
+        return action_cache.run(
+            functools.partial(run_sandbox, prepare_sandbox), command,
+            stdout=stdout, stderr=stderr, timeout=timeout,
+            cpu_time_limit=cpu_time_limit, trace=trace, resources=resources,
+            scheduling=scheduling, backend=prepare_sandbox.__module__,
+            **sandbox_config)
+
+    timer = sandboxlib.utils.PhaseTimer()
+    with sandboxlib.trace.tracing(trace, timer, **sandbox_config) as tracer, \
+            sandboxlib.cgroup.transient_cgroup(resources, timer) as cgroup:
+        context = prepare_sandbox(command, timer=timer, **sandbox_config)
+        with context as (argv, spawn_args):
+            spawn_args = with_cpu_time_limit(spawn_args, cpu_time_limit)
+            spawn_args = sandboxlib.scheduling.with_scheduling(
+                spawn_args, scheduling)
+            spawn_args = sandboxlib.cgroup.with_cgroup(spawn_args, cgroup)
+            with timer.phase('spawn'):
+                process = spawn(argv, stdout, stderr,
+                                new_process_group=timeout is not None,
+                                **spawn_args)
+            with timer.phase('run'):
+                try:
+                    exit, out, err = process.communicate(timeout=timeout)
+                except BaseException:
+                    process.kill()
+                    process.wait()
+                    raise
+        cgroup_usage = cgroup.usage() if cgroup else None
+    return sandboxlib.SandboxResult(
+        exit, out, err, timings=timer.timings, rusage=process.rusage,
+        timed_out=timeout_reason(process, cpu_time_limit),
+        file_accesses=tracer.file_accesses if tracer else None,
+        cgroup_usage=cgroup_usage)
+
+
+class Sandbox(object):
+    '''A sandbox that is set up once, and can then run many commands.
+
+    Each backend provides a subclass of this, which sets 'prepare_sandbox' to
+    the backend's prepare_sandbox() function. The 'sandbox_config' parameters
+    are the same as for the backend's run_sandbox() function, apart from
+    'command', 'stdout' and 'stderr'.
+
+    The configuration is checked, and everything that the calling process
+    needs to do to set up the sandbox is done, when the sandbox is opened.
+    That happens when it is used as a context manager, or when open() is
+    called. Everything is released when the context exits, or close() is
+    called.
+
+    Any setup that a backend does in the child process, such as creating
+    namespaces, is still done for each command.
+
+    '''
+
+    prepare_sandbox = None
+
+    def __init__(self, **sandbox_config):
+        self.sandbox_config = sandbox_config
+
+        # Records how long it took to set up and tear down the sandbox.
+        self.timer = sandboxlib.utils.PhaseTimer()
+
+        self._context = None
+        self._argv_prefix = None
+        self._spawn_args = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        '''Set up the sandbox, if it isn't set up already.'''
+        if self._context is not None:
+            return
+
+        # The command is appended to this argv for each run.
+        context = self.prepare_sandbox([], timer=self.timer,
+                                       **self.sandbox_config)
+        self._argv_prefix, self._spawn_args = context.__enter__()
+        self._context = context
+
+    def close(self):
+        '''Release everything that was set up by open().'''
+        if self._context is not None:
+            context, self._context = self._context, None
+            context.__exit__(None, None, None)
+
+    def spawn(self, command, stdout, stderr, env=None,
+              new_process_group=False, cpu_time_limit=None, scheduling=None):
+        '''Start 'command' in the sandbox, returning a Process instance.
+
+        The 'stdout', 'stderr' and 'new_process_group' parameters are as for
+        sandboxlib.spawn.spawn(). If 'env' is None, the environment given in
+        the sandbox configuration is used. The 'cpu_time_limit' and
+        'scheduling' are as for run_sandbox().
+
+        '''
+        if self._context is None:
+            raise RuntimeError("The sandbox is not open.")
+
+        if type(command) == str:
+            command = [command]
+
+        spawn_args = with_cpu_time_limit(
+            dict(self._spawn_args), cpu_time_limit)
+        spawn_args = sandboxlib.scheduling.with_scheduling(
+            spawn_args, scheduling)
+        if env is not None:
+            spawn_args['env'] = env
+
+        return spawn(self._argv_prefix + command, stdout, stderr,
+                     new_process_group=new_process_group, **spawn_args)
+
+    def run(self, command, env=None, stdout=sandboxlib.CAPTURE,
+            stderr=sandboxlib.CAPTURE, timeout=None, cpu_time_limit=None,
+            scheduling=None):
+        '''Run 'command' in the sandbox, returning a SandboxResult.
+
+        The 'timeout', 'cpu_time_limit' and 'scheduling' parameters are as
+        for run_sandbox(). The sandbox stays open if the command is killed.
+
+        '''
+        timer = sandboxlib.utils.PhaseTimer()
+        with timer.phase('spawn'):
+            process = self.spawn(command, stdout, stderr, env=env,
+                                 new_process_group=timeout is not None,
+                                 cpu_time_limit=cpu_time_limit,
+                                 scheduling=scheduling)
+        with timer.phase('run'):
+            try:
+                exit, out, err = process.communicate(timeout=timeout)
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+        return sandboxlib.SandboxResult(
+            exit, out, err, timings=timer.timings, rusage=process.rusage,
+            timed_out=timeout_reason(process, cpu_time_limit))
+
+    def run_with_redirection(self, command, **kwargs):
+        exit, out, err = self.run(command, **kwargs)
+        # out and err will be None
+        return exit
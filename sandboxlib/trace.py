@@ -0,0 +1,377 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Find out which files a sandboxed command read and wrote.
+
+Pass the 'trace' parameter to a backend's run_sandbox() function to use
+this. The 'file_accesses' attribute of the result is then a FileAccesses
+instance. There are two ways of tracing:
+
+  - METADATA, the default, records the type, size, modification time and
+    inode number of everything in the writable parts of 'filesystem_root'
+    before the command runs, and compares them with what is there after it
+    has finished. This costs one lstat() per file, and the command runs at
+    full speed. It can't tell which files were read.
+
+  - FANOTIFY does the same, and also watches the filesystem that holds
+    'filesystem_root' with fanotify (see fanotify(7)) while the command
+    runs, so that files which were read, or written and then deleted again,
+    are seen too. This needs root, and Linux 4.20 or later.
+
+Files that are accessed through 'extra_mounts' are not reported, apart from
+the ones in a 'bind' mount of a directory inside 'filesystem_root'. With
+FANOTIFY, files in 'filesystem_root' that other processes access while the
+command is running are reported as well.
+
+'''
+
+
+import contextlib
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import threading
+
+import sandboxlib
+from sandboxlib import libc
+
+
+METADATA = 'metadata'
+FANOTIFY = 'fanotify'
+
+_FANOTIFY_READ_EVENTS = libc.FAN_ACCESS | libc.FAN_CLOSE_NOWRITE
+_FANOTIFY_WRITE_EVENTS = libc.FAN_MODIFY | libc.FAN_CLOSE_WRITE
+
+_EVENT_METADATA = struct.Struct(libc.FANOTIFY_EVENT_METADATA_FORMAT)
+
+# readlink() of /proc/self/fd/N appends this to the path of a file that has
+# been deleted.
+_DELETED_SUFFIX = ' (deleted)'
+
+
+class FileAccesses(object):
+    '''The files that a command read, wrote, created and deleted.
+
+    Each attribute is a sorted list of paths as the command saw them, that
+    is relative to 'filesystem_root' and starting with '/':
+
+      - read: files that were opened for reading. This is None unless the
+            FANOTIFY method was used.
+      - written: files that were created or changed. Directories are only
+            listed in 'created', when they are new.
+      - created: files and directories that didn't exist before.
+      - deleted: files and directories that no longer exist. Things inside a
+            deleted directory are not listed separately.
+
+    '''
+
+    def __init__(self, read, written, created, deleted):
+        self.read = read
+        self.written = written
+        self.created = created
+        self.deleted = deleted
+
+    def __repr__(self):
+        counts = ['%s=%i' % (name, len(getattr(self, name)))
+                  for name in ['read', 'written', 'created', 'deleted']
+                  if getattr(self, name) is not None]
+        return '<FileAccesses %s>' % ' '.join(counts)
+
+    def to_dict(self):
+        '''Return the lists of paths as a dict, e.g. for saving as JSON.'''
+        return dict(read=self.read, written=self.written,
+                    created=self.created, deleted=self.deleted)
+
+
+def excluded_paths(extra_mounts):
+    '''Return the mount points of 'extra_mounts', relative to the root.
+
+    Whatever is mounted there hides what is beneath them in
+    'filesystem_root'.
+
+    '''
+    return set(sandboxlib.digest.relative_path(target)
+               for source, target, mount_type, options
+               in sandboxlib.validate_extra_mounts(extra_mounts))
+
+
+def output_paths(filesystem_root, filesystem_writable_paths):
+    '''Return the paths where a command may change 'filesystem_root'.
+
+    The paths are relative to the root, which itself is ''.
+
+    '''
+    if sandboxlib.overlay.is_overlay(filesystem_root):
+        # The changes go somewhere else.
+        return []
+    if filesystem_writable_paths == 'all':
+        return ['']
+    if type(filesystem_writable_paths) != list:
+        return []
+    return [sandboxlib.digest.relative_path(path)
+            for path in filesystem_writable_paths]
+
+
+def _walk(root, relpath, excluded):
+    # Yields (relative path, lstat() result) for 'relpath' and everything
+    # below it, in a stable order, skipping anything in 'excluded'.
+    if relpath in excluded:
+        return
+    path = os.path.join(root, relpath) if relpath else root
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    yield relpath, st
+
+    if stat.S_ISDIR(st.st_mode):
+        for entry in sandboxlib.utils.scan_directory(path):
+            child = os.path.join(relpath, entry.name) if relpath \
+                else entry.name
+            for item in _walk(root, child, excluded):
+                yield item
+
+
+def snapshot(root, relpaths, excluded=()):
+    '''Record enough about the files in 'relpaths' to tell if they change.
+
+    Returns a dict mapping the path of everything in 'relpaths' inside
+    'root', apart from the paths in 'excluded', to a tuple of its mode,
+    size, modification time and inode number.
+
+    '''
+    result = {}
+    for relpath in relpaths:
+        for path, st in _walk(root, relpath, excluded):
+            result[path] = (st.st_mode, st.st_size,
+                            getattr(st, 'st_mtime_ns', st.st_mtime),
+                            st.st_ino)
+    return result
+
+
+def _sandbox_path(relpath):
+    return '/' + relpath
+
+
+class _FanotifyListener(object):
+    # Collects the paths of the files under 'root' that are read and
+    # written, in a background thread.
+
+    def __init__(self, root):
+        self.root = root
+        self.read = set()
+        self.written = set()
+        self.overflowed = False
+
+        flags = libc.FAN_CLASS_NOTIF | libc.FAN_CLOEXEC | \
+            libc.FAN_NONBLOCK | libc.FAN_UNLIMITED_QUEUE
+        event_flags = os.O_RDONLY | getattr(os, 'O_LARGEFILE', 0) | \
+            os.O_CLOEXEC
+        try:
+            self.fd = libc.fanotify_init(flags, event_flags)
+        except (AttributeError, OSError) as e:
+            raise RuntimeError(
+                "Unable to trace file accesses with fanotify: %s" % e)
+
+        self._stop_read, self._stop_write = os.pipe()
+        try:
+            libc.fanotify_mark(
+                self.fd, libc.FAN_MARK_ADD | libc.FAN_MARK_FILESYSTEM,
+                _FANOTIFY_READ_EVENTS | _FANOTIFY_WRITE_EVENTS, root)
+        except OSError as e:
+            self._close()
+            raise RuntimeError(
+                "Unable to trace file accesses in %s with fanotify: %s" %
+                (root, e))
+
+        self.thread = threading.Thread(
+            target=self._run, name='sandboxlib-fanotify')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _close(self):
+        for fd in [self.fd, self._stop_read, self._stop_write]:
+            os.close(fd)
+
+    def _relative_path(self, path):
+        if path.endswith(_DELETED_SUFFIX):
+            return None
+        if self.root == '/':
+            return path.lstrip('/')
+        if path.startswith(self.root + '/'):
+            return path[len(self.root) + 1:]
+        return None
+
+    def _handle_event(self, mask, fd, pid):
+        if mask & libc.FAN_Q_OVERFLOW:
+            self.overflowed = True
+        if fd == libc.FAN_NOFD:
+            return
+        try:
+            if pid == os.getpid():
+                return
+            path = os.readlink('/proc/self/fd/%i' % fd)
+        except OSError:
+            return
+        finally:
+            os.close(fd)
+
+        relpath = self._relative_path(path)
+        if relpath is None:
+            return
+        if mask & _FANOTIFY_WRITE_EVENTS:
+            self.written.add(relpath)
+        if mask & _FANOTIFY_READ_EVENTS:
+            self.read.add(relpath)
+
+    def _read_events(self):
+        # Returns False once there are no events left to read.
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.EINTR]:
+                return False
+            raise
+        offset = 0
+        while offset + _EVENT_METADATA.size <= len(data):
+            event_len, version, reserved, metadata_len, mask, fd, pid = \
+                _EVENT_METADATA.unpack_from(data, offset)
+            self._handle_event(mask, fd, pid)
+            offset += event_len
+        return len(data) > 0
+
+    def _run(self):
+        try:
+            while True:
+                ready, _, _ = select.select(
+                    [self.fd, self._stop_read], [], [])
+                if self._stop_read in ready:
+                    # Events for everything that happened before stop() was
+                    # called are already queued.
+                    while self._read_events():
+                        pass
+                    return
+                self._read_events()
+        except Exception as e:
+            logging.getLogger('sandboxlib').warning(
+                "Error reading fanotify events: %s", e)
+
+    def stop(self):
+        '''Stop listening, returning the paths that were read and written.'''
+        os.write(self._stop_write, b'x')
+        self.thread.join()
+        self._close()
+        if self.overflowed:
+            logging.getLogger('sandboxlib').warning(
+                "Some file accesses in %s were not traced, because the "
+                "fanotify queue overflowed.", self.root)
+        return self.read, self.written
+
+
+class Tracer(object):
+    '''Traces the file accesses of one run of a command.
+
+    The parameters are the method, METADATA or FANOTIFY, and the sandbox
+    configuration, as passed to run_sandbox(). Call start() just before the
+    sandbox is set up, and finish() once it has been torn down.
+
+    '''
+
+    def __init__(self, method, filesystem_root='/',
+                 filesystem_writable_paths='all', extra_mounts=None,
+                 **sandbox_config):
+        sandboxlib.utils.check_parameter('trace', method, [METADATA, FANOTIFY])
+        assert not sandboxlib.overlay.is_overlay(filesystem_root), \
+            "File accesses can't be traced in an Overlay."
+
+        self.method = method
+        self.root = os.path.realpath(filesystem_root)
+        self.paths = output_paths(filesystem_root, filesystem_writable_paths)
+        self.excluded = excluded_paths(extra_mounts)
+
+        assert self.root != '/' or not self.paths, \
+            "Tracing file accesses needs a 'filesystem_root' other than " \
+            "'/', unless nothing is writable."
+
+        self.file_accesses = None
+
+        self._before = None
+        self._listener = None
+
+    def start(self):
+        '''Start tracing.'''
+        self._before = snapshot(self.root, self.paths, self.excluded)
+        if self.method == FANOTIFY:
+            self._listener = _FanotifyListener(self.root)
+
+    def stop(self):
+        '''Stop tracing, without working out what happened.'''
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            return listener.stop()
+        return None, set()
+
+    def finish(self):
+        '''Stop tracing, and return a FileAccesses instance.'''
+        read, written = self.stop()
+        before = self._before
+        after = snapshot(self.root, self.paths, self.excluded)
+
+        created = set(path for path in after if path not in before)
+        removed = set(path for path in before if path not in after)
+        # Everything inside a deleted directory goes along with it.
+        deleted = set(path for path in removed
+                      if os.path.dirname(path) not in removed)
+
+        written = set(path for path in written if path not in removed)
+        for path, info in after.items():
+            if not stat.S_ISDIR(info[0]) and before.get(path) != info:
+                written.add(path)
+
+        def paths(relpaths):
+            return sorted(_sandbox_path(relpath) for relpath in relpaths)
+
+        return FileAccesses(
+            read=paths(read) if read is not None else None,
+            written=paths(written), created=paths(created),
+            deleted=paths(deleted))
+
+
+@contextlib.contextmanager
+def tracing(method, timer, **sandbox_config):
+    '''Context that traces file accesses while it is active.
+
+    Returns a context of a Tracer, or of None if 'method' is None. When the
+    context exits normally, the result is in the tracer's 'file_accesses'
+    attribute.
+
+    '''
+    if method is None:
+        yield None
+        return
+
+    tracer = Tracer(method, **sandbox_config)
+    with timer.phase('trace'):
+        tracer.start()
+    try:
+        yield tracer
+    except BaseException:
+        tracer.stop()
+        raise
+    with timer.phase('trace'):
+        tracer.file_accesses = tracer.finish()
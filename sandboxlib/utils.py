@@ -13,15 +13,38 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import contextlib
+import errno
+import fcntl
 import logging
 import os
 import shutil
+import stat
 import subprocess
 import sys
+import time
 
 import sandboxlib
 
 
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python < 3.3.
+    monotonic = time.time
+
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5. The 'scandir' module from PyPI provides the same thing.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
 def check_parameter(name, value, supported_values):
     assert value in supported_values, \
         "'%(value)s' is an unsupported value for '%(name)s' in this " \
@@ -30,6 +53,37 @@ def check_parameter(name, value, supported_values):
             supported_values=', '.join(supported_values))
 
 
+class _DirEntry(object):
+    # Minimal stand-in for os.DirEntry, used when os.scandir() is missing.
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = os.lstat(self.path)
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self._stat.st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._stat.st_mode)
+
+
+def scan_directory(path):
+    '''Return a list of os.DirEntry-like objects for the contents of 'path'.
+
+    This uses os.scandir() if available, which avoids a stat() call per entry
+    on most filesystems. The results are sorted by name.
+
+    '''
+    if scandir is not None:
+        entries = list(scandir(path))
+    else:
+        entries = [_DirEntry(path, name) for name in os.listdir(path)]
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
+
 def find_program(program_name):
     search_path = os.environ.get('PATH')
 
@@ -51,3 +105,72 @@ def find_program(program_name):
                 program_name, search_path))
 
     return program_path
+
+
+@contextlib.contextmanager
+def lock_file(path, shared=False, blocking=True):
+    '''Hold an advisory flock() lock on 'path' for the duration of the context.
+
+    The file is created if it doesn't exist. Locks taken with shared=True can
+    be held by several processes at once, but exclude any exclusive lock.
+
+    If blocking=False and the lock cannot be taken immediately, the context
+    yields False instead of True, and no lock is held.
+
+    '''
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, operation)
+            locked = True
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            locked = False
+        yield locked
+    finally:
+        os.close(fd)
+
+
+class PhaseTimer(object):
+    '''Record how long each phase of running a sandbox takes.
+
+    The 'timings' attribute is an OrderedDict mapping the name of each phase
+    to the number of seconds spent in it, in the order that the phases were
+    first entered. Time spent in the same phase more than once is added up.
+
+    '''
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Count the time spent in the context towards phase 'name'.'''
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = \
+                self.timings.get(name, 0.0) + monotonic() - start
+
+    @contextlib.contextmanager
+    def timed_context(self, context, setup_phase, teardown_phase):
+        '''Enter 'context', timing its entry and exit as separate phases.'''
+        with self.phase(setup_phase):
+            value = context.__enter__()
+        try:
+            yield value
+        except BaseException:
+            exc_info = sys.exc_info()
+            with self.phase(teardown_phase):
+                suppress = context.__exit__(*exc_info)
+            if not suppress:
+                raise
+        else:
+            with self.phase(teardown_phase):
+                context.__exit__(None, None, None)
@@ -0,0 +1,60 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Fixtures shared by the 'sandboxlib' tests.
+
+Tests that take the 'sandboxlib_executor' fixture are run once with each
+backend. A module or test can be limited to some of the backends by marking
+it, for example:
+
+    pytestmark = pytest.mark.backends('chroot', 'linux_namespaces')
+
+'''
+
+
+import pytest
+
+import os
+
+import sandboxlib
+
+
+BACKENDS = ['chroot', 'linux_namespaces', 'linux_user_chroot']
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'backends(*names): run the test with these backends only')
+
+
+def pytest_generate_tests(metafunc):
+    if 'sandboxlib_executor' in metafunc.fixturenames:
+        marker = metafunc.definition.get_closest_marker('backends')
+        backends = list(marker.args) if marker is not None else BACKENDS
+        metafunc.parametrize('sandboxlib_executor', backends, indirect=True)
+
+
+@pytest.fixture()
+def sandboxlib_executor(request):
+    executor = getattr(sandboxlib, request.param)
+
+    if request.param == 'chroot' and os.getuid() != 0:
+        pytest.skip('chroot backend can only be used by root users')
+
+    if request.param == 'linux_namespaces' and \
+            not sandboxlib.linux_namespaces.namespaces_available():
+        pytest.skip('unable to create user namespaces')
+
+    return executor
@@ -121,7 +121,7 @@ int main(int argc, char *argv[]) {
         return 2;
     }
 
-    file = fopen(argv[0], "w");
+    file = fopen(argv[1], "w");
 
     if (file == NULL) {
         printf("Couldn't open %s for writing.", argv[1]);
@@ -154,3 +154,100 @@ def file_is_writable_test_program(session_tmpdir):
     build_c_program(
         FILE_IS_WRITABLE_TEST_PROGRAM, program_path, compiler_args=['-static'])
     return program_path
+
+
+WRITE_OUTPUT_TEST_PROGRAM = """
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+int main(int argc, char *argv[]) {
+    char buffer[65536];
+    long remaining, count;
+
+    if (argc != 2) {
+        fprintf(stderr, "Expected 1 argument: number of bytes to write.");
+        return 2;
+    }
+
+    memset(buffer, 'x', sizeof(buffer));
+    remaining = atol(argv[1]);
+
+    while (remaining > 0) {
+        count = remaining < (long)sizeof(buffer) ? remaining : sizeof(buffer);
+        if (fwrite(buffer, 1, count, stdout) != (size_t)count) {
+            return 1;
+        }
+        remaining -= count;
+    }
+
+    return 0;
+};
+"""
+
+
+@pytest.fixture(scope='session')
+def write_output_test_program(session_tmpdir):
+    '''Returns the path to a program that writes a given amount of output.
+
+    The program takes a number of bytes on the commandline, and writes that
+    many bytes to stdout. It returns 0 on success, 1 if the output couldn't
+    be written, or 2 on error.
+
+    '''
+    program_path = session_tmpdir.join('test-write-output')
+    build_c_program(
+        WRITE_OUTPUT_TEST_PROGRAM, program_path, compiler_args=['-static'])
+    return program_path
+
+
+COPY_FILE_TEST_PROGRAM = """
+#include <stdio.h>
+
+int main(int argc, char *argv[]) {
+    FILE *input, *output;
+    int c, i;
+
+    if (argc < 3) {
+        fprintf(stderr, "Expected at least 2 arguments: input and output.");
+        return 2;
+    }
+
+    input = fopen(argv[1], "r");
+    output = fopen(argv[2], "w");
+    if (input == NULL || output == NULL) {
+        printf("Couldn't open %s or %s.", argv[1], argv[2]);
+        return 1;
+    }
+
+    while ((c = fgetc(input)) != EOF) {
+        fputc(c, output);
+    }
+    fclose(input);
+    fclose(output);
+
+    for (i = 3; i < argc; i++) {
+        if (remove(argv[i]) != 0) {
+            printf("Couldn't delete %s.", argv[i]);
+            return 1;
+        }
+    }
+
+    return 0;
+};
+"""
+
+
+@pytest.fixture(scope='session')
+def copy_file_test_program(session_tmpdir):
+    '''Returns the path to a program that copies a file.
+
+    The program copies the file named by its first argument to the file
+    named by its second argument, and then deletes the files named by any
+    other arguments. It returns 0 on success, 1 on failure or 2 on error.
+
+    '''
+    program_path = session_tmpdir.join('test-copy-file')
+    build_c_program(
+        COPY_FILE_TEST_PROGRAM, program_path, compiler_args=['-static'])
+    return program_path
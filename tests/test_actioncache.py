@@ -0,0 +1,262 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.actioncache' module.'''
+
+
+import pytest
+
+import os
+import threading
+import time
+
+import sandboxlib
+from programs import file_is_writable_test_program, session_tmpdir
+
+
+class FakeSandbox(object):
+    '''Stands in for a backend's run_sandbox(), counting how often it runs.
+
+    Instead of running the command, it writes 'output' into the file named
+    by the last argument of the command, and returns 'output' as stdout.
+
+    '''
+
+    def __init__(self, output=b'output', exit=0, delay=0):
+        self.output = output
+        self.exit = exit
+        self.delay = delay
+        self.runs = 0
+
+    def __call__(self, command, stdout, stderr, filesystem_root, **kwargs):
+        self.runs += 1
+        time.sleep(self.delay)
+        path = os.path.join(filesystem_root, command[-1].lstrip('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(self.output)
+        if callable(stdout):
+            stdout(self.output)
+            stdout(b'')
+            out = None
+        else:
+            out = self.output
+        return sandboxlib.SandboxResult(self.exit, out, b'')
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    return sandboxlib.actioncache.ActionCache(str(tmpdir.join('cache')))
+
+
+@pytest.fixture()
+def root(tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('src', 'input').write('input', ensure=True)
+    return root
+
+
+def test_hit(cache, root):
+    sandbox = FakeSandbox()
+
+    result = cache.run(sandbox, ['make', '/out/file'],
+                       filesystem_root=str(root))
+    assert result == (0, b'output', b'')
+    assert not result.cached
+    assert root.join('out', 'file').read() == 'output'
+
+    # Going back to the original tree gives a hit, which recreates the
+    # output.
+    root.join('out').remove(rec=1)
+    result = cache.run(sandbox, ['make', '/out/file'],
+                       filesystem_root=str(root))
+    assert result == (0, b'output', b'')
+    assert result.cached
+    assert sandbox.runs == 1
+    assert root.join('out', 'file').read() == 'output'
+
+
+def test_inputs_change(cache, root):
+    sandbox = FakeSandbox()
+    config = dict(filesystem_root=str(root),
+                  filesystem_writable_paths=['/out'])
+
+    cache.run(sandbox, ['make', '/out/file'], env={'A': '1'}, **config)
+    root.join('out').remove(rec=1)
+    cache.run(sandbox, ['make', '/out/file'], env={'A': '2'}, **config)
+    assert sandbox.runs == 2
+
+    root.join('out').remove(rec=1)
+    root.join('src', 'input').write('changed')
+    cache.run(sandbox, ['make', '/out/file'], env={'A': '2'}, **config)
+    assert sandbox.runs == 3
+
+    root.join('out').remove(rec=1)
+    cache.run(sandbox, ['make', '/out/file'], env={'A': '2'}, **config)
+    assert sandbox.runs == 3
+
+
+def test_backend_is_part_of_digest(cache, root):
+    sandbox = FakeSandbox()
+    config = dict(filesystem_root=str(root),
+                  filesystem_writable_paths=['/out'])
+
+    cache.run(sandbox, ['make', '/out/file'], backend='sandboxlib.chroot',
+              **config)
+    root.join('out').remove(rec=1)
+    cache.run(sandbox, ['make', '/out/file'],
+              backend='sandboxlib.linux_namespaces', **config)
+    assert sandbox.runs == 2
+
+
+def test_output_to_consumer(cache, root):
+    sandbox = FakeSandbox()
+
+    for i in range(2):
+        chunks = []
+        if root.join('out').check():
+            root.join('out').remove(rec=1)
+        result = cache.run(sandbox, ['make', '/out/file'], stdout=chunks.append,
+                           filesystem_root=str(root))
+        assert result.stdout is None
+        assert b''.join(chunks) == b'output'
+        assert chunks[-1] == b''
+    assert sandbox.runs == 1
+
+
+def test_failures_not_cached(cache, root):
+    sandbox = FakeSandbox(exit=1)
+
+    for i in range(2):
+        if root.join('out').check():
+            root.join('out').remove(rec=1)
+        assert cache.run(sandbox, ['make', '/out/file'],
+                         filesystem_root=str(root)).exit == 1
+    assert sandbox.runs == 2
+
+
+def test_concurrent_runs_are_coalesced(cache, root, tmpdir):
+    sandbox = FakeSandbox(delay=0.5)
+    roots = [root]
+    for i in range(3):
+        copy = tmpdir.join('root%i' % i)
+        root.copy(copy)
+        roots.append(copy)
+
+    results = []
+
+    def run(path):
+        results.append(cache.run(sandbox, ['make', '/out/file'],
+                                 filesystem_root=str(path)))
+
+    threads = [threading.Thread(target=run, args=(path,)) for path in roots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sandbox.runs == 1
+    assert sorted(result.cached for result in results) == \
+        [False, True, True, True]
+    for path in roots:
+        assert path.join('out', 'file').read() == 'output'
+
+
+def test_deletions_and_symlinks(cache, root):
+    def sandbox(command, stdout, stderr, filesystem_root, **kwargs):
+        os.unlink(os.path.join(filesystem_root, 'src', 'input'))
+        os.symlink('target', os.path.join(filesystem_root, 'link'))
+        return sandboxlib.SandboxResult(0, b'', b'')
+
+    cache.run(sandbox, ['clean'], filesystem_root=str(root))
+
+    root.join('src', 'input').write('input')
+    root.join('link').remove()
+    result = cache.run(sandbox, ['clean'], filesystem_root=str(root))
+    assert result.cached
+    assert not root.join('src', 'input').exists()
+    assert os.readlink(str(root.join('link'))) == 'target'
+
+
+def test_owner_and_mtime(cache, root):
+    def sandbox(command, stdout, stderr, filesystem_root, **kwargs):
+        directory = os.path.join(filesystem_root, 'out')
+        path = os.path.join(directory, 'file')
+        os.mkdir(directory)
+        with open(path, 'w') as f:
+            f.write('output')
+        for created in [path, directory]:
+            if os.geteuid() == 0:
+                os.chown(created, 1234, 5678)
+            os.utime(created, (1000000000, 1000000000))
+        return sandboxlib.SandboxResult(0, b'', b'')
+
+    cache.run(sandbox, ['make'], filesystem_root=str(root))
+    root.join('out').remove(rec=1)
+    result = cache.run(sandbox, ['make'], filesystem_root=str(root))
+    assert result.cached
+
+    for created in [root.join('out', 'file'), root.join('out')]:
+        st = created.lstat()
+        assert st.mtime == 1000000000
+        if os.geteuid() == 0:
+            assert (st.uid, st.gid) == (1234, 5678)
+        else:
+            assert st.uid == os.geteuid()
+
+
+def test_evict(cache, root, tmpdir):
+    for i in range(3):
+        cache.run(FakeSandbox(output=b'x' * 1000), ['make', '/out/%i' % i],
+                  filesystem_root=str(tmpdir.mkdir('root%i' % i)))
+    assert len(cache.entries()) == 3
+
+    # Each entry holds 1000 bytes of output, and a 1000 byte file.
+    cache.evict(4500)
+    assert len(cache.entries()) == 2
+
+
+def test_root_not_allowed(cache):
+    with pytest.raises(AssertionError):
+        cache.run(FakeSandbox(), ['true'], filesystem_root='/')
+
+
+def test_run_sandbox(cache, tmpdir, file_is_writable_test_program):
+    if not sandboxlib.linux_namespaces.namespaces_available():
+        pytest.skip('unable to create user namespaces')
+
+    root = tmpdir.mkdir('root')
+    root.mkdir('bin')
+    root.mkdir('out')
+    file_is_writable_test_program.copy(root.join('bin'))
+    root.join('bin', 'test-file-is-writable').chmod(0o755)
+
+    def run():
+        return sandboxlib.linux_namespaces.run_sandbox(
+            ['/bin/test-file-is-writable', '/out/file'],
+            filesystem_root=str(root), filesystem_writable_paths=['/out'],
+            action_cache=cache)
+
+    result = run()
+    assert result.exit == 0
+    assert not result.cached
+    assert root.join('out', 'file').read() == '!'
+
+    root.join('out', 'file').remove()
+    result = run()
+    assert result == (0, b'Wrote data to /out/file.', b'')
+    assert result.cached
+    assert root.join('out', 'file').read() == '!'
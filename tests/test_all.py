@@ -19,21 +19,14 @@
 import pytest
 
 import os
+import pickle
+import sys
+import time
 
 import sandboxlib
 from programs import (
     file_is_writable_test_program, file_or_directory_exists_test_program,
-    session_tmpdir)
-
-
-@pytest.fixture(params=['chroot', 'linux_user_chroot'])
-def sandboxlib_executor(request):
-    executor = getattr(sandboxlib, request.param)
-
-    if request.param == 'chroot' and os.getuid() != 0:
-        pytest.skip('chroot backend can only be used by root users')
-
-    return executor
+    session_tmpdir, write_output_test_program)
 
 
 def test_no_output(sandboxlib_executor):
@@ -68,6 +61,61 @@ def test_current_working_directory(sandboxlib_executor, tmpdir):
     assert err.decode('unicode-escape') == ''
 
 
+def test_result_details(sandboxlib_executor):
+    result = sandboxlib_executor.run_sandbox(
+        ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'])
+
+    exit, out, err = result
+    assert (result.exit, result.stdout, result.stderr) == (exit, out, err)
+    assert exit == 0
+
+    assert list(result.timings)[0] == 'config'
+    assert 'spawn' in result.timings
+    assert 'run' in result.timings
+    assert all(seconds >= 0 for seconds in result.timings.values())
+
+    assert result.rusage.ru_utime + result.rusage.ru_stime > 0
+    assert result.rusage.ru_maxrss > 0
+
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy == result
+    assert copy.timings == result.timings
+
+
+def test_stdout_consumer(sandboxlib_executor):
+    chunks = []
+    lines = []
+    exit, out, err = sandboxlib_executor.run_sandbox(
+        ['sh', '-c', 'echo xyzzy; echo plugh; printf no-newline'],
+        stdout=chunks.append,
+        stderr=sandboxlib.output.LineSplitter(lines.append))
+
+    assert exit == 0
+    assert out is None
+    assert err is None
+    assert b''.join(chunks) == b'xyzzy\nplugh\nno-newline'
+    assert chunks[-1] == b''
+    assert lines == []
+
+
+def test_large_output_to_consumer(sandboxlib_executor, tmpdir,
+                                  write_output_test_program):
+    sandbox_path = tmpdir.mkdir('sandbox')
+    bin_path = sandbox_path.mkdir('bin')
+    write_output_test_program.copy(bin_path)
+    bin_path.join('test-write-output').chmod(0o755)
+
+    tail = sandboxlib.output.TailBuffer(max_size=16)
+    exit, out, err = sandboxlib_executor.run_sandbox(
+        ['test-write-output', str(32 * 1024 * 1024)],
+        filesystem_root=str(sandbox_path), stdout=tail)
+
+    assert exit == 0
+    assert out is None
+    assert tail.total_size == 32 * 1024 * 1024
+    assert tail.getvalue() == b'x' * 16
+
+
 class TestMounts(object):
     @pytest.fixture()
     def mounts_test_sandbox(self, tmpdir,
@@ -184,8 +232,10 @@ class TestWriteablePaths(object):
         if sandboxlib_executor == sandboxlib.chroot:
             pytest.xfail("chroot backend doesn't support read-only paths.")
 
+        # The tmpfs hides the existing contents of /data, so we write to a
+        # new file.
         exit, out, err = sandboxlib_executor.run_sandbox(
-            ['test-file-is-writable', '/data/1/canary'],
+            ['test-file-is-writable', '/data/canary'],
             filesystem_root=str(writable_paths_test_sandbox),
             filesystem_writable_paths=['/data'],
             extra_mounts=[
@@ -194,8 +244,249 @@ class TestWriteablePaths(object):
 
         assert err.decode('unicode-escape') == ''
         assert out.decode('unicode-escape') == \
-            "Wrote data to /data/1/canary."
+            "Wrote data to /data/canary."
+        assert exit == 0
+
+
+class TestOverlay(object):
+    @pytest.fixture()
+    def overlay_test_sandbox(self, tmpdir, file_is_writable_test_program):
+        sandbox_path = tmpdir.mkdir('sandbox')
+
+        bin_path = sandbox_path.mkdir('bin')
+        file_is_writable_test_program.copy(bin_path)
+        bin_path.join('test-file-is-writable').chmod(0o755)
+
+        sandbox_path.mkdir('data').join('canary').write(
+            "Please don't overwrite me.")
+
+        return sandbox_path
+
+    def run_test_program(self, executor, overlay):
+        return executor.run_sandbox(
+            ['test-file-is-writable', '/data/canary'],
+            filesystem_root=overlay)
+
+    def test_changes_discarded(self, sandboxlib_executor,
+                               overlay_test_sandbox):
+        overlay = sandboxlib.overlay.Overlay(str(overlay_test_sandbox))
+
+        if sandboxlib_executor == sandboxlib.linux_user_chroot:
+            with pytest.raises(AssertionError):
+                self.run_test_program(sandboxlib_executor, overlay)
+            return
+
+        exit, out, err = self.run_test_program(sandboxlib_executor, overlay)
+
+        assert err.decode('unicode-escape') == ''
+        assert out.decode('unicode-escape') == "Wrote data to /data/canary."
+        assert exit == 0
+        assert overlay_test_sandbox.join('data', 'canary').read() == \
+            "Please don't overwrite me."
+        assert overlay.upper is None
+
+    def test_changes_kept(self, sandboxlib_executor, overlay_test_sandbox,
+                          tmpdir):
+        if sandboxlib_executor == sandboxlib.linux_user_chroot:
+            pytest.skip("linux_user_chroot doesn't support overlays.")
+
+        overlay = sandboxlib.overlay.Overlay(
+            str(overlay_test_sandbox), changes=str(tmpdir.join('changes')))
+
+        exit, out, err = self.run_test_program(sandboxlib_executor, overlay)
+
         assert exit == 0
+        assert overlay_test_sandbox.join('data', 'canary').read() == \
+            "Please don't overwrite me."
+        upper = tmpdir.join('changes', 'upper')
+        assert str(upper) == overlay.upper
+        assert upper.join('data', 'canary').read() != \
+            "Please don't overwrite me."
+        assert not upper.join('bin').exists()
+
+        overlay.discard_changes()
+        assert not upper.exists()
+
+
+def processes_with_argument(argument):
+    pids = []
+    for pid in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                if argument.encode('ascii') in f.read().split(b'\0'):
+                    pids.append(pid)
+        except (IOError, OSError):
+            pass
+    return pids
+
+
+def wait_for_processes_to_exit(marker):
+    for i in range(100):
+        if not processes_with_argument(marker):
+            break
+        time.sleep(0.01)
+    return processes_with_argument(marker)
+
+
+def unique_sleep_argument():
+    # A distinctive argument for 'sleep', so we can find the processes
+    # afterwards.
+    return '%i.%i' % (1000 + os.getpid() % 1000, time.time() * 1000 % 1000)
+
+
+class TestTimeout(object):
+    def test_timeout_kills_process_tree(self, sandboxlib_executor):
+        marker = unique_sleep_argument()
+
+        start = time.time()
+        result = sandboxlib_executor.run_sandbox(
+            ['sh', '-c', 'echo started; sleep %s & sleep %s; wait' % (
+                marker, marker)],
+            timeout=0.5)
+
+        assert time.time() - start < 10
+        assert result.timed_out == sandboxlib.TIMEOUT_WALL_CLOCK
+        assert result.exit < 0
+        assert result.stdout == b'started\n'
+        assert wait_for_processes_to_exit(marker) == []
+
+    def test_no_timeout(self, sandboxlib_executor):
+        result = sandboxlib_executor.run_sandbox(
+            ['echo', 'xyzzy'], stdout=None, stderr=None, timeout=60)
+
+        assert result.exit == 0
+        assert result.timed_out is None
+
+    def test_cpu_time_limit(self, sandboxlib_executor):
+        start = time.time()
+        result = sandboxlib_executor.run_sandbox(
+            ['sh', '-c', 'while true; do :; done'], cpu_time_limit=1)
+
+        assert time.time() - start < 30
+        assert result.timed_out == sandboxlib.TIMEOUT_CPU_TIME
+        assert result.exit < 0
+
+    def test_sandbox_run(self, sandboxlib_executor, tmpdir):
+        with sandboxlib_executor.Sandbox(cwd=str(tmpdir)) as sandbox:
+            result = sandbox.run(['sleep', '30'], timeout=0.2)
+            assert result.timed_out == sandboxlib.TIMEOUT_WALL_CLOCK
+
+            result = sandbox.run(['true'], timeout=30)
+            assert (result.exit, result.timed_out) == (0, None)
+
+
+class TestSandbox(object):
+    def test_run_many(self, sandboxlib_executor, tmpdir):
+        sandbox = sandboxlib_executor.Sandbox(
+            cwd=str(tmpdir), env={'A': '1'},
+            extra_mounts=[(None, str(tmpdir.join('tmp')), 'tmpfs')])
+        with sandbox:
+            for i in range(5):
+                exit, out, err = sandbox.run(
+                    ['sh', '-c', 'echo $A; pwd; exit %i' % i])
+                assert exit == i
+                assert out.decode('unicode-escape') == '1\n%s\n' % tmpdir
+
+            exit, out, err = sandbox.run(['sh', '-c', 'echo $A$B'],
+                                         env={'B': '2'})
+            assert out == b'2\n'
+
+            assert sandbox.run_with_redirection(
+                ['true'], stdout=None, stderr=None) == 0
+
+        assert 'config' in sandbox.timer.timings
+
+        with pytest.raises(RuntimeError):
+            sandbox.run(['true'])
+
+    def test_mounts_persist(self, sandboxlib_executor, tmpdir):
+        if sandboxlib_executor == sandboxlib.linux_namespaces:
+            pytest.skip("linux_namespaces mounts are per-command.")
+
+        mount_point = tmpdir.join('tmp')
+        with sandboxlib_executor.Sandbox(
+                extra_mounts=[(None, str(mount_point), 'tmpfs')]) as sandbox:
+            assert sandbox.run(
+                ['sh', '-c', 'echo data > %s/file' % mount_point]).exit == 0
+            exit, out, err = sandbox.run(['cat', '%s/file' % mount_point])
+            assert out == b'data\n'
+
+
+@pytest.fixture()
+def event_loop():
+    if sys.version_info < (3, 5):
+        pytest.skip('asyncio API needs Python 3.5 or later')
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+class TestAsync(object):
+    def test_stdout(self, sandboxlib_executor, event_loop):
+        exit, out, err = event_loop.run_until_complete(
+            sandboxlib_executor.run_sandbox_async(
+                ['sh', '-c', 'echo xyzzy; echo plugh >&2']))
+
+        assert exit == 0
+        assert out.decode('unicode-escape') == 'xyzzy\n'
+        assert err.decode('unicode-escape') == 'plugh\n'
+
+    def test_no_output(self, sandboxlib_executor, event_loop):
+        exit, out, err = event_loop.run_until_complete(
+            sandboxlib_executor.run_sandbox_async(
+                ['sh', '-c', 'exit 3'], stdout=None, stderr=None))
+
+        assert exit == 3
+        assert out is None
+        assert err is None
+
+    def test_concurrent(self, sandboxlib_executor, event_loop):
+        import asyncio
+
+        results = event_loop.run_until_complete(asyncio.gather(*[
+            sandboxlib_executor.run_sandbox_async(['echo', str(i)])
+            for i in range(10)]))
+
+        assert [out for exit, out, err in results] == [
+            ('%i\n' % i).encode('ascii') for i in range(10)]
+
+    def test_cancel_kills_process_tree(self, sandboxlib_executor, event_loop):
+        import asyncio
+
+        marker = unique_sleep_argument()
+
+        task = event_loop.create_task(sandboxlib_executor.run_sandbox_async(
+            ['sh', '-c', 'sleep %s & sleep %s; wait' % (marker, marker)]))
+
+        for i in range(500):
+            if len(processes_with_argument(marker)) == 2 or task.done():
+                break
+            event_loop.run_until_complete(asyncio.sleep(0.01))
+        if task.done():
+            task.result()
+        assert len(processes_with_argument(marker)) == 2
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            event_loop.run_until_complete(task)
+
+        assert wait_for_processes_to_exit(marker) == []
+
+    def test_timeout(self, sandboxlib_executor, event_loop):
+        marker = unique_sleep_argument()
+
+        result = event_loop.run_until_complete(
+            sandboxlib_executor.run_sandbox_async(
+                ['sh', '-c', 'echo started; sleep %s & sleep %s; wait' % (
+                    marker, marker)],
+                timeout=0.5))
+
+        assert result.timed_out == sandboxlib.TIMEOUT_WALL_CLOCK
+        assert result.stdout == b'started\n'
+        assert wait_for_processes_to_exit(marker) == []
 
 
 def test_executor_for_platform():
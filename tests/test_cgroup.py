@@ -0,0 +1,126 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.cgroup' module.'''
+
+
+import pytest
+
+import os
+import sys
+import warnings
+
+import sandboxlib
+
+
+@pytest.fixture()
+def cgroup_parent():
+    parent = sandboxlib.cgroup.default_cgroup_parent()
+    if parent is None:
+        pytest.skip('unable to create cgroups')
+    return parent
+
+
+def require_controller(parent, controller):
+    if controller not in sandboxlib.cgroup.usable_controllers(parent):
+        pytest.skip("the '%s' cgroup controller is not available" %
+                    controller)
+
+
+def our_cgroups(parent):
+    prefix = 'sandboxlib-%i-' % os.getpid()
+    return [name for name in os.listdir(parent) if name.startswith(prefix)]
+
+
+def test_usage(cgroup_parent):
+    if not sandboxlib.linux_namespaces.namespaces_available():
+        pytest.skip('unable to create user namespaces')
+
+    result = sandboxlib.linux_namespaces.run_sandbox(
+        ['sh', '-c', 'i=0; while [ $i -lt 10000 ]; do i=$((i+1)); done'],
+        resources={})
+    assert result.exit == 0
+    assert 'cgroup' in result.timings
+    assert result.cgroup_usage.cpu_usage > 0
+    assert our_cgroups(cgroup_parent) == []
+
+
+def test_no_resources():
+    if not sandboxlib.linux_namespaces.namespaces_available():
+        pytest.skip('unable to create user namespaces')
+
+    result = sandboxlib.linux_namespaces.run_sandbox(['true'])
+    assert result.cgroup_usage is None
+
+
+def test_memory_limit(cgroup_parent):
+    require_controller(cgroup_parent, 'memory')
+
+    result = sandboxlib.linux_namespaces.run_sandbox(
+        [sys.executable, '-c', 'x = bytearray(256 * 1024 * 1024)'],
+        resources={'memory.max': 32 * 1024 * 1024})
+    assert result.exit != 0
+    assert result.cgroup_usage.oom_kills >= 1
+    assert result.cgroup_usage.memory_peak is None or \
+        result.cgroup_usage.memory_peak <= 32 * 1024 * 1024
+
+
+def test_leftover_processes_are_killed(cgroup_parent):
+    if os.getuid() != 0:
+        pytest.skip('chroot backend can only be used by root users')
+
+    # The chroot backend doesn't use a PID namespace, so the background
+    # process outlives the command.
+    result = sandboxlib.chroot.run_sandbox(
+        ['sh', '-c', 'sleep 1000 >/dev/null 2>&1 &'], resources={})
+    assert result.exit == 0
+    assert our_cgroups(cgroup_parent) == []
+
+
+def test_unsupported_resource():
+    with pytest.raises(AssertionError):
+        sandboxlib.linux_namespaces.run_sandbox(
+            ['true'], resources={'cpuset.cpus': '0'})
+
+
+def test_missing_controller(cgroup_parent, monkeypatch):
+    monkeypatch.setattr(sandboxlib.cgroup, 'usable_controllers',
+                        lambda parent: set())
+    with pytest.raises(RuntimeError):
+        sandboxlib.linux_namespaces.run_sandbox(
+            ['true'], resources={'pids.max': 10})
+
+
+def test_degrade_config_for_capabilities(monkeypatch):
+    monkeypatch.setattr(sandboxlib.cgroup, 'default_cgroup_parent',
+                        lambda: None)
+    in_config = {'resources': {'memory.max': 1024 * 1024}}
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        out_config = sandboxlib.linux_namespaces.\
+            degrade_config_for_capabilities(in_config, warn=True)
+    assert out_config['resources'] is None
+    assert len(caught) == 1
+    assert in_config['resources'] == {'memory.max': 1024 * 1024}
+
+
+def test_degrade_missing_controller(cgroup_parent, monkeypatch):
+    monkeypatch.setattr(sandboxlib.cgroup, 'usable_controllers',
+                        lambda parent: set(['pids']))
+    out_config = sandboxlib.chroot.degrade_config_for_capabilities(
+        {'resources': {'memory.max': 1024 * 1024, 'pids.max': 10}},
+        warn=False)
+    assert out_config['resources'] == {'pids.max': 10}
@@ -0,0 +1,184 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.cleanup' module.'''
+
+
+import pytest
+
+import fcntl
+import os
+import subprocess
+import sys
+
+import sandboxlib
+
+
+def make_tree(path):
+    for i in range(10):
+        path.join('dir', str(i), 'file').write('x' * 100, ensure=True)
+    return path
+
+
+def test_remove_tree(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    trash_dir = tmpdir.join('trash')
+
+    sandboxlib.cleanup.remove_tree(str(tree), trash_dir=str(trash_dir))
+    assert not tree.exists()
+
+    sandboxlib.cleanup.wait_for_cleanup()
+    assert trash_dir.listdir() == []
+
+
+def test_remove_file(tmpdir):
+    path = tmpdir.join('file')
+    path.write('x')
+
+    sandboxlib.cleanup.remove_tree(str(path),
+                                   trash_dir=str(tmpdir.join('trash')))
+    sandboxlib.cleanup.wait_for_cleanup()
+    assert not path.exists()
+
+
+def test_default_trash_dir(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+
+    trash_dir = sandboxlib.cleanup.default_trash_dir(str(tree))
+    assert os.stat(os.path.dirname(trash_dir)).st_dev == \
+        os.stat(str(tmpdir)).st_dev
+
+    sandboxlib.cleanup.remove_tree(str(tree))
+    sandboxlib.cleanup.wait_for_cleanup()
+    assert not tree.exists()
+
+
+@pytest.mark.parametrize('kind', ['symlink', 'shared', 'file'])
+def test_refuse_unsafe_default_trash_dir(tmpdir, monkeypatch, kind):
+    trash_dir = tmpdir.join('trash')
+    if kind == 'symlink':
+        trash_dir.mksymlinkto(tmpdir.mkdir('elsewhere'))
+    elif kind == 'shared':
+        trash_dir.mkdir().chmod(0o777)
+    else:
+        trash_dir.write('')
+    monkeypatch.setattr(sandboxlib.cleanup, 'default_trash_dir',
+                        lambda path: str(trash_dir))
+    tree = make_tree(tmpdir.join('tree'))
+
+    with pytest.raises(RuntimeError):
+        sandboxlib.cleanup.remove_tree(str(tree))
+    assert tree.exists()
+
+
+def test_default_trash_dir_is_private(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    trash_dir = sandboxlib.cleanup.default_trash_dir(str(tree))
+
+    sandboxlib.cleanup.remove_tree(str(tree))
+    sandboxlib.cleanup.wait_for_cleanup()
+    assert os.lstat(trash_dir).st_mode & 0o777 == 0o700
+
+
+def test_trash_deleted_at_exit(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    trash_dir = tmpdir.join('trash')
+
+    # The process exits without calling wait_for_cleanup().
+    subprocess.check_call([
+        sys.executable, '-c',
+        'import sandboxlib; sandboxlib.cleanup.remove_tree(%r, trash_dir=%r)'
+        % (str(tree), str(trash_dir))],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert not tree.exists()
+    assert trash_dir.listdir() == []
+
+
+def test_read_only_directories(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    for i in range(10):
+        tree.join('dir', str(i)).chmod(0o500)
+    tree.join('dir').chmod(0o500)
+    trash_dir = tmpdir.join('trash')
+
+    sandboxlib.cleanup.remove_tree(str(tree), trash_dir=str(trash_dir))
+    sandboxlib.cleanup.wait_for_cleanup()
+    assert trash_dir.listdir() == []
+
+
+def test_purge_leftovers(tmpdir):
+    trash_dir = tmpdir.join('trash')
+
+    # Nothing holds a lock on this, so it is purged even though it is named
+    # after a process that is still running: the PID may have been reused,
+    # or belong to another PID namespace.
+    leftover = make_tree(trash_dir.join('%i-abc' % os.getppid()))
+    # An entry that is locked still belongs to some process.
+    running = make_tree(trash_dir.join('99999999-abc'))
+    fd = os.open(str(running), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        sandboxlib.cleanup.purge_trash(str(trash_dir))
+        sandboxlib.cleanup.wait_for_cleanup()
+    finally:
+        os.close(fd)
+
+    assert not leftover.exists()
+    assert running.exists()
+
+
+def test_trash_is_locked_until_deleted(tmpdir):
+    trash_dir = tmpdir.join('trash')
+    # Another process must not purge trash that is waiting to be deleted.
+    script = (
+        'import sandboxlib.cleanup, sys, threading\n'
+        'lock = threading.Lock()\n'
+        'lock.acquire()\n'
+        'sandboxlib.cleanup._delete = lambda path: lock.acquire()\n'
+        'sandboxlib.cleanup.remove_tree(sys.argv[1], trash_dir=sys.argv[2])\n'
+        'sys.stdout.write("removed\\n")\n'
+        'sys.stdout.flush()\n'
+        'sys.stdin.read()\n'
+        'lock.release()\n')
+    tree = make_tree(tmpdir.join('tree'))
+    source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, '-c', script, str(tree), str(trash_dir)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=source_dir)
+    try:
+        assert process.stdout.readline() == b'removed\n'
+        [entry] = trash_dir.listdir()
+
+        sandboxlib.cleanup.purge_trash(str(trash_dir))
+        sandboxlib.cleanup.wait_for_cleanup()
+        assert entry.join('tree').exists()
+    finally:
+        process.communicate()
+    assert process.returncode == 0
+
+    # The process has exited, so what it left behind can now be purged.
+    subprocess.check_call([
+        sys.executable, '-c',
+        'import sandboxlib; sandboxlib.cleanup.purge_trash(%r)'
+        % str(trash_dir)], cwd=source_dir)
+    assert trash_dir.listdir() == []
+
+
+def test_remove_tree_with_missing_source(tmpdir):
+    with pytest.raises(OSError):
+        sandboxlib.cleanup.remove_tree(
+            str(tmpdir.join('missing')), trash_dir=str(tmpdir.join('trash')))
+    assert tmpdir.join('trash').listdir() == []
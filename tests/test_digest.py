@@ -0,0 +1,130 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.digest' module.'''
+
+
+import pytest
+
+import os
+
+import sandboxlib
+
+
+def make_tree(path):
+    path.join('bin', 'program').write('program', ensure=True)
+    path.join('etc', 'config').write('config', ensure=True)
+    path.join('out', 'result').write('result', ensure=True)
+    path.join('bin', 'link').mksymlinkto('program')
+    return path
+
+
+@pytest.fixture()
+def no_racy_files(monkeypatch):
+    # Files changed in the last few seconds aren't normally added to a
+    # StatCache.
+    monkeypatch.setattr(sandboxlib.digest, '_RACY_SECONDS', 0)
+
+
+def test_copies_match(tmpdir):
+    first = sandboxlib.digest.tree_digest(str(make_tree(tmpdir.join('a'))))
+    second = sandboxlib.digest.tree_digest(str(make_tree(tmpdir.join('b'))))
+
+    assert first == second
+    assert first.digest == second.digest
+    assert first.subtree_digest('/bin') == second.subtree_digest('bin')
+
+
+def test_changes(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    before = sandboxlib.digest.tree_digest(str(tree))
+
+    tree.join('out', 'result').write('changed')
+    after = sandboxlib.digest.tree_digest(str(tree))
+
+    assert before != after
+    assert before.subtree_digest('bin') == after.subtree_digest('bin')
+    assert before.subtree_digest('out') != after.subtree_digest('out')
+    assert before.subtree_digest('missing') is None
+
+    assert before.changed_paths(after, ['/bin', '/out', 'new']) == ['/out']
+    tree.join('new').write('new')
+    assert before.changed_paths(
+        sandboxlib.digest.tree_digest(str(tree)), ['/bin', 'new']) == ['new']
+
+    tree.join('bin', 'program').chmod(0o700)
+    assert sandboxlib.digest.tree_digest(str(tree)).subtree_digest('bin') != \
+        before.subtree_digest('bin')
+
+
+def test_excluded(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+    before = sandboxlib.digest.tree_digest(str(tree), excluded=['/out'])
+
+    tree.join('out', 'result').write('changed')
+    after = sandboxlib.digest.tree_digest(str(tree), excluded=['/out'])
+
+    assert before == after
+    assert after.subtree_digest('out') is None
+
+
+def test_stat_cache(tmpdir, monkeypatch, no_racy_files):
+    tree = make_tree(tmpdir.join('tree'))
+    cache_path = str(tmpdir.join('stat-cache'))
+
+    stat_cache = sandboxlib.digest.StatCache(cache_path)
+    first = sandboxlib.digest.tree_digest(str(tree), stat_cache=stat_cache)
+    stat_cache.save()
+    assert len(stat_cache) == 3
+
+    read = []
+    real_file_digest = sandboxlib.digest.file_digest
+
+    def file_digest(path):
+        read.append(os.path.relpath(path, str(tree)))
+        return real_file_digest(path)
+
+    monkeypatch.setattr(sandboxlib.digest, 'file_digest', file_digest)
+
+    # Only the file that changed is read again, even by a new process.
+    tree.join('out', 'result').write('changed')
+    stat_cache = sandboxlib.digest.StatCache(cache_path)
+    second = sandboxlib.digest.tree_digest(
+        str(tree), stat_cache=stat_cache, threads=4)
+    assert read == ['out/result']
+    assert first.subtree_digest('etc') == second.subtree_digest('etc')
+    assert first != second
+
+    # The result is the same as without a cache.
+    assert second == sandboxlib.digest.tree_digest(str(tree))
+
+
+def test_stat_cache_max_entries(tmpdir, no_racy_files):
+    tree = make_tree(tmpdir.join('tree'))
+    cache_path = str(tmpdir.join('stat-cache'))
+
+    stat_cache = sandboxlib.digest.StatCache(cache_path)
+    sandboxlib.digest.tree_digest(str(tree), stat_cache=stat_cache)
+    stat_cache.save()
+
+    assert len(sandboxlib.digest.StatCache(cache_path, max_entries=2)) == 2
+
+
+def test_recently_changed_files_not_cached(tmpdir):
+    tree = make_tree(tmpdir.join('tree'))
+
+    stat_cache = sandboxlib.digest.StatCache()
+    sandboxlib.digest.tree_digest(str(tree), stat_cache=stat_cache)
+    assert len(stat_cache) == 0
@@ -0,0 +1,140 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for running commands through sandboxlib.forkserver.'''
+
+
+import signal
+import sys
+import time
+
+import pytest
+
+import sandboxlib
+
+
+pytestmark = [
+    pytest.mark.skipif(sys.version_info < (3, 5),
+                       reason='fork server needs Python 3.5 or later'),
+    pytest.mark.backends('chroot', 'linux_namespaces'),
+]
+
+
+def test_run_many(sandboxlib_executor, tmpdir):
+    with sandboxlib.forkserver.ForkServer(
+            sandboxlib_executor, cwd=str(tmpdir)) as server:
+        for i in range(20):
+            exit, out, err = server.run_sandbox(
+                ['sh', '-c', 'echo %i; pwd; echo error >&2; exit %i' % (i, i)])
+
+            assert exit == i
+            assert out.decode('unicode-escape') == '%i\n%s\n' % (i, tmpdir)
+            assert err.decode('unicode-escape') == 'error\n'
+
+
+def test_env_and_consumers(sandboxlib_executor):
+    chunks = []
+    with sandboxlib.forkserver.ForkServer(
+            sandboxlib_executor, env={'A': '1'}) as server:
+        result = server.run_sandbox(['sh', '-c', 'echo $A$B'],
+                                    stdout=chunks.append, stderr=None)
+        assert result == (0, None, None)
+        assert b''.join(chunks) == b'1\n'
+        assert result.rusage is not None
+
+        exit, out, err = server.run_sandbox(
+            ['sh', '-c', 'echo $A$B'], env={'B': '2'}, stderr=sandboxlib.STDOUT)
+        assert out == b'2\n'
+
+
+def test_exec_error(sandboxlib_executor):
+    with sandboxlib.forkserver.ForkServer(sandboxlib_executor) as server:
+        with pytest.raises(OSError) as excinfo:
+            server.run_sandbox(['this-program-does-not-exist'])
+        assert excinfo.value.filename == 'this-program-does-not-exist'
+
+        # The server carries on working.
+        assert server.run_sandbox(['true']).exit == 0
+
+
+def test_setup_error(sandboxlib_executor, tmpdir):
+    server = sandboxlib.forkserver.ForkServer(
+        sandboxlib_executor, filesystem_root=str(tmpdir.join('missing')))
+    with pytest.raises(RuntimeError):
+        server.start()
+
+
+def test_kill(sandboxlib_executor):
+    with sandboxlib.forkserver.ForkServer(sandboxlib_executor) as server:
+        process = server.spawn(['sleep', '1000'], None, None)
+        assert process.poll() is None
+        process.kill(signal.SIGTERM)
+        assert process.wait() == -signal.SIGTERM
+
+
+def test_consumer_error_kills_command(sandboxlib_executor, tmpdir):
+    def consumer(data):
+        if data:
+            raise ValueError("Consumer failed")
+
+    with sandboxlib.forkserver.ForkServer(
+            sandboxlib_executor, cwd=str(tmpdir)) as server:
+        # The traceback keeps the process, and so its connection to the
+        # server, alive while we check that the command was killed.
+        with pytest.raises(ValueError) as excinfo:
+            server.run_sandbox(
+                ['sh', '-c', 'echo start; sleep 0.5; touch finished'],
+                stdout=consumer)
+        time.sleep(1)
+        assert not tmpdir.join('finished').exists()
+        del excinfo
+
+        # The server carries on working.
+        assert server.run_sandbox(['true']).exit == 0
+
+
+def test_many_commands_at_once(sandboxlib_executor):
+    # Commands exiting while others start mustn't leave the server waiting
+    # on a connection that isn't ready.
+    with sandboxlib.forkserver.ForkServer(sandboxlib_executor) as server:
+        processes = []
+        for i in range(50):
+            processes.append(server.spawn(['sh', '-c', 'exit %i' % i],
+                                          None, None))
+        assert [process.wait() for process in processes] == list(range(50))
+
+
+def test_cpu_time_limit(sandboxlib_executor):
+    with sandboxlib.forkserver.ForkServer(sandboxlib_executor) as server:
+        result = server.run_sandbox(
+            ['sh', '-c', 'while true; do :; done'], cpu_time_limit=1,
+            timeout=30)
+        assert result.timed_out == sandboxlib.TIMEOUT_CPU_TIME
+        assert result.exit < 0
+
+        # The limit only applies to that command.
+        exit, out, err = server.run_sandbox(['sh', '-c', 'ulimit -t'])
+        assert out == b'unlimited\n'
+
+
+def test_fork_server_is_reused(sandboxlib_executor):
+    try:
+        server = sandboxlib.forkserver.fork_server(
+            sandboxlib_executor, filesystem_root='/')
+        assert sandboxlib.forkserver.fork_server(
+            sandboxlib_executor, filesystem_root='/') is server
+        assert server.run_sandbox(['true']).exit == 0
+    finally:
+        sandboxlib.forkserver.close_fork_servers()
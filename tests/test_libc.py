@@ -0,0 +1,41 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.libc' module.'''
+
+
+import pytest
+
+from sandboxlib import libc
+
+
+@pytest.mark.parametrize('options, expected', [
+    (None, (0, None)),
+    ('', (0, None)),
+    ('defaults', (0, None)),
+    ('ro,nosuid,nodev', (libc.MS_RDONLY | libc.MS_NOSUID | libc.MS_NODEV,
+                         None)),
+    ('ro,rw', (0, None)),
+    ('rbind,ro', (libc.MS_BIND | libc.MS_REC | libc.MS_RDONLY, None)),
+    ('size=10m,mode=0755,noexec', (libc.MS_NOEXEC, 'size=10m,mode=0755')),
+    ('noauto,nofail,x-systemd.automount,mode=1777', (0, 'mode=1777')),
+])
+def test_parse_mount_options(options, expected):
+    assert libc.parse_mount_options(options) == expected
+
+
+def test_parse_mount_options_loop():
+    with pytest.raises(ValueError):
+        libc.parse_mount_options('loop,ro')
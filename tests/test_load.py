@@ -0,0 +1,513 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.load' image loaders.'''
+
+
+import pytest
+
+import io
+import json
+import os
+import tarfile
+
+import sandboxlib
+
+
+def make_app_container_image(path, name, data):
+    '''Create a minimal App Container image at 'path'.'''
+    image_dir = path.dirpath().join('%s.image' % path.basename)
+    image_dir.join('manifest').write(
+        json.dumps({'name': name, 'app': {'exec': ['/bin/true']}}),
+        ensure=True)
+    image_dir.join('rootfs', 'data').write(data, ensure=True)
+
+    with tarfile.open(str(path), 'w:gz') as tf:
+        tf.add(str(image_dir.join('manifest')), arcname='manifest')
+        tf.add(str(image_dir.join('rootfs')), arcname='rootfs')
+
+    return path
+
+
+@pytest.fixture()
+def app_container_image(tmpdir):
+    return make_app_container_image(
+        tmpdir.join('test.aci'), 'test/test', 'x' * 1000)
+
+
+def test_unpack_app_container_image(app_container_image):
+    context = sandboxlib.load.appc.unpack_app_container_image(
+        str(app_container_image))
+    with context as (rootfs_path, manifest):
+        assert manifest['name'] == 'test/test'
+        assert os.path.exists(os.path.join(rootfs_path, 'data'))
+    assert not os.path.exists(rootfs_path)
+
+
+class TestImageStore(object):
+    def test_reuse(self, tmpdir, app_container_image):
+        store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+
+        with store.unpack(str(app_container_image)) as (rootfs_path, manifest):
+            first_rootfs_path = rootfs_path
+            assert manifest['name'] == 'test/test'
+
+        # The unpacked image is kept around, and reused next time.
+        assert os.path.exists(first_rootfs_path)
+        with store.unpack(str(app_container_image)) as (rootfs_path, manifest):
+            assert rootfs_path == first_rootfs_path
+            assert manifest['name'] == 'test/test'
+
+        assert len(store.entries()) == 1
+
+    def test_image_id(self, tmpdir, app_container_image):
+        store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+
+        image_id = store.image_id(str(app_container_image))
+        assert image_id == sandboxlib.load.appc.image_digest(
+            str(app_container_image))
+        assert image_id.startswith('sha512-')
+        assert store.image_id(str(app_container_image)) == image_id
+
+    def test_evict(self, tmpdir):
+        store = sandboxlib.load.appc.ImageStore(
+            str(tmpdir.join('store')), max_size=2500)
+
+        images = [
+            make_app_container_image(
+                tmpdir.join('%i.aci' % i), 'test/%i' % i, str(i) * 1000)
+            for i in range(3)]
+
+        for image in images:
+            with store.unpack(str(image)):
+                pass
+            # Make sure the last-used times differ.
+            for image_id, size, last_used in store.entries():
+                path = os.path.join(store.path, 'images', image_id)
+                os.utime(path, (last_used - 10, last_used - 10))
+
+        remaining = set(image_id for image_id, size, last_used
+                        in store.entries())
+        assert remaining == set(store.image_id(str(image))
+                                for image in images[1:])
+
+    def test_entry_in_use_is_not_evicted(self, tmpdir, app_container_image):
+        store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+
+        with store.unpack(str(app_container_image)) as (rootfs_path, manifest):
+            store.evict(0)
+            assert os.path.exists(rootfs_path)
+
+        store.evict(0)
+        assert not os.path.exists(rootfs_path)
+
+
+def program_found(name):
+    try:
+        sandboxlib.utils.find_program(name)
+        return True
+    except sandboxlib.ProgramNotFound:
+        return False
+
+
+def test_filesystem_image_type(tmpdir):
+    squashfs = tmpdir.join('image.squashfs')
+    squashfs.write(b'hsqs' + b'\0' * 2000, mode='wb')
+    erofs = tmpdir.join('image.erofs')
+    erofs.write(b'\0' * 1024 + b'\xe2\xe1\xf5\xe0' + b'\0' * 1000, mode='wb')
+    other = tmpdir.join('image.tar')
+    other.write(b'\0' * 2000, mode='wb')
+
+    image = sandboxlib.load.image
+    assert image.filesystem_image_type(str(squashfs)) == image.SQUASHFS
+    assert image.filesystem_image_type(str(erofs)) == image.EROFS
+    assert image.filesystem_image_type(str(other)) is None
+    assert image.filesystem_image_type(str(tmpdir.join('missing'))) is None
+
+
+@pytest.fixture()
+def ext4_image(tmpdir):
+    # No squashfs or erofs tools are needed to test the mounting code, as
+    # any filesystem type can be given explicitly.
+    if os.getuid() != 0:
+        pytest.skip('mounting images needs the root user')
+    if not program_found('mkfs.ext4'):
+        pytest.skip("'mkfs.ext4' not found")
+
+    tree = tmpdir.join('tree')
+    tree.join('data').write('x' * 1000, ensure=True)
+    tree.join('tmp').ensure(dir=True)
+    tree.join('work').ensure(dir=True)
+    image_file = tmpdir.join('image.ext4')
+    exit, out, err = sandboxlib._run_command(
+        ['mkfs.ext4', '-q', '-d', str(tree), str(image_file), '4M'],
+        stdout=sandboxlib.CAPTURE, stderr=sandboxlib.CAPTURE)
+    assert exit == 0, err
+    return image_file
+
+
+def test_mount_filesystem_image(tmpdir, ext4_image):
+    host_dir = tmpdir.join('host').ensure(dir=True)
+
+    image = sandboxlib.load.image
+    with image.mount_filesystem_image(
+            str(ext4_image), filesystem_type='ext4') as root:
+        assert os.path.ismount(root)
+        with pytest.raises(OSError):
+            open(os.path.join(root, 'new-file'), 'w')
+
+        with image.writable_layers(root, ['/tmp', ('/work', str(host_dir))]):
+            # The writable paths start empty, or with the host directory.
+            assert os.listdir(os.path.join(root, 'tmp')) == []
+            open(os.path.join(root, 'tmp', 'new-file'), 'w').close()
+            open(os.path.join(root, 'work', 'new-file'), 'w').close()
+
+        assert host_dir.join('new-file').exists()
+        assert not os.path.exists(os.path.join(root, 'tmp', 'new-file'))
+
+        with pytest.raises(RuntimeError):
+            with image.writable_layers(root, ['/missing']):
+                pass
+
+    assert not os.path.exists(root)
+
+
+@pytest.mark.skipif(not program_found('mksquashfs'),
+                    reason="'mksquashfs' not found")
+def test_mount_app_container_image(tmpdir, app_container_image):
+    if os.getuid() != 0:
+        pytest.skip('mounting images needs the root user')
+
+    store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+    context = sandboxlib.load.appc.mount_app_container_image(
+        str(app_container_image), store=store)
+    with context as (rootfs_path, manifest):
+        assert manifest['name'] == 'test/test'
+        assert os.path.exists(os.path.join(rootfs_path, 'data'))
+
+    # The squashfs image is kept in the store.
+    assert len(store.entries()) == 1
+
+
+def test_image_store_filesystem_image(tmpdir, monkeypatch,
+                                      app_container_image):
+    converted = []
+
+    def fake_convert_tree(path, image_file, filesystem_type):
+        converted.append(sorted(os.listdir(path)))
+        with open(image_file, 'wb') as f:
+            f.write(b'hsqs')
+
+    monkeypatch.setattr(
+        sandboxlib.load.image, 'convert_tree', fake_convert_tree)
+
+    store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+    for i in range(2):
+        with store.filesystem_image(str(app_container_image)) as image_file:
+            assert sandboxlib.load.image.is_filesystem_image(image_file)
+
+    # The image is only converted once.
+    assert converted == [['manifest', 'rootfs']]
+    [(name, size, last_used)] = store.entries()
+    assert name.endswith('.squashfs')
+    assert size == 4
+
+    store.evict(0)
+    assert store.entries() == []
+
+
+class TestExtractTarball(object):
+    @pytest.fixture()
+    def tree(self, tmpdir):
+        tree = tmpdir.join('tree')
+        tree.join('dir', 'small').write('x' * 1000, ensure=True)
+        tree.join('dir', 'large').write('y' * (3 * 1024 * 1024))
+        tree.join('dir', 'small').chmod(0o640)
+        os.link(str(tree.join('dir', 'small')), str(tree.join('hardlink')))
+        tree.join('symlink').mksymlinkto('dir/small')
+        tree.join('dir').chmod(0o750)
+        os.utime(str(tree.join('dir')), (1000000000, 1000000000))
+        return tree
+
+    def make_tarball(self, tmpdir, tree, mode):
+        path = tmpdir.join('tree.tar')
+        with tarfile.open(str(path), mode) as tf:
+            for name in ['dir', 'hardlink', 'symlink']:
+                tf.add(str(tree.join(name)), arcname=name)
+        return path
+
+    def check_tree(self, path):
+        assert path.join('dir', 'small').read() == 'x' * 1000
+        assert path.join('dir', 'large').read() == 'y' * (3 * 1024 * 1024)
+        assert path.join('dir', 'small').stat().mode & 0o777 == 0o640
+        assert path.join('hardlink').stat().ino == \
+            path.join('dir', 'small').stat().ino
+        assert path.join('symlink').readlink() == 'dir/small'
+        assert path.join('dir').stat().mode & 0o777 == 0o750
+        assert path.join('dir').stat().mtime == 1000000000
+
+    @pytest.mark.parametrize('mode', ['w', 'w:gz', 'w:bz2', 'w:xz'])
+    def test_extract(self, tmpdir, tree, mode):
+        tarball = self.make_tarball(tmpdir, tree, mode)
+        target = tmpdir.mkdir('target')
+
+        size = sandboxlib.load.extract.extract_tarball(
+            str(tarball), str(target), writer_threads=2)
+
+        self.check_tree(target)
+        assert size == 1000 + 3 * 1024 * 1024
+
+    @pytest.mark.parametrize('mode', ['w:gz', 'w:bz2', 'w:xz'])
+    def test_extract_without_programs(self, tmpdir, monkeypatch, tree, mode):
+        monkeypatch.setattr(sandboxlib.load.extract, 'decompressor_program',
+                            lambda compression: None)
+        tarball = self.make_tarball(tmpdir, tree, mode)
+        target = tmpdir.mkdir('target')
+
+        sandboxlib.load.extract.extract_tarball(str(tarball), str(target))
+
+        self.check_tree(target)
+
+    def test_compression_format(self, tmpdir, tree):
+        extract = sandboxlib.load.extract
+        for mode, compression in [('w', None), ('w:gz', extract.GZIP),
+                                  ('w:bz2', extract.BZIP2),
+                                  ('w:xz', extract.XZ)]:
+            tarball = self.make_tarball(tmpdir, tree, mode)
+            assert extract.compression_format(str(tarball)) == compression
+
+    def test_refuse_path_outside_target(self, tmpdir):
+        tarball = tmpdir.join('evil.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            info = tarfile.TarInfo('../evil')
+            tf.addfile(info)
+
+        with pytest.raises(RuntimeError):
+            sandboxlib.load.extract.extract_tarball(
+                str(tarball), str(tmpdir.mkdir('target')))
+        assert not tmpdir.join('evil').exists()
+
+    def add_file(self, tf, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+
+    def add_symlink(self, tf, name, linkname):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tf.addfile(info)
+
+    def test_duplicate_member(self, tmpdir):
+        tarball = tmpdir.join('duplicate.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            for i in range(20):
+                self.add_file(tf, 'file', str(i).encode('ascii'))
+        target = tmpdir.mkdir('target')
+
+        sandboxlib.load.extract.extract_tarball(
+            str(tarball), str(target), writer_threads=4)
+        assert target.join('file').read() == '19'
+
+    def test_file_replaced_by_symlink(self, tmpdir):
+        outside = tmpdir.join('outside')
+        outside.write('outside')
+        tarball = tmpdir.join('evil.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            self.add_file(tf, 'file', b'x' * 1000)
+            self.add_symlink(tf, 'file', str(outside))
+        target = tmpdir.mkdir('target')
+
+        sandboxlib.load.extract.extract_tarball(
+            str(tarball), str(target), writer_threads=4)
+        assert target.join('file').readlink() == str(outside)
+        assert outside.read() == 'outside'
+
+    def test_refuse_path_through_symlink(self, tmpdir):
+        outside = tmpdir.mkdir('outside')
+        tarball = tmpdir.join('evil.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            self.add_symlink(tf, 'link', str(outside))
+            self.add_file(tf, 'link/evil', b'evil')
+
+        with pytest.raises(RuntimeError):
+            sandboxlib.load.extract.extract_tarball(
+                str(tarball), str(tmpdir.mkdir('target')))
+        assert not outside.join('evil').exists()
+
+    def test_decompressor_errors_are_reported(self, tmpdir, tree):
+        if sandboxlib.load.extract.decompressor_program('gzip') is None:
+            pytest.skip('no gzip program found')
+        tarball = self.make_tarball(tmpdir, tree, 'w:gz')
+        data = tarball.read_binary()
+        tarball.write_binary(data[:len(data) // 2])
+
+        with pytest.raises(RuntimeError) as excinfo:
+            sandboxlib.load.extract.extract_tarball(
+                str(tarball), str(tmpdir.mkdir('target')))
+        assert str(tarball) in str(excinfo.value)
+
+    def test_hardlink_to_symlink(self, tmpdir):
+        outside = tmpdir.join('outside')
+        outside.write('outside')
+        tarball = tmpdir.join('evil.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            self.add_symlink(tf, 'a', str(outside))
+            info = tarfile.TarInfo('b')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'a'
+            tf.addfile(info)
+        target = tmpdir.mkdir('target')
+
+        sandboxlib.load.extract.extract_tarball(str(tarball), str(target))
+        assert target.join('b').readlink() == str(outside)
+        assert outside.stat().nlink == 1
+
+    def test_refuse_hardlink_to_directory(self, tmpdir):
+        tarball = tmpdir.join('evil.tar')
+        with tarfile.open(str(tarball), 'w') as tf:
+            info = tarfile.TarInfo('dir')
+            info.type = tarfile.DIRTYPE
+            tf.addfile(info)
+            info = tarfile.TarInfo('link')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'dir'
+            tf.addfile(info)
+
+        with pytest.raises(RuntimeError):
+            sandboxlib.load.extract.extract_tarball(
+                str(tarball), str(tmpdir.mkdir('target')))
+
+    def test_corrupt_archive(self, tmpdir, tree):
+        tarball = self.make_tarball(tmpdir, tree, 'w:gz')
+        data = tarball.read_binary()
+        tarball.write_binary(data[:len(data) // 2])
+
+        with pytest.raises((RuntimeError, tarfile.TarError, EOFError,
+                            IOError)):
+            sandboxlib.load.extract.extract_tarball(
+                str(tarball), str(tmpdir.mkdir('target')))
+
+
+class TestReadManifest(object):
+    def test_read_manifest(self, app_container_image):
+        manifest = sandboxlib.load.appc.read_manifest(str(app_container_image))
+        assert manifest['name'] == 'test/test'
+        assert manifest['app']['exec'] == ['/bin/true']
+
+    def test_manifest_after_rootfs(self, tmpdir):
+        image_dir = tmpdir.join('image')
+        image_dir.join('manifest').write(
+            json.dumps({'name': 'test/late'}), ensure=True)
+        image_dir.join('rootfs', 'data').write('x', ensure=True)
+        image = tmpdir.join('late.aci')
+        with tarfile.open(str(image), 'w:xz') as tf:
+            tf.add(str(image_dir.join('rootfs')), arcname='rootfs')
+            tf.add(str(image_dir.join('manifest')), arcname='./manifest')
+
+        manifest = sandboxlib.load.appc.read_manifest(str(image))
+        assert manifest['name'] == 'test/late'
+
+    def test_missing_manifest(self, tmpdir):
+        image = tmpdir.join('empty.aci')
+        tmpdir.join('data').write('x')
+        with tarfile.open(str(image), 'w:gz') as tf:
+            tf.add(str(tmpdir.join('data')), arcname='rootfs/data')
+
+        with pytest.raises(ValueError):
+            sandboxlib.load.appc.read_manifest(str(image))
+
+    @pytest.mark.parametrize('manifest', [
+        [], {}, {'name': 'x', 'app': []}, {'name': 'x', 'app': {'exec': []}},
+        {'name': 'x', 'app': {'exec': '/bin/true'}},
+        {'name': 'x', 'app': {'environment': [{'name': 'A'}]}},
+    ])
+    def test_invalid_manifest(self, manifest):
+        with pytest.raises(ValueError):
+            sandboxlib.load.appc.validate_manifest(manifest)
+
+    def test_manifest_cache(self, tmpdir, monkeypatch, app_container_image):
+        store = sandboxlib.load.appc.ImageStore(str(tmpdir.join('store')))
+
+        def fail_digest(image_file):
+            raise AssertionError("The image was hashed.")
+
+        monkeypatch.setattr(sandboxlib.load.appc, 'image_digest', fail_digest)
+        manifest = sandboxlib.load.appc.read_manifest(
+            str(app_container_image), store=store)
+        assert manifest['name'] == 'test/test'
+
+        def fail(image_file):
+            raise AssertionError("The manifest was read again.")
+
+        monkeypatch.setattr(
+            sandboxlib.load.appc, '_read_manifest_member', fail)
+        assert sandboxlib.load.appc.read_manifest(
+            str(app_container_image), store=store) == manifest
+        assert store.entries() == []
+
+
+class TestTree(object):
+    @pytest.fixture()
+    def manifest_file(self, tmpdir):
+        path = tmpdir.join('manifest')
+        path.write(json.dumps({'name': 'test/tree',
+                               'app': {'exec': ['/bin/true']}}))
+        return path
+
+    def test_open_directory(self, tmpdir, manifest_file):
+        rootfs = tmpdir.mkdir('rootfs')
+
+        context = sandboxlib.load.tree.open_directory(str(rootfs))
+        with context as (rootfs_path, manifest):
+            assert rootfs_path == str(rootfs)
+            assert manifest is None
+
+        context = sandboxlib.load.tree.open_directory(
+            str(rootfs), manifest_file=str(manifest_file))
+        with context as (rootfs_path, manifest):
+            assert rootfs_path == str(rootfs)
+            assert manifest['name'] == 'test/tree'
+
+    def test_open_app_container_directory(self, tmpdir, manifest_file):
+        rootfs = tmpdir.mkdir('rootfs')
+        assert sandboxlib.load.tree.is_app_container_directory(str(tmpdir))
+
+        context = sandboxlib.load.tree.open_directory(str(tmpdir))
+        with context as (rootfs_path, manifest):
+            assert rootfs_path == str(rootfs)
+            assert manifest['name'] == 'test/tree'
+
+    def test_unpack_tarball(self, tmpdir, manifest_file):
+        tmpdir.join('rootfs', 'data').write('x', ensure=True)
+        tarball = tmpdir.join('rootfs.tar.gz')
+        with tarfile.open(str(tarball), 'w:gz') as tf:
+            tf.add(str(tmpdir.join('rootfs', 'data')), arcname='data')
+
+        assert sandboxlib.load.tree.is_tarball(str(tarball))
+        assert not sandboxlib.load.tree.is_tarball(str(manifest_file))
+
+        context = sandboxlib.load.tree.unpack_tarball(
+            str(tarball), manifest_file=str(manifest_file))
+        with context as (rootfs_path, manifest):
+            assert os.path.exists(os.path.join(rootfs_path, 'data'))
+            assert manifest['name'] == 'test/tree'
+        assert not os.path.exists(rootfs_path)
+
+    def test_invalid_manifest_file(self, tmpdir):
+        manifest_file = tmpdir.join('manifest')
+        manifest_file.write('{')
+        with pytest.raises(ValueError):
+            sandboxlib.load.appc.load_manifest(str(manifest_file))
@@ -0,0 +1,100 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the output consumers in sandboxlib.output.'''
+
+
+import io
+import sys
+
+import pytest
+
+import sandboxlib
+
+
+def test_tail_buffer():
+    buf = sandboxlib.output.TailBuffer(max_size=10)
+    for chunk in [b'0123', b'4567', b'89ab', b'cd', b'']:
+        buf(chunk)
+
+    assert buf.getvalue() == b'456789abcd'
+    assert buf.total_size == 14
+    assert buf.truncated
+
+
+def test_tail_buffer_large_chunk():
+    buf = sandboxlib.output.TailBuffer(max_size=4)
+    buf(b'xy')
+    buf(b'0123456789')
+
+    assert buf.getvalue() == b'6789'
+
+
+def test_tail_buffer_spill_file():
+    spill_file = io.BytesIO()
+    buf = sandboxlib.output.TailBuffer(max_size=4, spill_file=spill_file)
+    for chunk in [b'0123', b'4567', b'89', b'']:
+        buf(chunk)
+
+    assert buf.getvalue() == b'6789'
+    assert spill_file.getvalue() == b'0123456789'
+
+
+def test_line_splitter():
+    lines = []
+    splitter = sandboxlib.output.LineSplitter(lines.append, max_line_length=8)
+    for chunk in [b'one\ntw', b'o\n\nthree', b'-and-a-bit\nfour', b'']:
+        splitter(chunk)
+
+    assert lines == [
+        b'one\n', b'two\n', b'\n', b'three-an', b'd-a-bit\n', b'four']
+
+
+def test_large_output():
+    # 64MB of output, with only a small tail kept.
+    buf = sandboxlib.output.TailBuffer(max_size=1024)
+    exit, out, err = sandboxlib._run_command(
+        ['dd', 'if=/dev/zero', 'bs=1M', 'count=64'], stdout=buf, stderr=None)
+
+    assert exit == 0
+    assert buf.total_size == 64 * 1024 * 1024
+    assert buf.getvalue() == b'\0' * 1024
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='asyncio API needs Python 3.5 or later')
+def test_async_consumer_backpressure():
+    import asyncio
+
+    received = []
+
+    def slow_consumer(data):
+        received.append(data)
+        return asyncio.sleep(0.001)
+
+    # This module must still import on Python 2, so there is no coroutine
+    # function here.
+    loop = asyncio.new_event_loop()
+    try:
+        process = sandboxlib.spawn.spawn(
+            ['dd', 'if=/dev/zero', 'bs=64k', 'count=64'], slow_consumer, None)
+        exit, out, err = loop.run_until_complete(
+            sandboxlib.aio.communicate(process))
+    finally:
+        loop.close()
+
+    assert exit == 0
+    assert out is None
+    assert sum(len(data) for data in received) == 64 * 65536
@@ -0,0 +1,125 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for running many sandboxes with sandboxlib.pool.'''
+
+
+import sys
+
+import pytest
+
+import sandboxlib
+
+
+pytestmark = [
+    pytest.mark.skipif(sys.version_info < (3, 5),
+                       reason='pool needs Python 3.5 or later'),
+    pytest.mark.backends('chroot', 'linux_namespaces'),
+]
+
+if sys.version_info >= (3, 5):
+    from sandboxlib.pool import Job
+
+
+def test_run_many(sandboxlib_executor):
+    jobs = [Job(['sh', '-c', 'echo %i' % i]) for i in range(10)]
+    finished = list(sandboxlib.pool.run_many(
+        jobs, executor=sandboxlib_executor, max_cpus=4))
+
+    assert sorted(finished, key=jobs.index) == jobs
+    for i, job in enumerate(jobs):
+        assert job.state == sandboxlib.pool.SUCCEEDED
+        assert job.result.stdout == ('%i\n' % i).encode('ascii')
+
+
+def test_completion_order(sandboxlib_executor):
+    slow = Job(['sleep', '0.5'], name='slow')
+    fast = Job(['true'], name='fast')
+    finished = list(sandboxlib.pool.run_many(
+        [slow, fast], executor=sandboxlib_executor, max_cpus=2))
+
+    assert finished == [fast, slow]
+
+
+def test_cpu_limit(sandboxlib_executor, tmpdir):
+    # Each job records how many jobs were running when it started.
+    script = 'touch %(dir)s/%(i)i; ls %(dir)s | wc -l; sleep 0.1; ' \
+             'rm %(dir)s/%(i)i'
+    jobs = [Job(['sh', '-c', script % {'dir': tmpdir, 'i': i}])
+            for i in range(6)]
+    list(sandboxlib.pool.run_many(
+        jobs, executor=sandboxlib_executor, max_cpus=2))
+
+    assert max(int(job.result.stdout) for job in jobs) == 2
+
+
+def test_dependencies(sandboxlib_executor, tmpdir):
+    log = tmpdir.join('log')
+    first = Job(['sh', '-c', 'sleep 0.2; echo first >> %s' % log])
+    second = Job(['sh', '-c', 'echo second >> %s' % log], depends=[first])
+    third = Job(['sh', '-c', 'echo third >> %s' % log], depends=[second])
+    finished = list(sandboxlib.pool.run_many(
+        [third, second, first], executor=sandboxlib_executor, max_cpus=4))
+
+    assert finished == [first, second, third]
+    assert log.read() == 'first\nsecond\nthird\n'
+
+
+def test_fail_fast(sandboxlib_executor):
+    failing = Job(['sh', '-c', 'exit 1'])
+    slow = Job(['sleep', '100'])
+    dependent = Job(['true'], depends=[slow])
+    finished = list(sandboxlib.pool.run_many(
+        [failing, slow, dependent], executor=sandboxlib_executor, max_cpus=2))
+
+    assert finished[0] == failing
+    assert set(finished) == set([failing, slow, dependent])
+    assert failing.state == sandboxlib.pool.FAILED
+    assert failing.result.exit == 1
+    assert slow.state == sandboxlib.pool.CANCELLED
+    assert dependent.state == sandboxlib.pool.CANCELLED
+
+
+def test_keep_going(sandboxlib_executor):
+    failing = Job(['sh', '-c', 'exit 1'])
+    dependent = Job(['true'], depends=[failing])
+    indirect = Job(['true'], depends=[dependent])
+    other = Job(['sh', '-c', 'sleep 0.2'])
+    finished = list(sandboxlib.pool.run_many(
+        [failing, dependent, indirect, other], executor=sandboxlib_executor,
+        max_cpus=2, keep_going=True))
+
+    assert set(finished) == set([failing, dependent, indirect, other])
+    assert failing.state == sandboxlib.pool.FAILED
+    assert dependent.state == sandboxlib.pool.SKIPPED
+    assert indirect.state == sandboxlib.pool.SKIPPED
+    assert other.state == sandboxlib.pool.SUCCEEDED
+
+
+def test_error(sandboxlib_executor):
+    job = Job(['this-program-does-not-exist'])
+    list(sandboxlib.pool.run_many(
+        [job], executor=sandboxlib_executor, keep_going=True))
+
+    assert job.state == sandboxlib.pool.FAILED
+    assert isinstance(job.error, OSError)
+
+
+def test_cycle():
+    a = Job(['true'])
+    b = Job(['true'], depends=[a])
+    a.depends.append(b)
+    with pytest.raises(ValueError):
+        sandboxlib.pool.run_many([a, b], executor=sandboxlib.chroot)
@@ -0,0 +1,114 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.scheduling' module.'''
+
+
+import pytest
+
+import sys
+
+import sandboxlib
+
+
+pytestmark = pytest.mark.backends('linux_namespaces')
+
+
+@pytest.fixture()
+def two_nodes(monkeypatch):
+    monkeypatch.setattr(sandboxlib.scheduling, 'numa_nodes',
+                        lambda: {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]})
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('0', [0]),
+    ('0-3', [0, 1, 2, 3]),
+    ('0-1,8-9\n', [0, 1, 8, 9]),
+    ('', []),
+])
+def test_parse_cpu_list(text, expected):
+    assert sandboxlib.scheduling.parse_cpu_list(text) == expected
+
+
+def test_split_cpus_by_node(two_nodes):
+    shares = sandboxlib.scheduling.split_cpus(2, cpus=range(8))
+    assert shares == [{'cpus': [0, 1, 2, 3], 'memory_nodes': [0]},
+                      {'cpus': [4, 5, 6, 7], 'memory_nodes': [1]}]
+
+    shares = sandboxlib.scheduling.split_cpus(4, cpus=range(8))
+    assert [share['cpus'] for share in shares] == \
+        [[0, 1], [2, 3], [4, 5], [6, 7]]
+
+    shares = sandboxlib.scheduling.split_cpus(3, cpus=range(8))
+    assert sorted(sum([share['cpus'] for share in shares], [])) == \
+        list(range(8))
+
+
+def test_split_cpus_uneven_nodes(monkeypatch):
+    monkeypatch.setattr(sandboxlib.scheduling, 'numa_nodes',
+                        lambda: {0: [0, 1, 2, 3, 4, 5], 1: [6, 7]})
+    shares = sandboxlib.scheduling.split_cpus(2, cpus=range(8))
+    assert shares == [{'cpus': [0, 1, 2, 3, 4, 5], 'memory_nodes': [0]},
+                      {'cpus': [6, 7], 'memory_nodes': [1]}]
+
+    shares = sandboxlib.scheduling.split_cpus(4, cpus=range(8))
+    assert [share['memory_nodes'] for share in shares] == [[0], [0], [1], [1]]
+
+
+def test_split_cpus_more_sandboxes_than_cpus(monkeypatch):
+    monkeypatch.setattr(sandboxlib.scheduling, 'numa_nodes', lambda: {})
+    shares = sandboxlib.scheduling.split_cpus(3, cpus=[0, 1])
+    assert shares == [{'cpus': [0]}, {'cpus': [1]}, {'cpus': [0]}]
+
+
+def test_split_available_cpus():
+    shares = sandboxlib.scheduling.split_cpus(1)
+    assert shares[0]['cpus'] == sandboxlib.scheduling.available_cpus()
+
+
+def test_run_sandbox(sandboxlib_executor):
+    cpu = sandboxlib.scheduling.available_cpus()[-1]
+    exit, out, err = sandboxlib_executor.run_sandbox(
+        [sys.executable, '-c',
+         'import os; print(sorted(os.sched_getaffinity(0)), '
+         'os.getpriority(os.PRIO_PROCESS, 0))'],
+        scheduling={'cpus': [cpu], 'nice': 10})
+    assert exit == 0, err
+    assert out.decode('ascii').split() == ['[%i]' % cpu, '10']
+
+
+def test_io_class(sandboxlib_executor):
+    try:
+        ionice = sandboxlib.utils.find_program('ionice')
+    except sandboxlib.ProgramNotFound:
+        pytest.skip('ionice is not available')
+
+    exit, out, err = sandboxlib_executor.run_sandbox(
+        [ionice], scheduling={'io_class': 'idle'})
+    assert exit == 0, err
+    assert out.strip() == b'idle'
+
+
+def test_invalid_scheduling(sandboxlib_executor):
+    for scheduling in [{'cpus': []}, {'nice': 20}, {'io_class': 'fast'},
+                       {'io_priority': 8}, {'priority': 1}]:
+        with pytest.raises(AssertionError):
+            sandboxlib_executor.run_sandbox(['true'], scheduling=scheduling)
+
+
+def test_unavailable_cpu(sandboxlib_executor):
+    with pytest.raises(RuntimeError):
+        sandboxlib_executor.run_sandbox(
+            ['true'], scheduling={'cpus': [100000]})
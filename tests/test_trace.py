@@ -0,0 +1,113 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for the 'sandboxlib.trace' module.'''
+
+
+import pytest
+
+import os
+
+import sandboxlib
+from programs import copy_file_test_program, session_tmpdir
+
+
+pytestmark = pytest.mark.backends('linux_namespaces')
+
+
+@pytest.fixture()
+def root(tmpdir, copy_file_test_program):
+    root = tmpdir.mkdir('root')
+    root.mkdir('bin')
+    copy_file_test_program.copy(root.join('bin'))
+    root.join('bin', 'test-copy-file').chmod(0o755)
+    root.join('src', 'input').write('input', ensure=True)
+    root.join('src', 'old').write('old')
+    root.join('tmp', 'a', 'b').write('b', ensure=True)
+    return root
+
+
+def copy_file(executor, root, method, **kwargs):
+    return executor.run_sandbox(
+        ['/bin/test-copy-file', '/src/input', '/out', '/src/old',
+         '/tmp/a/b'],
+        filesystem_root=str(root), trace=method, **kwargs)
+
+
+def test_metadata(sandboxlib_executor, root):
+    result = copy_file(sandboxlib_executor, root, sandboxlib.trace.METADATA)
+    assert result.exit == 0
+    assert 'trace' in result.timings
+
+    accesses = result.file_accesses
+    assert accesses.read is None
+    assert accesses.written == ['/out']
+    assert accesses.created == ['/out']
+    assert accesses.deleted == ['/src/old', '/tmp/a/b']
+
+
+def test_no_trace(sandboxlib_executor, root):
+    result = copy_file(sandboxlib_executor, root, None)
+    assert result.exit == 0
+    assert result.file_accesses is None
+
+
+def test_writable_paths(sandboxlib_executor, root):
+    root.mkdir('out')
+    result = sandboxlib_executor.run_sandbox(
+        ['/bin/test-copy-file', '/src/input', '/out/file'],
+        filesystem_root=str(root), filesystem_writable_paths=['/out'],
+        trace=sandboxlib.trace.METADATA)
+    assert result.exit == 0
+    assert result.file_accesses.to_dict() == {
+        'read': None, 'written': ['/out/file'], 'created': ['/out/file'],
+        'deleted': []}
+
+
+def test_changed_file_is_written(tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('file').write('before')
+
+    tracer = sandboxlib.trace.Tracer(
+        sandboxlib.trace.METADATA, filesystem_root=str(root))
+    tracer.start()
+    root.join('file').write('changed')
+    root.mkdir('directory')
+    accesses = tracer.finish()
+
+    assert accesses.written == ['/file']
+    assert accesses.created == ['/directory']
+    assert accesses.deleted == []
+
+
+def test_root_not_allowed():
+    with pytest.raises(AssertionError):
+        sandboxlib.trace.Tracer(sandboxlib.trace.METADATA,
+                                filesystem_root='/')
+
+
+def test_fanotify(sandboxlib_executor, root):
+    try:
+        result = copy_file(
+            sandboxlib_executor, root, sandboxlib.trace.FANOTIFY)
+    except RuntimeError as e:
+        pytest.skip(str(e))
+    assert result.exit == 0
+
+    accesses = result.file_accesses
+    assert accesses.read == ['/bin/test-copy-file', '/src/input']
+    assert accesses.written == ['/out']
+    assert accesses.created == ['/out']
+    assert accesses.deleted == ['/src/old', '/tmp/a/b']
@@ -0,0 +1,205 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Tests for converting 'filesystem_writable_paths' into read-only paths.
+
+The larger scaling tests create up to a million files, so they are skipped
+unless SANDBOXLIB_SLOW_TESTS is set in the environment.
+
+'''
+
+
+import pytest
+
+import os
+
+import sandboxlib
+from sandboxlib.linux_user_chroot import invert_paths, invert_writable_paths
+
+
+def reference_readonly_paths(fs_root, writable_paths):
+    '''The os.walk()-based implementation, for comparison.'''
+    absolute_writable_paths = [
+        os.path.join(fs_root, path.lstrip('/')) for path in writable_paths]
+    result = []
+    for path in sorted(invert_paths(os.walk(fs_root), absolute_writable_paths)):
+        if not os.path.islink(path):
+            result.append('/' + os.path.relpath(path, fs_root))
+    return result
+
+
+@pytest.fixture()
+def small_tree(tmpdir):
+    for path in ['bin/sh', 'data/1/canary', 'data/2/canary', 'data-2/x',
+                 'usr/lib/a', 'usr/lib/b/c', 'usr/share/d']:
+        tmpdir.join(path).write('', ensure=True)
+    tmpdir.join('data', 'link').mksymlinkto(tmpdir.join('usr'))
+    tmpdir.join('lib').mksymlinkto('usr/lib')
+    return tmpdir
+
+
+@pytest.mark.parametrize('writable_paths', [
+    [],
+    ['/'],
+    ['/data/1'],
+    ['/data/1', '/data/2/canary', 'usr/lib/b/'],
+    ['/data', '/data/1/canary'],
+    ['/bin/sh/impossible', '/nonexistent/path', '/data-2'],
+])
+def test_matches_reference(small_tree, writable_paths):
+    fs_root = str(small_tree)
+    expected = reference_readonly_paths(fs_root, writable_paths)
+    result = invert_writable_paths(fs_root, writable_paths)
+    # The reference implementation returns '/.' for the root directory.
+    assert sorted(result) == sorted(
+        '/' if path == '/.' else path for path in expected)
+
+
+def make_synthetic_tree(root, n_entries, files_per_directory=1000):
+    '''Create a tree resembling a staging area, with 'n_entries' entries.'''
+    for path in ['bin', 'etc', 'home/user', 'usr/lib/x', 'var/tmp']:
+        root.join(path).ensure(dir=True)
+
+    share = root.join('usr', 'share')
+    n_directories = max(1, n_entries // files_per_directory)
+    for i in range(n_directories):
+        directory = share.join('d%i' % i)
+        directory.ensure(dir=True)
+        for j in range(min(n_entries, files_per_directory)):
+            # Avoiding py.path here speeds things up a lot.
+            open(os.path.join(str(directory), 'f%i' % j), 'w').close()
+
+
+@pytest.mark.parametrize('n_entries', [
+    10**3,
+    10**4,
+    pytest.param(10**5, marks=pytest.mark.skipif(
+        'SANDBOXLIB_SLOW_TESTS' not in os.environ, reason='slow test')),
+    pytest.param(10**6, marks=pytest.mark.skipif(
+        'SANDBOXLIB_SLOW_TESTS' not in os.environ, reason='slow test')),
+])
+def test_scaling(tmpdir, monkeypatch, n_entries):
+    '''The work done must not depend on the size of the read-only parts.'''
+    fs_root = tmpdir.join('root')
+    make_synthetic_tree(fs_root, n_entries)
+
+    scanned = []
+    scan_directory = sandboxlib.utils.scan_directory
+
+    def counting_scan_directory(path):
+        entries = scan_directory(path)
+        scanned.append((path, len(entries)))
+        return entries
+
+    monkeypatch.setattr(
+        sandboxlib.utils, 'scan_directory', counting_scan_directory)
+
+    result = invert_writable_paths(
+        str(fs_root), ['/home/user', '/usr/lib/x', '/var/tmp'])
+
+    assert result == ['/bin', '/etc', '/usr/share']
+    assert sorted(os.path.relpath(path, str(fs_root))
+                  for path, n in scanned) == [
+        '.', 'home', 'usr', 'usr/lib', 'var']
+    assert sum(n for path, n in scanned) == 10
+
+
+class TestReadOnlyPathsCache(object):
+    def age_tree(self, path):
+        # Directories modified very recently aren't trusted by the cache.
+        old = os.stat(str(path)).st_mtime - 60
+        for dirpath, dirnames, filenames in os.walk(str(path)):
+            os.utime(dirpath, (old, old))
+
+    def test_hit_and_miss(self, small_tree):
+        self.age_tree(small_tree)
+        cache = sandboxlib.linux_user_chroot.ReadOnlyPathsCache()
+
+        first = cache.readonly_paths(str(small_tree), ['/data/1'])
+        second = cache.readonly_paths(str(small_tree), ['data/1/'])
+
+        assert first == second == invert_writable_paths(
+            str(small_tree), ['/data/1'])
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_modified_directory(self, small_tree):
+        self.age_tree(small_tree)
+        cache = sandboxlib.linux_user_chroot.ReadOnlyPathsCache()
+
+        cache.readonly_paths(str(small_tree), ['/data/1'])
+        small_tree.join('data', '3').ensure(dir=True)
+        result = cache.readonly_paths(str(small_tree), ['/data/1'])
+
+        assert '/data/3' in result
+        assert (cache.hits, cache.misses) == (0, 2)
+
+    def test_recently_modified_directory(self, small_tree):
+        cache = sandboxlib.linux_user_chroot.ReadOnlyPathsCache()
+
+        cache.readonly_paths(str(small_tree), ['/data/1'])
+        cache.readonly_paths(str(small_tree), ['/data/1'])
+
+        assert (cache.hits, cache.misses) == (0, 2)
+
+    def test_generation(self, small_tree):
+        cache = sandboxlib.linux_user_chroot.ReadOnlyPathsCache()
+
+        cache.readonly_paths(str(small_tree), ['/data/1'], generation=1)
+        small_tree.join('data', '3').ensure(dir=True)
+        result = cache.readonly_paths(
+            str(small_tree), ['/data/1'], generation=1)
+        assert '/data/3' not in result
+
+        result = cache.readonly_paths(
+            str(small_tree), ['/data/1'], generation=2)
+        assert '/data/3' in result
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_invalidate(self, small_tree):
+        self.age_tree(small_tree)
+        cache = sandboxlib.linux_user_chroot.ReadOnlyPathsCache()
+
+        cache.readonly_paths(str(small_tree), ['/data/1'], generation=1)
+        cache.invalidate(str(small_tree))
+        cache.readonly_paths(str(small_tree), ['/data/1'], generation=1)
+
+        assert (cache.hits, cache.misses) == (0, 2)
+
+    def test_generation_through_run_sandbox(self, small_tree, monkeypatch):
+        self.age_tree(small_tree)
+        monkeypatch.setattr(sandboxlib.linux_user_chroot,
+                            'linux_user_chroot_program', lambda: 'true')
+        monkeypatch.setattr(sandboxlib.linux_user_chroot,
+                            'readonly_paths_cache',
+                            sandboxlib.linux_user_chroot.ReadOnlyPathsCache())
+        cache = sandboxlib.linux_user_chroot.readonly_paths_cache
+
+        def run(generation):
+            # 'true' stands in for linux-user-chroot, and ignores its
+            # arguments.
+            result = sandboxlib.linux_user_chroot.run_sandbox(
+                ['sh'], filesystem_root=str(small_tree),
+                filesystem_writable_paths=['/data/1'],
+                filesystem_generation=generation)
+            assert result.exit == 0
+
+        run(1)
+        small_tree.join('data', '3').ensure(dir=True)
+        self.age_tree(small_tree)
+        run(1)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        run(2)
+        assert (cache.hits, cache.misses) == (1, 2)